@@ -0,0 +1,162 @@
+import json
+import re
+import time
+from os.path import getsize
+
+# this module is what the parsing workers import, so it must not have any import time side effects
+
+# files at least this big are decoded one message at a time instead of loading the whole document
+STREAM_THRESHOLD = 64 * 1024 * 1024
+STREAM_CHUNK = 4 * 1024 * 1024
+
+SKIP_WHITESPACE = re.compile(r"\s*")
+SKIP_TO_VALUE = re.compile(r"[\s:]*")
+SKIP_SEPARATORS = re.compile(r"[\s,]*")
+
+def parseFile(path: str) -> dict:
+    """Parses one DiscordChatExporter json file into plain tuples that are cheap to send back from a worker.
+
+    The result has the file's channel, the authors seen in it (by id, in the same shape as the export's
+    author json) and its messages as (id, author id, content, timestamp, ((url, file name), ...)) tuples.
+    """
+    size = getsize(path)
+
+    if size >= STREAM_THRESHOLD:
+        header, all_messages = streamFile(path)
+    else:
+        with open(path, "r", encoding="utf-8") as jsonFile:
+            header = json.load(jsonFile)
+        all_messages = header["messages"]
+
+    guild_json = header["guild"]
+    channel_json = header["channel"]
+
+    channel = (guild_json["name"], channel_json["name"], guild_json["iconUrl"], channel_json["id"], guild_json["id"])
+    authors = dict[str, dict[str, str]]()
+    out_messages = []
+
+    for message_json in all_messages:
+        author_json = message_json["author"]
+        author_id = author_json["id"]
+
+        if author_id not in authors:
+            authors[author_id] = {"name": author_json["name"], "nickname": author_json["nickname"], "color": author_json["color"], "avatarUrl": author_json["avatarUrl"]}
+
+        attachments = tuple((attachment_json["url"], attachment_json["fileName"]) for attachment_json in message_json["attachments"])
+
+        out_messages.append((message_json["id"], author_id, message_json["content"], message_json["timestamp"], attachments))
+
+    return {"path": path, "bytes": size, "channel": channel, "authors": authors, "messages": out_messages}
+
+def streamFile(path: str):
+    """Reads the header of an export and returns it with a generator over its messages.
+
+    Only one chunk of the file and the message being decoded are held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    jsonFile = open(path, "r", encoding="utf-8")
+    buffer = ""
+    position = 0
+
+    def readMore() -> bool:
+        nonlocal buffer
+        nonlocal position
+        chunk = jsonFile.read(STREAM_CHUNK)
+        # drop what has been consumed only when reading, so decoding a message never copies the buffer
+        buffer = buffer[position:] + chunk
+        position = 0
+        return chunk != ""
+
+    def skip(pattern: re.Pattern) -> None:
+        nonlocal position
+        while True:
+            position = pattern.match(buffer, position).end()
+            if position < len(buffer) or not readMore():
+                return
+
+    def decodeNext():
+        nonlocal position
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the value runs past the end of what we have read so far
+                if not readMore():
+                    raise
+                continue
+
+            position = end
+            return value
+
+    # the keys before "messages" are the small header (guild, channel, date range, ...), read them one at a time
+    header = dict()
+
+    try:
+        skip(SKIP_WHITESPACE)
+        if not buffer.startswith("{", position):
+            raise ValueError(f"{path} is not a json object")
+        position += 1
+
+        while True:
+            skip(SKIP_SEPARATORS)
+            key = decodeNext()
+            skip(SKIP_TO_VALUE)
+
+            if key == "messages":
+                break
+
+            header[key] = decodeNext()
+    except:
+        jsonFile.close()
+        raise
+
+    def messageIterator():
+        nonlocal position
+
+        try:
+            if not buffer.startswith("[", position):
+                raise ValueError(f"{path} has a malformed messages array")
+            position += 1
+
+            while True:
+                skip(SKIP_SEPARATORS)
+                if position >= len(buffer) or buffer.startswith("]", position):
+                    return
+
+                yield decodeNext()
+        finally:
+            jsonFile.close()
+
+    return header, messageIterator()
+
+class ParseProgress:
+    """Prints a periodic files/bytes/messages throughput line while an archive is parsed."""
+
+    def __init__(self, total_files: int, total_bytes: int, interval: float = 2.0):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+
+        self.files = 0
+        self.bytes = 0
+        self.messages = 0
+        self.start = time.perf_counter()
+        self.last_print = self.start
+
+    def update(self, result: dict) -> None:
+        self.files += 1
+        self.bytes += result["bytes"]
+        self.messages += len(result["messages"])
+
+        now = time.perf_counter()
+        if now - self.last_print >= self.interval and self.files < self.total_files:
+            self.last_print = now
+            self.print(now)
+
+    def print(self, now: float) -> None:
+        elapsed = max(now - self.start, 1e-9)
+        print(f"Parsed {self.files}/{self.total_files} files, {self.bytes / 1e6:.1f}/{self.total_bytes / 1e6:.1f} MB, "
+              f"{self.messages} messages ({self.bytes / 1e6 / elapsed:.1f} MB/s, {self.messages / elapsed:.0f} messages/s)")
+
+    def finish(self) -> None:
+        self.print(time.perf_counter())
@@ -0,0 +1,344 @@
+# message_reader imports this module before its own classes exist, so annotations must not be evaluated eagerly
+from __future__ import annotations
+
+import json
+import mmap
+import sys
+from os import listdir, replace, stat, getcwd
+from os.path import isfile, join, exists
+from collections.abc import Mapping, Iterator
+from datetime import datetime, date, timedelta, timezone
+import numpy as np
+import message_reader as mr
+
+# a compiled, columnar copy of the parsed messages2 archive that message_reader can memory-map at startup.
+#
+# layout: MAGIC, a little endian uint64 with the length of a json table of contents, the table of contents,
+# then every column as a raw numpy array aligned to 8 bytes. messages are sorted by month-day, then year,
+# then timestamp, so a calendar day is one contiguous slice found through the day_buckets offset table.
+
+MAGIC = b"PZSNAP01"
+VERSION = 1
+SNAPSHOT_PATH = join(getcwd(), 'messages2.snapshot')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# month * 32 + day, so every month-day has its own slot
+BUCKETS = 13 * 32
+
+def dayKey(month: int, day: int) -> int:
+    return month * 32 + day
+
+def sourceSignature(folder: str) -> dict[str, list[int]]:
+    out = dict()
+
+    for f in sorted(listdir(folder)):
+        path = join(folder, f)
+        if isfile(path):
+            file_stat = stat(path)
+            out[f] = [file_stat.st_size, file_stat.st_mtime_ns]
+
+    return out
+
+def writeSnapshot(path: str, messages: Mapping, people: Mapping, channels: Mapping, source: dict[str, list[int]]) -> None:
+    people_ids = list(people)
+    person_index = {person_id: i for i, person_id in enumerate(people_ids)}
+    channel_ids = list(channels)
+    channel_index = {channel_id: i for i, channel_id in enumerate(channel_ids)}
+
+    ordered = sorted(messages.values(), key=lambda message: (dayKey(message.ts.month, message.ts.day), message.ts.year, message.ts))
+    n = len(ordered)
+
+    ts_us = np.empty(n, dtype=np.int64)
+    utc_offset = np.empty(n, dtype=np.int16)
+    year = np.empty(n, dtype=np.uint16)
+    discord_id = np.empty(n, dtype=np.uint64)
+    sender = np.empty(n, dtype=np.uint32)
+    channel = np.empty(n, dtype=np.uint32)
+    content_offset = np.empty(n, dtype=np.uint64)
+    content_length = np.empty(n, dtype=np.uint32)
+    attachment_start = np.empty(n, dtype=np.uint32)
+    attachment_count = np.empty(n, dtype=np.uint16)
+    day_buckets = np.zeros(BUCKETS + 1, dtype=np.int64)
+
+    attachment_strings = list[int]()
+    strings = bytearray()
+
+    def addString(value: str) -> tuple[int, int]:
+        encoded = value.encode("utf-8", "surrogatepass")
+        offset = len(strings)
+        strings.extend(encoded)
+        return offset, len(encoded)
+
+    for i, message in enumerate(ordered):
+        ts_us[i] = (message.ts - EPOCH) // ONE_MICROSECOND
+        utc_offset[i] = message.ts.utcoffset() // timedelta(minutes=1)
+        year[i] = message.ts.year
+        discord_id[i] = int(message.discord_id)
+        sender[i] = person_index[message.sender.discord_id]
+        channel[i] = channel_index[message.channel.channel_id]
+        content_offset[i], content_length[i] = addString(message.content)
+
+        attachment_start[i] = len(attachment_strings) // 4
+        attachment_count[i] = len(message.attachments)
+        for attachment in message.attachments:
+            attachment_strings.extend(addString(attachment.url))
+            attachment_strings.extend(addString(attachment.name))
+
+        day_buckets[dayKey(message.ts.month, message.ts.day) + 1] += 1
+
+    np.cumsum(day_buckets, out=day_buckets)
+
+    id_order = np.argsort(discord_id, kind="stable").astype(np.uint32)
+
+    columns = {
+        "ts_us": ts_us,
+        "utc_offset": utc_offset,
+        "year": year,
+        "discord_id": discord_id,
+        "sender": sender,
+        "channel": channel,
+        "content_offset": content_offset,
+        "content_length": content_length,
+        "attachment_start": attachment_start,
+        "attachment_count": attachment_count,
+        # url offset, url length, name offset, name length for every attachment
+        "attachments": np.array(attachment_strings, dtype=np.uint64).reshape(-1, 4),
+        "day_buckets": day_buckets,
+        "id_order": id_order,
+        "sorted_ids": discord_id[id_order],
+        "strings": np.frombuffer(bytes(strings), dtype=np.uint8),
+    }
+
+    toc = dict()
+    toc["version"] = VERSION
+    toc["count"] = n
+    toc["source"] = source
+    toc["people"] = [[people[person_id].username, person_id, people[person_id].nickname, people[person_id].color, people[person_id].avatar] for person_id in people_ids]
+    toc["channels"] = [[channels[channel_id].server_name, channels[channel_id].channel_name, channels[channel_id].icon, channel_id, channels[channel_id].server_id] for channel_id in channel_ids]
+    toc["arrays"] = dict()
+
+    # offsets are relative to the start of the data section, which comes right after the padded table of contents
+    offset = 0
+    for name, column in columns.items():
+        toc["arrays"][name] = [column.dtype.str, list(column.shape), offset]
+        offset += column.nbytes
+        offset += -offset % 8
+
+    toc_bytes = json.dumps(toc).encode("utf-8")
+    header_length = len(MAGIC) + 8 + len(toc_bytes)
+    padding = -header_length % 8
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(MAGIC)
+        out.write(len(toc_bytes).to_bytes(8, "little"))
+        out.write(toc_bytes)
+        out.write(b"\0" * padding)
+
+        written = 0
+        for column in columns.values():
+            out.write(column.tobytes())
+            written += column.nbytes
+            out.write(b"\0" * (-written % 8))
+            written += -written % 8
+
+    # the old snapshot stays usable until the new one is complete
+    replace(tmp_path, path)
+
+class Snapshot:
+    """A memory-mapped snapshot. Messages are only built (and then kept) when they are looked up."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as snapshot_file:
+            self.mm = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a message snapshot")
+
+        toc_length = int.from_bytes(self.mm[len(MAGIC):len(MAGIC) + 8], "little")
+        toc_end = len(MAGIC) + 8 + toc_length
+        toc = json.loads(self.mm[len(MAGIC) + 8:toc_end])
+
+        if toc["version"] != VERSION:
+            raise ValueError(f"{path} is snapshot version {toc['version']}, expected {VERSION}")
+
+        data_start = toc_end + (-toc_end % 8)
+
+        self.count: int = toc["count"]
+        self.source: dict[str, list[int]] = toc["source"]
+
+        self.people_by_index = [mr.Person(username, discord_id, nickname, color, avatar) for username, discord_id, nickname, color, avatar in toc["people"]]
+        self.channels_by_index = [mr.Channel(server_name=server_name, channel_name=channel_name, icon=icon, channel_id=channel_id, server_id=server_id) for server_name, channel_name, icon, channel_id, server_id in toc["channels"]]
+        self.people = {person.discord_id: person for person in self.people_by_index}
+        self.channels = {channel.channel_id: channel for channel in self.channels_by_index}
+
+        columns = dict[str, np.ndarray]()
+        for name, (dtype, shape, offset) in toc["arrays"].items():
+            count = int(np.prod(shape)) if len(shape) > 0 else 1
+            columns[name] = np.frombuffer(self.mm, dtype=np.dtype(dtype), count=count, offset=data_start + offset).reshape(shape)
+
+        self.ts_us = columns["ts_us"]
+        self.utc_offset = columns["utc_offset"]
+        self.year = columns["year"]
+        self.discord_id = columns["discord_id"]
+        self.sender = columns["sender"]
+        self.channel = columns["channel"]
+        self.content_offset = columns["content_offset"]
+        self.content_length = columns["content_length"]
+        self.attachment_start = columns["attachment_start"]
+        self.attachment_count = columns["attachment_count"]
+        self.attachments = columns["attachments"]
+        self.day_buckets = columns["day_buckets"]
+        self.id_order = columns["id_order"]
+        self.sorted_ids = columns["sorted_ids"]
+        self.strings = columns["strings"]
+
+        self.loaded = dict[int, mr.Message]()
+        self.timezones = dict[int, timezone]()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def message(self, i: int) -> mr.Message:
+        message = self.loaded.get(i)
+        if message is not None:
+            return message
+
+        offset = int(self.utc_offset[i])
+        if offset not in self.timezones:
+            self.timezones[offset] = timezone(timedelta(minutes=offset))
+        ts = (EPOCH + timedelta(microseconds=int(self.ts_us[i]))).astimezone(self.timezones[offset])
+
+        attachments = list()
+        start = int(self.attachment_start[i])
+        for url_offset, url_length, name_offset, name_length in self.attachments[start:start + int(self.attachment_count[i])].tolist():
+            attachments.append(mr.Attachment(self.stringAt(url_offset, url_length), self.stringAt(name_offset, name_length)))
+
+        content = self.stringAt(int(self.content_offset[i]), int(self.content_length[i]))
+
+        message = mr.Message(sender=self.people_by_index[self.sender[i]], channel=self.channels_by_index[self.channel[i]], content=content, ts=ts, discord_id=str(self.discord_id[i]), attachments=attachments)
+        self.loaded[i] = message
+        return message
+
+    def stringAt(self, offset: int, length: int) -> str:
+        return self.strings[offset:offset + length].tobytes().decode("utf-8", "surrogatepass")
+
+    def find(self, discord_id: str) -> int | None:
+        try:
+            key = np.uint64(int(discord_id))
+        except (ValueError, OverflowError):
+            return None
+
+        position = int(np.searchsorted(self.sorted_ids, key))
+        if position < self.count and self.sorted_ids[position] == key:
+            return int(self.id_order[position])
+        return None
+
+    def dayRange(self, day: date) -> tuple[int, int]:
+        key = dayKey(day.month, day.day)
+        start = int(self.day_buckets[key])
+        end = int(self.day_buckets[key + 1])
+
+        # inside a month-day bucket messages are sorted by year
+        years = self.year[start:end]
+        return start + int(np.searchsorted(years, day.year, "left")), start + int(np.searchsorted(years, day.year, "right"))
+
+class LazyMessages(Mapping):
+    """discord id -> Message over a snapshot, standing in for message_reader.messages."""
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, discord_id: str) -> mr.Message:
+        i = self.snapshot.find(discord_id)
+        if i is None:
+            raise KeyError(discord_id)
+        return self.snapshot.message(i)
+
+    def __contains__(self, discord_id) -> bool:
+        return self.snapshot.find(discord_id) is not None
+
+    def __iter__(self) -> Iterator[int]:
+        for discord_id in self.snapshot.discord_id.tolist():
+            yield discord_id
+
+    def __len__(self) -> int:
+        return len(self.snapshot)
+
+class LazyDays(Mapping):
+    """date -> list of that day's Messages over a snapshot, standing in for message_reader.day_to_message."""
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, day: date) -> list[mr.Message]:
+        start, end = self.snapshot.dayRange(day)
+        if start == end:
+            raise KeyError(day)
+        return [self.snapshot.message(i) for i in range(start, end)]
+
+    def __contains__(self, day) -> bool:
+        start, end = self.snapshot.dayRange(day)
+        return start < end
+
+    def __iter__(self) -> Iterator[date]:
+        buckets = self.snapshot.day_buckets
+        for key in range(BUCKETS):
+            start = int(buckets[key])
+            end = int(buckets[key + 1])
+            for year in np.unique(self.snapshot.year[start:end]).tolist():
+                yield date(year, key // 32, key % 32)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+class LazyWeights(Mapping):
+    """date -> weights for that day, scored the first time a day is asked for."""
+
+    def __init__(self, days: LazyDays):
+        self.days = days
+        self.weights = dict[date, np.ndarray]()
+
+    def __getitem__(self, day: date) -> np.ndarray:
+        if day not in self.weights:
+            self.weights[day] = mr.scoreBatch(self.days[day])
+        return self.weights[day]
+
+    def __contains__(self, day) -> bool:
+        return day in self.days
+
+    def __iter__(self) -> Iterator[date]:
+        return iter(self.days)
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+def openSnapshot(path: str, folder: str) -> Snapshot | None:
+    """Opens the snapshot at path if it was compiled from exactly the files that are in folder now."""
+    if not exists(path):
+        return None
+
+    try:
+        snapshot = Snapshot(path)
+    except ValueError as e:
+        print(f"Ignoring snapshot: {e}")
+        return None
+
+    # a box can be deployed with only the snapshot and no export next to it
+    if exists(folder) and snapshot.source != sourceSignature(folder):
+        print(f"Ignoring snapshot {path}, {folder} changed since it was compiled")
+        return None
+
+    return snapshot
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else SNAPSHOT_PATH
+
+    if mr.snapshot is not None and path == SNAPSHOT_PATH:
+        print(f"{path} is already up to date")
+    else:
+        print(f"Compiling {len(mr.messages)} messages into {path}...")
+        writeSnapshot(path, mr.messages, mr.people, mr.channels, sourceSignature(mr.MESSAGES_FOLDER))
+        print("Compile Complete!")
@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import time
+from google.cloud import firestore
+import logging as log
+import message_reader_fs as mr
+import metrics
+
+# brings message documents from before the current schema (mr.SCHEMA_VERSION) up to date. version 2 copies the
+# sender's and channel's display fields into the message, version 3 adds month_day and year for the day query.
+#
+# documents are walked in id order a page at a time. each page's writes go out in one batch, and the last id of a
+# committed page is saved to the checkpoint file, so an interrupted run picks up where it left off. documents that
+# are already up to date only cost their read.
+
+CHECKPOINT_FILE = "backfill_checkpoint.json"
+
+# one write per message, firestore caps a batch at 500
+PAGE_SIZE = 400
+
+def readCheckpoint(path: str, namespace: str) -> dict:
+    if not os.path.exists(path):
+        return dict()
+
+    with open(path, "r") as checkpoint_file:
+        return json.load(checkpoint_file).get(namespace, dict())
+
+def writeCheckpoint(path: str, namespace: str, progress: dict) -> None:
+    checkpoints = dict()
+
+    if os.path.exists(path):
+        with open(path, "r") as checkpoint_file:
+            checkpoints = json.load(checkpoint_file)
+
+    checkpoints[namespace] = progress
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoints, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+
+    # a crash mid-write leaves the previous checkpoint in place
+    os.replace(tmp_path, path)
+
+def needsBackfill(docsnap: firestore.DocumentSnapshot) -> bool:
+    try:
+        return docsnap.get("schema") < mr.SCHEMA_VERSION
+    except KeyError:
+        return True
+
+
+def backfillPage(docsnaps: list[firestore.DocumentSnapshot], profiles: dict[str, dict | None], dry_run: bool) -> tuple[int, int]:
+    """Brings every document in docsnaps that needs it up to date, returns (migrated, missing a profile).
+
+    profiles holds the people and channels read so far by path, they are few so every one is only read once. Only
+    documents without snapshots need them.
+    """
+    to_migrate = [docsnap for docsnap in docsnaps if needsBackfill(docsnap)]
+    unread = dict[str, firestore.DocumentReference]()
+
+    for docsnap in to_migrate:
+        if mr.hasInlineProfiles(docsnap):
+            continue
+
+        for ref in (docsnap.get("sender"), docsnap.get("channel")):
+            if ref.path not in profiles:
+                unread[ref.path] = ref
+
+    for path, snap in mr.resolveRefs(list(unread.values())).items():
+        profiles[path] = snap.to_dict() if snap.exists else None
+
+    batch = mr.getDb().batch()
+    migrated = 0
+    missing = 0
+
+    for docsnap in to_migrate:
+        # only the new fields, a message written meanwhile by the bot keeps everything else it has
+        update = dict()
+
+        update["schema"] = mr.SCHEMA_VERSION
+        update["month_day"], update["year"] = mr.monthDay(docsnap.get("ts"))
+
+        if not mr.hasInlineProfiles(docsnap):
+            sender = profiles.get(docsnap.get("sender").path)
+            channel = profiles.get(docsnap.get("channel").path)
+
+            if sender is None or channel is None:
+                log.warning(f"message {docsnap.id} points at a sender or channel that doesn't exist, leaving it as it is")
+                missing += 1
+                continue
+
+            update["sender_snapshot"] = mr.personFromDict(sender).toDict()
+            update["channel_snapshot"] = mr.channelFromDict(channel).toDict()
+
+        batch.set(docsnap.reference, update, merge=True)
+        migrated += 1
+
+    if migrated > 0 and not dry_run:
+        with metrics.firestoreCall("commit"):
+            batch.commit()
+        metrics.firestore_writes.inc("commit", amount=migrated)
+
+    return migrated, missing
+
+def backfill(namespace: str = mr.DEFAULT_NAMESPACE, page_size: int = PAGE_SIZE, checkpoint_path: str = CHECKPOINT_FILE, dry_run: bool = False) -> dict:
+    """Backfills every message in namespace, resuming from the checkpoint. Returns the totals."""
+    messages = mr.collection("messages", namespace)
+    progress = {"schema": mr.SCHEMA_VERSION, "last_message_id": None, "read": 0, "migrated": 0, "missing": 0}
+
+    if not dry_run:
+        checkpoint = readCheckpoint(checkpoint_path, namespace)
+
+        # a checkpoint from a backfill to an older schema says nothing about this one
+        if checkpoint.get("schema") == mr.SCHEMA_VERSION:
+            progress.update(checkpoint)
+
+    cursor = None
+    if progress["last_message_id"] is not None:
+        print(f"resuming after message {progress['last_message_id']}, {progress['read']} messages already read")
+        cursor = mr.getDocument(messages.document(progress["last_message_id"]))
+
+    profiles = dict[str, dict | None]()
+    start = time.perf_counter()
+    read = 0
+
+    while True:
+        query = messages.limit(page_size) if cursor is None else messages.start_after(cursor).limit(page_size)
+
+        with metrics.firestoreCall("query"):
+            page = list(query.get())
+        metrics.firestore_reads.inc("query", amount=len(page))
+
+        if len(page) == 0:
+            break
+
+        migrated, missing = backfillPage(page, profiles, dry_run)
+        cursor = page[-1]
+        read += len(page)
+
+        progress["last_message_id"] = cursor.id
+        progress["read"] += len(page)
+        progress["migrated"] += migrated
+        progress["missing"] += missing
+
+        if not dry_run:
+            writeCheckpoint(checkpoint_path, namespace, progress)
+
+        print(f"read {progress['read']} messages, {'would migrate' if dry_run else 'migrated'} {progress['migrated']}, {progress['missing']} missing a profile, {read / (time.perf_counter() - start):.0f} messages/s")
+
+        if len(page) < page_size:
+            break
+
+    return progress
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Brings message documents written before the current schema up to date")
+    parser.add_argument("--namespace", default=mr.DEFAULT_NAMESPACE, help="server whose messages to backfill")
+    parser.add_argument("--page", type=int, default=PAGE_SIZE, help="messages read and written per batch")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="file that records how far the backfill got")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the first message")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be migrated")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+
+    if args.restart and not args.dry_run:
+        writeCheckpoint(args.checkpoint, args.namespace, dict())
+
+    totals = backfill(args.namespace, min(args.page, 500), args.checkpoint, args.dry_run)
+    print(f"done, {totals['migrated']} of {totals['read']} messages {'would be ' if args.dry_run else ''}migrated, {totals['missing']} missing a profile")
\ No newline at end of file
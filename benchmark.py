@@ -0,0 +1,239 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timezone
+import numpy as np
+from generate_archive import generateArchive
+
+# cpu benchmarks against a generated archive. results go to a json file so two commits can be compared with
+# --compare, nothing here talks to discord or firestore
+
+def timeCalls(fn, calls: int) -> dict[str, float]:
+    """Calls fn calls times, returns the latency distribution in microseconds."""
+    samples = np.empty(calls, dtype=np.float64)
+
+    for i in range(calls):
+        start = time.perf_counter_ns()
+        fn()
+        samples[i] = time.perf_counter_ns() - start
+
+    samples /= 1000
+
+    out = dict()
+
+    out["calls"] = calls
+    out["mean_us"] = float(samples.mean())
+    out["p50_us"] = float(np.percentile(samples, 50))
+    out["p90_us"] = float(np.percentile(samples, 90))
+    out["p99_us"] = float(np.percentile(samples, 99))
+    out["max_us"] = float(samples.max())
+
+    return out
+
+def benchParse(root: str, workers: int) -> dict[str, float]:
+    """Loads the archive in root/messages2 in a fresh interpreter, so peak memory is only the parse's own."""
+    env = dict(os.environ, MESSAGE_READER_WORKERS=str(workers))
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--parse-only"], cwd=root, env=env, capture_output=True, text=True, check=True).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+def parseOnly() -> None:
+    # imported first so the timed import below is only the archive load
+    import numpy, scoring, sampling, archive_parser
+
+    start = time.perf_counter()
+    import message_reader
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on linux. the workers' peak is reported separately, they run at the same time
+    out = dict()
+
+    out["workers"] = int(os.environ["MESSAGE_READER_WORKERS"])
+    out["seconds"] = elapsed
+    out["messages"] = len(message_reader.messages)
+    out["messages_per_s"] = len(message_reader.messages) / elapsed
+    out["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    out["worker_peak_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    print(json.dumps(out))
+
+def benchMemory(root: str) -> dict[str, float]:
+    """Memory held by the loaded archive (messages, people, channels and the day map), in a fresh interpreter."""
+    env = dict(os.environ, MESSAGE_READER_WORKERS="1")
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--memory-only"], cwd=root, env=env, capture_output=True, text=True, check=True).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+def memoryOnly() -> None:
+    import numpy, scoring, sampling, archive_parser
+
+    # only what the load allocates and keeps is counted, the parse's temporary objects are freed by the end
+    gc.collect()
+    tracemalloc.start()
+    import message_reader
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    count = len(message_reader.messages)
+    out = dict()
+
+    out["messages"] = count
+    out["retained_mb"] = retained / 1e6
+    out["peak_mb"] = peak / 1e6
+    out["bytes_per_message"] = retained / count if count > 0 else 0.0
+
+    print(json.dumps(out))
+
+def benchScoring(messages: list) -> dict[str, float]:
+    import scoring
+
+    engine = scoring.getEngine()
+    out = dict()
+
+    start = time.perf_counter()
+    for message in messages:
+        scoring.calcWeight(message)
+    out["calc_weight_per_s"] = len(messages) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    engine.scoreBatch(messages)
+    out["score_batch_per_s"] = len(messages) / (time.perf_counter() - start)
+
+    out["messages"] = len(messages)
+    return out
+
+def benchToday(today: date, calls: int) -> dict[str, float]:
+    import message_reader
+
+    message_reader.todays_tables.clear()
+
+    # the first call of the day builds the alias table, every call after that is a single draw
+    start = time.perf_counter()
+    message_reader.todays_tables[today] = message_reader.buildTodaysTable(today)
+    build = time.perf_counter() - start
+
+    rng = np.random.default_rng(0)
+
+    out = timeCalls(lambda: message_reader.getMessageFromToday(rng), calls)
+    out["build_ms"] = build * 1000
+    out["candidates"] = len(message_reader.todays_tables[today][0])
+
+    return out
+
+def benchEmbed(messages: list, calls: int) -> dict[str, float]:
+    # the bot module builds its client and backend on import, neither connects to anything until started
+    import bot
+
+    picks = [messages[i % len(messages)] for i in range(calls)]
+    iterator = iter(picks)
+
+    out = timeCalls(lambda: bot.makeEmbed(next(iterator)), calls)
+    return out
+
+def gitCommit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path, "r") as old_file:
+        old = json.load(old_file)
+    with open(new_path, "r") as new_file:
+        new = json.load(new_file)
+
+    print(f"{old['commit']} -> {new['commit']}")
+
+    for bench, results in new["results"].items():
+        for key, value in results.items():
+            before = old["results"].get(bench, dict()).get(key)
+            if isinstance(value, (int, float)) and isinstance(before, (int, float)) and before != 0:
+                print(f"  {bench}.{key}: {before:.4g} -> {value:.4g} ({(value / before - 1) * 100:+.1f}%)")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Runs the cpu benchmarks against a generated archive")
+    parser.add_argument("--per-day", type=float, default=200, help="average messages per day in the generated archive")
+    parser.add_argument("--channels", type=int, default=12)
+    parser.add_argument("--people", type=int, default=40)
+    parser.add_argument("--years", type=int, default=5, help="years of messages, ending last year")
+    parser.add_argument("--calls", type=int, default=20000, help="calls per latency benchmark")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parse workers for the parallel parse run")
+    parser.add_argument("--output", default=None, help="where to write the results, bench_<commit>.json by default")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="print the change between two result files and exit")
+    parser.add_argument("--parse-only", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--memory-only", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.parse_only:
+        parseOnly()
+        return
+
+    if args.memory_only:
+        memoryOnly()
+        return
+
+    if args.compare is not None:
+        compare(*args.compare)
+        return
+
+    today = date.today()
+    cwd = os.getcwd()
+    output = os.path.abspath(args.output) if args.output is not None else None
+    params = {"per_day": args.per_day, "channels": args.channels, "people": args.people, "years": args.years, "calls": args.calls}
+    results = dict()
+
+    with tempfile.TemporaryDirectory() as root:
+        print("generating archive")
+        generated = generateArchive(os.path.join(root, "messages2"), args.channels, args.people, args.per_day, date(today.year - args.years, 1, 1), date(today.year - 1, 12, 31))
+        params["messages"] = generated
+
+        for workers in sorted({1, args.workers}):
+            print(f"parse, {workers} workers")
+            results[f"parse_{workers}_workers"] = benchParse(root, workers)
+
+        print("memory")
+        results["memory"] = benchMemory(root)
+
+        # everything else runs on the archive loaded into this process
+        os.chdir(root)
+        os.environ["MESSAGE_READER_WORKERS"] = str(args.workers)
+        import message_reader
+
+        messages = list(message_reader.messages.values())
+
+        print("scoring")
+        results["scoring"] = benchScoring(messages)
+        print("getMessageFromToday")
+        results["message_from_today"] = benchToday(today, args.calls)
+        print("makeEmbed")
+        results["make_embed"] = benchEmbed(messages, args.calls)
+
+        os.chdir(cwd)
+
+    report = {
+        "commit": gitCommit(),
+        "time": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": params,
+        "results": results,
+    }
+
+    output = output or f"bench_{report['commit']}.json"
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"wrote {output}")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,128 +1,262 @@
 import os
+import asyncio
+import signal
+import time
+import zlib
+from functools import partial
+from dotenv import load_dotenv
+
+# the modules below read their settings from the environment when they are imported, so .env goes in first
+load_dotenv()
+
 import discord
-from discord.ext import tasks
 import message_reader_fs as mr
+import storage_backend
+import search_index
+from scheduler import Scheduler, Job
+import metrics
 import datetime as dt
 from pytz import timezone
-from dotenv import load_dotenv
-import google.cloud.logging as gcloud_logging
-import google.auth as auth
 import logging as log
 
 ## if you are getting an SSL error, check this thread https://github.com/Rapptz/discord.py/issues/4159#issuecomment-700615568
 
-load_dotenv()
-
 TOKEN = str(os.getenv('DISCORD_TOKEN'))
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-client = discord.Client(intents=intents)
+# shards are picked and connected by discord.py, one per ~1000 servers
+client = discord.AutoShardedClient(intents=intents)
 
 EDT = timezone('America/New_York')
 
-creds, project_id = auth.load_credentials_from_file("service-account-auth.json")
-gcp_client = gcloud_logging.Client(project=project_id, credentials=creds)
-gcp_client.setup_logging()
+MOTD_HOUR = 9
+REFRESH_HOUR = 2
+# the refreshes of all servers are spread over this many minutes after 2am so they don't hit storage at once, at
+# most until an hour before the message of the day so every refresh is done by then
+MAX_REFRESH_SPREAD_MINUTES = (MOTD_HOUR - REFRESH_HOUR - 1) * 60
+REFRESH_SPREAD_MINUTES = min(int(os.getenv("REFRESH_SPREAD_MINUTES", "120")), MAX_REFRESH_SPREAD_MINUTES)
+# the next day is prefetched in the two hours before midnight
+PREFETCH_HOUR = 22
+
+class Server:
+    """What the bot keeps for one server it is in."""
+
+    def __init__(self, guild: discord.Guild, memory_channel):
+        self.guild = guild
+        self.namespace = mr.namespaceFor(guild.id)
+        # None if the server has no memories channel, its messages are still stored
+        self.memory_channel = memory_channel
+        # the message of the day, picked and rendered by the refresh so 9am only has to send it
+        self.staged_motd: tuple[dt.date, discord.Embed] | None = None
+
+# by guild id
+servers = dict[int, Server]()
+# where messages are stored and read from, picked with STORAGE_BACKEND
+backend = storage_backend.getBackend()
+scheduler = Scheduler()
+# $search, loaded from SEARCH_INDEX_PATH and kept up to date with every message stored (see indexStored)
+search = search_index.openIndex()
+# embeds sent for one $search, discord allows at most 10 on a message
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "3"))
+# the namespaces whose messages are indexed for $search, the index is in memory so it isn't open to every server
+SEARCH_NAMESPACES = frozenset(namespace.strip() for namespace in os.getenv("SEARCH_NAMESPACES", mr.DEFAULT_NAMESPACE).split(",") if namespace.strip() != "")
+# $stats reports on the whole bot, so only server admins and this user (STATS_OWNER_ID) can run it
+STATS_OWNER_ID = os.getenv("STATS_OWNER_ID", "")
+started_at = time.time()
+
+handler_seconds = metrics.Histogram("handler_seconds", "Time spent handling a message, by command (store for messages that get saved)", ("command",))
+metrics.Gauge("storage_backend_stat", "Stats reported by the storage backend", lambda: {(key,): value for key, value in backend.stats().items()}, ("stat",))
+metrics.Gauge("job_last_duration_seconds", "How long each scheduled job took the last time it ran", lambda: {(name,): job.last_duration for name, job in scheduler.jobs.items()}, ("job",))
+metrics.Gauge("job_runs_total", "Scheduled job runs", lambda: {(name, "ok"): job.runs for name, job in scheduler.jobs.items()} | {(name, "failed"): job.failures for name, job in scheduler.jobs.items()}, ("job", "result"), kind="counter")
+metrics.Gauge("uptime_seconds", "Seconds since the bot started", lambda: time.time() - started_at)
+metrics.Gauge("servers", "Servers the bot is in", lambda: len(servers))
+metrics.Gauge("search_index_messages", "Messages in the search index", lambda: len(search))
+
+def addServer(guild: discord.Guild) -> Server:
+    memory_channel = None
+
+    for channel in guild.channels:
+        if "memories" in channel.name:
+            memory_channel = channel
 
-pizzeria = None
-memoryChannel = None
+    server = Server(guild, memory_channel)
+    servers[guild.id] = server
+
+    if memory_channel is None:
+        log.warning(f"{guild.name} ({guild.id}) has no memories channel, only storing its messages")
+    else:
+        # each server refreshes at its own fixed minute within the spread
+        offset = zlib.crc32(str(guild.id).encode()) % max(REFRESH_SPREAD_MINUTES, 1)
+        scheduler.add(Job(f"refresh-{guild.id}", REFRESH_HOUR + offset // 60, offset % 60, EDT, partial(refreshToday, server), grace=dt.timedelta(hours=6)))
+        # and loads the next day's messages in the two hours before midnight, so the refresh finds them ready
+        prefetch_offset = offset % 120
+        scheduler.add(Job(f"prefetch-{guild.id}", PREFETCH_HOUR + prefetch_offset // 60, prefetch_offset % 60, EDT, partial(prefetchTomorrow, server)))
+
+    return server
+
+def removeServer(guild: discord.Guild) -> None:
+    servers.pop(guild.id, None)
+    scheduler.remove(f"refresh-{guild.id}")
+    scheduler.remove(f"prefetch-{guild.id}")
 
 @client.event
 async def on_ready():
-    global pizzeria
-    global memoryChannel
+    # on_ready comes again after a reconnect, the servers are looked up again in case channels changed
+    for guild in client.guilds:
+        addServer(guild)
 
-    pizzeria = client.guilds[0]
+    if not scheduler.isRunning():
+        scheduler.start()
 
-    for channel in pizzeria.channels:
-        if "memories" in channel.name:
-            memoryChannel = channel
+    # the day caches load in the background, commands that need one wait for this instead of loading it again
+    backend.startWarmUp([server.namespace for server in servers.values() if server.memory_channel is not None])
 
-    assert memoryChannel != None
+    log.info(f'We have logged in as {client.user} in {len(servers)} servers over {client.shard_count} shards')
 
-    background_task.start()
+@client.event
+async def on_guild_join(guild):
+    log.info(f"joined {guild.name} ({guild.id})")
+    addServer(guild)
 
-    log.info(f'We have logged in as {client.user}')
+@client.event
+async def on_guild_remove(guild):
+    log.info(f"left {guild.name} ({guild.id})")
+    removeServer(guild)
 
 @client.event
 async def on_message(message):
     if message.author == client.user:
         return
 
-    if message.channel != memoryChannel:
-        username = message.author.global_name
-        discord_sender_id = str(message.author.id)
-        nickname = message.author.display_name
-        color = str(message.author.color)
-        avatar = str(message.author.display_avatar)
-        sender = mr.Person(username, discord_sender_id, nickname, color, avatar)
+    # direct messages to the bot aren't part of any server's memories
+    if message.guild is None:
+        return
+
+    server = servers.get(message.guild.id)
+    if server is None:
+        server = addServer(message.guild)
 
-        server_name = message.channel.guild.name
-        channel_name = message.channel.name
-        icon = str(message.channel.guild.icon)
-        channel_id = str(message.channel.id)
-        server_id = str(message.channel.guild.id)
-        channel = mr.Channel(server_name, channel_name, icon, int(channel_id), int(server_id))
+    if message.channel != server.memory_channel:
+        with handler_seconds.time("store"):
+            username = message.author.global_name
+            discord_sender_id = str(message.author.id)
+            nickname = message.author.display_name
+            color = str(message.author.color)
+            avatar = str(message.author.display_avatar)
+            sender = mr.Person(username, discord_sender_id, nickname, color, avatar)
 
-        content = message.content
-        ts = message.created_at
-        discord_message_id = str(message.id)
-        attachments = list()
+            server_name = message.channel.guild.name
+            channel_name = message.channel.name
+            icon = str(message.channel.guild.icon)
+            channel_id = str(message.channel.id)
+            server_id = str(message.channel.guild.id)
+            channel = mr.Channel(server_name, channel_name, icon, int(channel_id), int(server_id))
 
-        for attachment in message.attachments:
-            attachment_name = attachment.filename
-            attachment_url = attachment.url
+            content = message.content
+            ts = message.created_at
+            discord_message_id = str(message.id)
+            attachments = list()
 
-            attachments.append(mr.Attachment(attachment_url, attachment_name))
+            for attachment in message.attachments:
+                attachment_name = attachment.filename
+                attachment_url = attachment.url
 
-        message = mr.Message(sender, channel, content, ts, discord_message_id, attachments)
+                attachments.append(mr.Attachment(attachment_url, attachment_name))
 
-        mr.putMessage(message)
+            message = mr.Message(sender, channel, content, ts, discord_message_id, attachments)
+
+            await backend.putMessage(message)
     else:
         if message.content.startswith('$bot-check'):
-            log.info("bot check command received")
-            await message.channel.send('The bot is alive!!!')
-        
+            with handler_seconds.time("bot-check"):
+                log.info("bot check command received")
+                await message.channel.send('The bot is alive!!!')
+
         if message.content.startswith('$memory'):
-            log.info("memory command received")
-            await sendMemory(memoryChannel)
+            with handler_seconds.time("memory"):
+                log.info("memory command received")
+                await sendMemory(server)
 
         if message.content.startswith("$date"):
-            log.info("date command received")
-            await message.channel.send(f"Right now it is {(dt.datetime.now(EDT)).strftime('%Y-%m-%d %H:%M:%S %Z')}")
+            with handler_seconds.time("date"):
+                log.info("date command received")
+                await message.channel.send(f"Right now it is {(dt.datetime.now(EDT)).strftime('%Y-%m-%d %H:%M:%S %Z')}")
 
         if message.content.startswith("$message"):
-            words = message.content.split()
-            if len(words) >= 2:
-                key = words[1]
-                to_send = mr.getMessage(key)
-                if to_send is not None:
-                    log.info(f"message command received with key {key}")
-                    embed = makeEmbed(to_send)
-                    await message.channel.send(embed=embed)
+            with handler_seconds.time("message"):
+                words = message.content.split()
+                if len(words) >= 2:
+                    key = words[1]
+                    try:
+                        to_send = await backend.lookupMessage(key, server.namespace)
+                    except Exception as e:
+                        log.error(f"message command with key {key} failed: {e}")
+                        await message.channel.send(f"Couldn't look up message {key} right now, try again in a bit")
+                        return
+                    finally:
+                        log.debug(f"message cache: {backend.message_cache.stats()}")
+
+                    if to_send is not None:
+                        log.info(f"message command received with key {key}")
+                        embed = makeEmbed(to_send)
+                        await message.channel.send(embed=embed)
+                    else:
+                        log.info(f"message command received with invalid key {key}")
+                        await message.channel.send(f"Unable to find message with id {key}")
                 else:
-                    log.info(f"message command received with invalid key {key}")
-                    await message.channel.send(f"Unable to find message with id {key}")
-            else:
-                log.info("message command received with no key")
-                await message.channel.send("Usage: $message <key>")
-
-@tasks.loop(minutes=1)
-async def background_task():
-    global memoryChannel
-
-    now = dt.datetime.now(EDT)
-    if now.minute == 0 and now.hour == 9:
-        log.info("sending message of the day")
-        await sendMemory(memoryChannel, "Message of the day @everyone")
-    
-    if now.minute == 0 and now.hour == 2:
-        log.info("updating today's messages")
-        mr.updateTodaysMessages()
+                    log.info("message command received with no key")
+                    await message.channel.send("Usage: $message <key>")
+
+        if message.content.startswith("$search"):
+            with handler_seconds.time("search"):
+                await sendSearchResults(message.channel, server, message.content[len("$search"):])
+
+        if message.content.startswith("$stats"):
+            with handler_seconds.time("stats"):
+                if canSeeStats(message.author):
+                    log.info("stats command received")
+                    await message.channel.send("```\n" + statsSummary(server.namespace) + "\n```")
+                else:
+                    log.info(f"stats command from {message.author.id} refused, not an admin")
+                    await message.channel.send("Only server admins can use $stats")
+
+async def sendMessageOfTheDay() -> None:
+    log.info(f"sending message of the day to {len(servers)} servers")
+
+    to_send = [server for server in servers.values() if server.memory_channel is not None]
+    results = await asyncio.gather(*[sendServerMessageOfTheDay(server) for server in to_send], return_exceptions=True)
+
+    # one server failing doesn't keep the others from getting theirs
+    for server, result in zip(to_send, results):
+        if isinstance(result, Exception):
+            log.error(f"sending the message of the day to {server.guild.name} ({server.guild.id}) failed: {result}")
+
+async def sendServerMessageOfTheDay(server: Server) -> None:
+    staged_motd = server.staged_motd
+    server.staged_motd = None
+
+    if staged_motd is not None and staged_motd[0] == mr.getTodaysDate():
+        await server.memory_channel.send("Message of the day @everyone", embed=staged_motd[1])
+    else:
+        # nothing was staged for today (the refresh failed or hasn't run yet), pick one now
+        await sendMemory(server, "Message of the day @everyone")
+
+async def refreshToday(server: Server) -> None:
+    log.info(f"updating today's messages for {server.namespace}")
+    await backend.updateTodaysMessages(server.namespace)
+
+    server.staged_motd = (mr.getTodaysDate(), makeEmbed(await backend.getMessageFromToday(server.namespace)))
+    log.info(f"staged the message of the day for {server.namespace}")
+
+async def prefetchTomorrow(server: Server) -> None:
+    # the day after the evening the run was scheduled on, so a run caught up after midnight still loads that day
+    # rather than the one after it
+    evening = (dt.datetime.now(EDT) - dt.timedelta(hours=PREFETCH_HOUR)).date()
+    await backend.prefetchDay(evening + dt.timedelta(days=1), server.namespace)
 
-    log.debug(f"Background task ran at {now}")
+scheduler.add(Job("motd", MOTD_HOUR, 0, EDT, sendMessageOfTheDay, grace=dt.timedelta(minutes=30)))
 
 def makeFooter(message: mr.Message) -> str:
     if message.isDM():
@@ -130,15 +264,17 @@ def makeFooter(message: mr.Message) -> str:
     
     return "Messaged in #" + message.channel.channel_name + " in " + message.channel.server_name
 
-def makeEmbed(message: mr.Message) -> discord.Embed:
+def makeEmbed(message: mr.Message, title: str | None = None) -> discord.Embed:
     author_name = message.sender.nickname + " (" + message.sender.username + ")"
     url = message.getMessageLink()
     author_icon_url = message.sender.avatar
     
-    num_years = dt.date.today().year - message.ts.year
-    plural = '' if num_years == 1 else 's'
+    if title is None:
+        num_years = dt.date.today().year - message.ts.year
+        plural = '' if num_years == 1 else 's'
+
+        title = "On this day " + str(num_years) + " year" + plural + " ago, *" + message.sender.nickname + "* said"
 
-    title = "On this day " + str(num_years) + " year" + plural + " ago, *" + message.sender.nickname + "* said"
     description = message.content
     color = message.sender.color
 
@@ -156,8 +292,150 @@ def makeEmbed(message: mr.Message) -> discord.Embed:
 
     return msg
 
-async def sendMemory(channel, text = "") -> None: 
-    msg = mr.getMessageFromToday()
-    await channel.send(text, embed=makeEmbed(msg))
+def formatDuration(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    if seconds < 120:
+        return f"{seconds:.1f}s"
+    if seconds < 7200:
+        return f"{seconds / 60:.0f}m"
+
+    return f"{seconds / 3600:.1f}h"
+
+def canSeeStats(author) -> bool:
+    if STATS_OWNER_ID != "" and str(author.id) == STATS_OWNER_ID:
+        return True
+
+    # a member's permissions in the server the message was sent in
+    permissions = getattr(author, "guild_permissions", None)
+    return permissions is not None and permissions.administrator
+
+def statsSummary(namespace: str = mr.DEFAULT_NAMESPACE) -> str:
+    """A short plain text version of the metrics for $stats, with the day cache of namespace."""
+    lines = [f"up {formatDuration(time.time() - started_at)} in {len(servers)} servers"]
+
+    rpcs = metrics.firestore_seconds.summary()
+    if len(rpcs) > 0:
+        lines.append(f"firestore: {metrics.firestore_reads.total():.0f} documents read, {metrics.firestore_writes.total():.0f} written, {metrics.firestore_errors.total():.0f} errors")
+        for (op,), (count, mean, p99) in sorted(rpcs.items()):
+            lines.append(f"  {op}: {count} rpcs, mean {formatDuration(mean)}, p99 <= {formatDuration(p99)}")
+
+    # only looked at, $stats in a server that isn't loaded shouldn't load or make room for it
+    day_cache = mr.findDayCache(namespace)
+    snapshot = day_cache.current if day_cache is not None else mr.EMPTY_DAY
+    staged = day_cache.staged if day_cache is not None else None
+    if snapshot.loaded_at > 0:
+        lines.append(f"day cache: {len(snapshot.candidates)} messages for {snapshot.day}, loaded {formatDuration(time.time() - snapshot.loaded_at)} ago, {len(mr.dayCaches())} servers loaded")
+    else:
+        lines.append("day cache: not loaded yet")
+    if staged is not None:
+        lines.append(f"  {len(staged.candidates)} messages for {staged.day} prefetched")
+
+    lines.append(f"search index: {len(search)} messages, {search.unsaved()} not saved yet")
+
+    cache = mr.cacheStats()
+    lines.append(f"profile cache: people {cache['person_hits']} hits/{cache['person_misses']} misses, channels {cache['channel_hits']} hits/{cache['channel_misses']} misses")
+
+    stats = backend.stats()
+    lines.append(f"message cache: {stats['message_cache_hit_rate'] * 100:.0f}% hit rate over {stats['message_cache_lookups']} lookups, {stats['message_cache_misses']} not found, {stats['message_cache_errors']} errors")
+
+    if "writer_queue_depth" in stats:
+        lines.append(f"write queue: {stats['writer_queue_depth']} queued, {stats['writer_committed']} committed, {stats['writer_requeued']} put back, {stats['writer_spilled']} saved to disk")
+
+    for (command,), (count, mean, p99) in sorted(handler_seconds.summary().items()):
+        lines.append(f"${command}: {count} handled, mean {formatDuration(mean)}, p99 <= {formatDuration(p99)}" if command != "store" else f"stored {count} messages, mean {formatDuration(mean)}")
+
+    # every server has its own refresh job, only the ones for namespace are shown
+    refreshes = {f"refresh-{guild_id}" for guild_id, server in servers.items() if server.namespace == namespace}
+
+    for name, job in scheduler.jobs.items():
+        if name.startswith("refresh-") and name not in refreshes:
+            continue
+
+        if job.last_run is not None:
+            lines.append(f"job {name}: last ran {job.last_run:%Y-%m-%d %H:%M} in {formatDuration(job.last_duration)}, {job.failures} failures")
+
+    return "\n".join(lines)
+
+async def sendMemory(server: Server, text = "") -> None:
+    msg = await backend.getMessageFromToday(server.namespace)
+    await server.memory_channel.send(text, embed=makeEmbed(msg))
+
+async def sendSearchResults(channel, server: Server, text: str) -> None:
+    if server.namespace not in SEARCH_NAMESPACES:
+        log.info(f"search command received in {server.namespace}, which isn't indexed")
+        await channel.send("Search isn't enabled on this server")
+        return
+
+    query = search_index.Query(text)
 
-client.run(TOKEN)
\ No newline at end of file
+    if query.isEmpty():
+        log.info("search command received with no terms")
+        await channel.send('Usage: $search <words> ["a phrase"] [from:<name>] [in:<channel>] [year:<year>]')
+        return
+
+    ids, total = search.search(query, server.namespace, SEARCH_RESULTS)
+    log.info(f"search command received, {total} matches for {text.strip()}")
+
+    if len(ids) == 0:
+        await channel.send("No messages match that search")
+        return
+
+    try:
+        found = await asyncio.gather(*[backend.lookupMessage(id, server.namespace) for id in ids])
+    except Exception as e:
+        log.error(f"looking up search results failed: {e}")
+        await channel.send("Couldn't look up the search results right now, try again in a bit")
+        return
+
+    embeds = [makeEmbed(result, f"*{result.sender.nickname}* said on {result.ts.astimezone(EDT):%B %d, %Y}") for result in found if result is not None]
+    more = f", showing the top {len(embeds)}" if total > len(embeds) else ""
+
+    await channel.send(f"{total} message{'' if total == 1 else 's'} found{more}", embeds=embeds)
+
+def indexStored(messages: list[mr.Message]) -> None:
+    # only once they are written, so $search never turns up a message $message can't find
+    for message in messages:
+        if message.namespace() in SEARCH_NAMESPACES:
+            search.add(message)
+
+backend.onStored(indexStored)
+
+async def saveSearchIndex() -> None:
+    if search.unsaved() > 0:
+        await asyncio.to_thread(search.save)
+        log.info(f"saved the search index with {len(search)} messages")
+
+scheduler.add(Job("search-index", 3, 30, EDT, saveSearchIndex, grace=dt.timedelta(hours=12)))
+
+async def main():
+    if os.path.exists("service-account-auth.json"):
+        mr.setupLogging()
+    else:
+        # running without firestore, e.g. on the sqlite backend
+        log.basicConfig(level=log.INFO)
+
+    # without it the server whose data is under servers/pizzeria would start over under its guild id
+    if len(mr.GUILD_NAMESPACES) == 0:
+        log.error(f"GUILD_NAMESPACES is not set, add GUILD_NAMESPACES=<guild id>={mr.DEFAULT_NAMESPACE} to .env with the id of the server whose data is under servers/{mr.DEFAULT_NAMESPACE}")
+        raise SystemExit(1)
+
+    # METRICS_PORT=0 turns the endpoint off
+    metrics_runner = await metrics.serve() if metrics.METRICS_PORT > 0 else None
+
+    # docker stop sends SIGTERM, closing the client lets the finally below flush the write queue
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(client.close()))
+
+    async with client:
+        await backend.start()
+        try:
+            await client.start(TOKEN)
+        finally:
+            await scheduler.stop()
+            await backend.stop()
+            await saveSearchIndex()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,94 @@
+import json
+import os
+from datetime import date, datetime
+import logging as log
+import message_reader_fs as mr
+
+# one folder per namespace, with one file per year and month-day holding that day's messages along with their
+# senders and channels so nothing has to be resolved again. a bucket for a year before the latest one never changes
+# once written.
+CACHE_DIR = os.getenv("DAY_CACHE_DIR", "day_cache")
+
+# bumped whenever the file layout changes, older files are ignored and fetched again
+VERSION = 1
+
+def bucketPath(year: int, today: date, namespace: str = mr.DEFAULT_NAMESPACE) -> str:
+    return os.path.join(CACHE_DIR, namespace, f"{year}-{today.month:02d}{today.day:02d}.json")
+
+def readBucket(year: int, today: date, namespace: str = mr.DEFAULT_NAMESPACE) -> list[mr.Message] | None:
+    """The cached messages for today's month and day in year, None if there is no usable cache file."""
+    path = bucketPath(year, today, namespace)
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="utf-8") as bucket_file:
+            bucket = json.load(bucket_file)
+
+        if bucket["version"] != VERSION:
+            return None
+
+        return loadBucket(bucket)
+    except (OSError, ValueError, KeyError) as e:
+        log.warning(f"ignoring unreadable day cache {path}: {e}")
+        return None
+
+def readBuckets(years: list[int], today: date, namespace: str = mr.DEFAULT_NAMESPACE) -> dict[int, list[mr.Message] | None]:
+    return {year: readBucket(year, today, namespace) for year in years}
+
+def writeBucket(year: int, today: date, messages: list[mr.Message], namespace: str = mr.DEFAULT_NAMESPACE) -> None:
+    path = bucketPath(year, today, namespace)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w", encoding="utf-8") as bucket_file:
+        json.dump(dumpBucket(messages), bucket_file, ensure_ascii=False)
+
+    # a crash mid-write leaves the previous bucket in place
+    os.replace(tmp_path, path)
+
+def dumpBucket(messages: list[mr.Message]) -> dict:
+    people = dict[str, dict]()
+    channels = dict[str, dict]()
+    out = []
+
+    for message in messages:
+        people[message.sender.discord_id] = message.sender.toDict()
+        channels[message.channel.channel_id] = message.channel.toDict()
+
+        attachments = [[attachment.url, attachment.name] for attachment in message.attachments]
+        out.append([message.discord_id, message.sender.discord_id, message.channel.channel_id, message.content, message.ts.isoformat(), attachments])
+
+    return {"version": VERSION, "people": people, "channels": channels, "messages": out}
+
+def loadBucket(bucket: dict) -> list[mr.Message]:
+    people = dict[str, mr.Person]()
+    channels = dict[str, mr.Channel]()
+
+    for discord_id, person in bucket["people"].items():
+        people[discord_id] = mr.Person(person["username"], person["discord_id"], person["nickname"], person["color"], person["avatar"])
+
+    for channel_id, channel in bucket["channels"].items():
+        channels[channel_id] = mr.Channel(channel["server_name"], channel["channel_name"], channel["icon"], int(channel["channel_id"]), int(channel["server_id"]))
+
+    out = []
+
+    for discord_id, sender_id, channel_id, content, ts, attachments in bucket["messages"]:
+        out.append(mr.Message(people[sender_id], channels[channel_id], content, datetime.fromisoformat(ts), discord_id, [mr.Attachment(url, name) for url, name in attachments]))
+
+    return out
+
+def lastTs(messages: list[mr.Message]) -> datetime | None:
+    if len(messages) == 0:
+        return None
+
+    return max(message.ts for message in messages)
+
+def mergeBucket(cached: list[mr.Message], fetched: list[mr.Message]) -> list[mr.Message]:
+    merged = {message.discord_id: message for message in cached}
+
+    for message in fetched:
+        merged[message.discord_id] = message
+
+    return sorted(merged.values(), key=lambda message: message.ts)
\ No newline at end of file
@@ -0,0 +1,203 @@
+import threading
+import time
+from collections import Counter
+import numpy as np
+from google.api_core.exceptions import ServiceUnavailable
+from google.cloud import firestore
+
+# an in-memory stand-in for the parts of firestore.Client that message_reader_fs uses, so the write path can be
+# run offline. every rpc can be given a latency and a chance of failing, and is counted by kind.
+#
+#   import message_reader_fs as mr
+#   mr.db = FakeFirestore(latency=0.02, failure_rate=0.01)
+
+class FakeFirestore:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+        self.docs = dict[str, dict]()
+        # when each document was last written, by path
+        self.written_at = dict[str, float]()
+        self.rpcs = Counter[str]()
+        self.failures = Counter[str]()
+
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+
+    def rpc(self, kind: str) -> None:
+        """Counts one rpc, waits out its latency and fails it if the dice say so."""
+        with self.lock:
+            self.rpcs[kind] += 1
+            delay = self.latency + (self.rng.exponential(self.jitter) if self.jitter > 0 else 0.0)
+            failed = self.rng.random() < self.failure_rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if failed:
+            with self.lock:
+                self.failures[kind] += 1
+            raise ServiceUnavailable(f"injected {kind} failure")
+
+    def collection(self, *path: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self, "/".join(path))
+
+    def document(self, *path: str) -> "FakeDocumentReference":
+        return FakeDocumentReference(self, "/".join(path))
+
+    def batch(self) -> "FakeWriteBatch":
+        return FakeWriteBatch(self)
+
+    def get_all(self, refs: list["FakeDocumentReference"]):
+        self.rpc("batch_get")
+
+        for ref in refs:
+            yield ref.snapshot()
+
+    def write(self, path: str, data: dict, merge: bool) -> None:
+        # callers hold the lock
+        if merge and path in self.docs:
+            self.docs[path] = {**self.docs[path], **data}
+        else:
+            self.docs[path] = dict(data)
+
+        self.written_at[path] = time.perf_counter()
+
+    def close(self) -> None:
+        pass
+
+class FakeDocumentReference:
+    def __init__(self, client: FakeFirestore, path: str):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def __eq__(self, value) -> bool:
+        return isinstance(value, FakeDocumentReference) and self.path == value.path
+
+    def __hash__(self) -> int:
+        return self.path.__hash__()
+
+    def snapshot(self) -> "FakeDocumentSnapshot":
+        with self.client.lock:
+            data = self.client.docs.get(self.path)
+
+        return FakeDocumentSnapshot(self, None if data is None else dict(data))
+
+    def get(self) -> "FakeDocumentSnapshot":
+        self.client.rpc("get")
+        return self.snapshot()
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        self.client.rpc("commit")
+
+        with self.client.lock:
+            self.client.write(self.path, data, merge)
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: FakeDocumentReference, data: dict | None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+
+    def get(self, field: str):
+        if self.data is None or field not in self.data:
+            raise KeyError(f"{field} is not in {self.reference.path}")
+
+        return self.data[field]
+
+    def to_dict(self) -> dict | None:
+        return None if self.data is None else dict(self.data)
+
+class FakeWriteBatch:
+    def __init__(self, client: FakeFirestore):
+        self.client = client
+        self.writes = list[tuple[str, dict, bool]]()
+
+    def __len__(self) -> int:
+        return len(self.writes)
+
+    def set(self, ref: FakeDocumentReference, data: dict, merge: bool = False) -> None:
+        self.writes.append((ref.path, data, merge))
+
+    def commit(self) -> None:
+        self.client.rpc("commit")
+
+        # all or nothing, like a real batch
+        with self.client.lock:
+            for path, data, merge in self.writes:
+                self.client.write(path, data, merge)
+
+        self.writes.clear()
+
+OPERATORS = {
+    "==": lambda a, b: a == b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+class FakeQuery:
+    def __init__(self, client: FakeFirestore, path: str, filters: tuple = (), order: str | None = None, count: int | None = None, after=None):
+        self.client = client
+        self.path = path
+        self.filters = filters
+        self.order = order
+        self.count = count
+        self.after = after
+
+    def copy(self, **changes) -> "FakeQuery":
+        fields = {"filters": self.filters, "order": self.order, "count": self.count, "after": self.after}
+        fields.update(changes)
+        return FakeQuery(self.client, self.path, **fields)
+
+    def where(self, filter: firestore.FieldFilter) -> "FakeQuery":
+        return self.copy(filters=self.filters + ((filter.field_path, OPERATORS[filter.op_string], filter.value),))
+
+    def order_by(self, field: str) -> "FakeQuery":
+        return self.copy(order=field)
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self.copy(count=count)
+
+    def start_after(self, snapshot: FakeDocumentSnapshot) -> "FakeQuery":
+        return self.copy(after=snapshot)
+
+    def get(self) -> list[FakeDocumentSnapshot]:
+        self.client.rpc("query")
+        prefix = self.path + "/"
+
+        with self.client.lock:
+            matches = [(path, dict(data)) for path, data in self.client.docs.items() if path.startswith(prefix) and "/" not in path[len(prefix):]]
+
+        matches = [(path, data) for path, data in matches if all(field in data and compare(data[field], value) for field, compare, value in self.filters)]
+
+        # documents are ordered by id after the order_by field, which is what makes start_after well defined
+        if self.order is not None:
+            matches.sort(key=lambda match: (match[1][self.order], match[0]))
+        else:
+            matches.sort(key=lambda match: match[0])
+
+        if self.after is not None:
+            paths = [path for path, _ in matches]
+            if self.after.reference.path in paths:
+                matches = matches[paths.index(self.after.reference.path) + 1:]
+
+        if self.count is not None:
+            matches = matches[:self.count]
+
+        return [FakeDocumentSnapshot(FakeDocumentReference(self.client, path), data) for path, data in matches]
+
+    def stream(self):
+        yield from self.get()
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: FakeFirestore, path: str):
+        super().__init__(client, path)
+
+    def document(self, id: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self.client, self.path + "/" + id)
\ No newline at end of file
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+from datetime import datetime, date, timedelta, timezone
+import numpy as np
+
+# writes a made up archive in the same DiscordChatExporter json format as the real export in messages2, for
+# benchmarking and for trying things out without the real messages
+
+DISCORD_EPOCH_MS = 1420070400000
+
+WORDS = ("the", "a", "i", "you", "it", "is", "that", "lol", "lmao", "what", "no", "yeah", "pizza", "game", "tonight",
+         "tomorrow", "class", "today", "anyone", "want", "to", "go", "get", "food", "omg", "this", "so", "good", "bad",
+         "why", "did", "we", "do", "play", "call", "later", "now", "im", "just", "like", "and", "but", "for", "me")
+# a few of the words the scoring rules care about, so the generated messages exercise every rule
+SPECIAL_WORDS = ("@david", "sycamore", "reed", "cw", "tw", "kill")
+
+CHANNEL_NAMES = ("general", "memes", "gaming", "music", "food", "venting", "school", "nsfw", "pets", "movies", "art", "random")
+# how lopsided activity is across channels and people, the busiest of 12 channels gets about a third of the messages
+SHARE_EXPONENT = 1.1
+
+USERNAMES = ("neonkitchens", "mineawesome", "insidioushumdrum", "anaru", "knifekeroppi")
+
+def snowflake(ts: datetime, sequence: int) -> str:
+    ms = int(ts.timestamp() * 1000) - DISCORD_EPOCH_MS
+    return str((ms << 22) | (sequence & 0x3FFFFF))
+
+def makePeople(rng: np.random.Generator, count: int) -> list[dict]:
+    people = []
+
+    for i in range(count):
+        username = USERNAMES[i] if i < len(USERNAMES) else f"user{i}"
+        color = "#" + "".join(f"{value:02x}" for value in rng.integers(0, 256, 3))
+
+        people.append({
+            "id": str(100000000000000000 + i),
+            "name": username,
+            "discriminator": "0000",
+            "nickname": username.capitalize(),
+            "color": color,
+            "isBot": False,
+            "roles": [],
+            "avatarUrl": f"https://cdn.discordapp.com/avatars/{100000000000000000 + i}/avatar.png",
+        })
+
+    return people
+
+def makeContent(rng: np.random.Generator) -> str:
+    length = int(rng.geometric(0.12))
+    words = list(rng.choice(WORDS, length))
+
+    if rng.random() < 0.05:
+        words.insert(int(rng.integers(0, len(words) + 1)), str(rng.choice(SPECIAL_WORDS)))
+
+    return " ".join(words)
+
+def makeMessage(rng: np.random.Generator, ts: datetime, sequence: int, author: dict, attachment_ratio: float) -> dict:
+    message_id = snowflake(ts, sequence)
+    attachments = []
+
+    if rng.random() < attachment_ratio:
+        attachments.append({
+            "id": message_id,
+            "url": f"https://cdn.discordapp.com/attachments/0/{message_id}/image.png",
+            "fileName": "image.png",
+            "fileSizeBytes": int(rng.integers(10000, 5000000)),
+        })
+
+    return {
+        "id": message_id,
+        "type": "Default",
+        "timestamp": ts.isoformat(timespec="milliseconds"),
+        "timestampEdited": None,
+        "callEndedTimestamp": None,
+        "isPinned": False,
+        "content": makeContent(rng),
+        "author": author,
+        "attachments": attachments,
+        "embeds": [],
+        "stickers": [],
+        "reactions": [],
+        "mentions": [],
+    }
+
+def makeChannel(index: int, dm_ratio: float, channel_count: int) -> tuple[dict, dict]:
+    channel_id = str(200000000000000000 + index)
+
+    # the last dm_ratio of the channels are dms, which the export puts under guild 0
+    if index >= channel_count * (1 - dm_ratio):
+        guild = {"id": "0", "name": "Direct Messages", "iconUrl": "https://cdn.discordapp.com/embed/avatars/0.png"}
+        channel = {"id": channel_id, "type": "DirectTextChat", "categoryId": None, "category": "Private", "name": f"dm{index}", "topic": None}
+    else:
+        guild = {"id": "300000000000000000", "name": "Pizzeria", "iconUrl": "https://cdn.discordapp.com/icons/300000000000000000/icon.png"}
+        channel = {"id": channel_id, "type": "GuildTextChat", "categoryId": None, "category": "Text Channels", "name": f"{CHANNEL_NAMES[index % len(CHANNEL_NAMES)]}-{index}", "topic": None}
+
+    return guild, channel
+
+def rankShares(rng: np.random.Generator, count: int, exponent: float = SHARE_EXPONENT) -> np.ndarray:
+    """Zipf shares by rank (the busiest gets 1, the next 1/2^exponent...), with a random channel or person at each rank."""
+    shares = 1 / np.arange(1, count + 1) ** exponent
+    shares /= shares.sum()
+    rng.shuffle(shares)
+
+    return shares
+
+def generateArchive(folder: str, channels: int = 12, people: int = 40, per_day: float = 200, start: date = date(2020, 1, 1),
+                    end: date = date(2024, 12, 31), attachment_ratio: float = 0.08, dm_ratio: float = 0.25, seed: int = 0) -> int:
+    """Writes one export per channel into folder, returns how many messages were written.
+
+    Each day gets a poisson number of messages (per_day on average) spread over the channels and people, with
+    busier channels and people getting a bigger share like on a real server.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+
+    all_people = makePeople(rng, people)
+    people_share = rankShares(rng, people)
+    channel_share = rankShares(rng, channels)
+
+    channel_messages = [list[dict]() for _ in range(channels)]
+    days = (end - start).days + 1
+    sequence = 0
+
+    for day_offset in range(days):
+        day = start + timedelta(days=day_offset)
+        day_start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        count = int(rng.poisson(per_day))
+
+        seconds = np.sort(rng.integers(0, 86400 * 1000, count))
+        channel_picks = rng.choice(channels, count, p=channel_share)
+        people_picks = rng.choice(people, count, p=people_share)
+
+        for ms, channel_index, person_index in zip(seconds, channel_picks, people_picks):
+            ts = day_start + timedelta(milliseconds=int(ms))
+            channel_messages[channel_index].append(makeMessage(rng, ts, sequence, all_people[person_index], attachment_ratio))
+            sequence += 1
+
+    for index in range(channels):
+        guild, channel = makeChannel(index, dm_ratio, channels)
+        messages = channel_messages[index]
+
+        export = {
+            "guild": guild,
+            "channel": channel,
+            "dateRange": {"after": None, "before": None},
+            "exportedAt": datetime.now(timezone.utc).isoformat(),
+            "messages": messages,
+            "messageCount": len(messages),
+        }
+
+        with open(os.path.join(folder, f"Pizzeria - {channel['name']} [{channel['id']}].json"), "w", encoding="utf-8") as export_file:
+            json.dump(export, export_file, ensure_ascii=False, indent=2)
+
+    return sequence
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes a synthetic DiscordChatExporter archive")
+    parser.add_argument("--out", default="messages2", help="folder to write the exports to")
+    parser.add_argument("--channels", type=int, default=12, help="number of channels (and dms)")
+    parser.add_argument("--people", type=int, default=40, help="number of people sending messages")
+    parser.add_argument("--per-day", type=float, default=200, help="average messages per day over all channels")
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2020, 1, 1), help="first day of messages")
+    parser.add_argument("--end", type=date.fromisoformat, default=date(2024, 12, 31), help="last day of messages")
+    parser.add_argument("--attachment-ratio", type=float, default=0.08, help="share of messages with an attachment")
+    parser.add_argument("--dm-ratio", type=float, default=0.25, help="share of the channels that are dms")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed writes the same archive")
+    args = parser.parse_args()
+
+    written = generateArchive(args.out, args.channels, args.people, args.per_day, args.start, args.end, args.attachment_ratio, args.dm_ratio, args.seed)
+    print(f"wrote {written} messages to {args.out}")
\ No newline at end of file
@@ -0,0 +1,112 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+from cachetools import TTLCache
+import logging as log
+import message_reader_fs as mr
+
+class MessageCache:
+    """Fully resolved messages for $message lookups, kept for ttl seconds and at most maxsize of them.
+
+    Messages already loaded for today count as hits. Concurrent lookups of the same id share one fetch. A message
+    that doesn't exist is a miss, an error from the backend is raised to the caller and counted separately.
+    Entries are kept per namespace, a server can only look up its own messages.
+    """
+
+    def __init__(self, fetch: Callable[[str, str], Awaitable[mr.Message | None]], maxsize: int = 512, ttl: float = 3600):
+        self.fetch = fetch
+        # a TTLCache evicts the least recently used entry once it is full
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.in_flight = dict[str, asyncio.Task]()
+
+        self.invalid = 0
+        self.hits = 0
+        self.day_hits = 0
+        self.coalesced = 0
+        self.fetches = 0
+        self.misses = 0
+        self.errors = 0
+        self.hit_time = 0.0
+        self.fetch_time = 0.0
+        self.max_fetch_time = 0.0
+
+    async def lookup(self, id: str, namespace: str = mr.DEFAULT_NAMESPACE) -> mr.Message | None:
+        start = time.perf_counter()
+
+        # discord ids are snowflakes, anything else can't be a message
+        if not id.isdigit():
+            self.invalid += 1
+            self.misses += 1
+            return None
+
+        key = namespace + "/" + id
+
+        message = self.entries.get(key)
+        if message is None:
+            message = mr.findTodaysMessage(id, namespace)
+            if message is not None:
+                self.day_hits += 1
+        else:
+            self.hits += 1
+
+        if message is not None:
+            self.hit_time += time.perf_counter() - start
+            return message
+
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self.load(id, namespace))
+            self.in_flight[key] = task
+        else:
+            self.coalesced += 1
+
+        # shielded so one caller giving up doesn't cancel the fetch for everyone else waiting on it
+        message = await asyncio.shield(task)
+
+        if message is None:
+            self.misses += 1
+
+        return message
+
+    async def load(self, id: str, namespace: str) -> mr.Message | None:
+        key = namespace + "/" + id
+        start = time.perf_counter()
+        self.fetches += 1
+
+        try:
+            message = await self.fetch(id, namespace)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            del self.in_flight[key]
+
+            elapsed = time.perf_counter() - start
+            self.fetch_time += elapsed
+            self.max_fetch_time = max(self.max_fetch_time, elapsed)
+
+        if message is not None:
+            self.entries[key] = message
+
+        log.debug(f"fetched message {id} in {elapsed * 1000:.1f}ms")
+        return message
+
+    def stats(self) -> dict[str, float]:
+        out = dict()
+
+        served = self.hits + self.day_hits
+        lookups = self.invalid + served + self.coalesced + self.fetches
+
+        out["lookups"] = lookups
+        out["hits"] = self.hits
+        out["day_hits"] = self.day_hits
+        out["coalesced"] = self.coalesced
+        out["fetches"] = self.fetches
+        out["misses"] = self.misses
+        out["errors"] = self.errors
+        out["hit_rate"] = served / lookups if lookups > 0 else 0.0
+        out["mean_hit_ms"] = self.hit_time / served * 1000 if served > 0 else 0.0
+        out["mean_fetch_ms"] = self.fetch_time / self.fetches * 1000 if self.fetches > 0 else 0.0
+        out["max_fetch_ms"] = self.max_fetch_time * 1000
+
+        return out
\ No newline at end of file
@@ -1,157 +1,144 @@
-import json
-
-from os import getcwd
+from os import getcwd, getenv, cpu_count
 from os import listdir
-from os.path import isfile, join
+from os.path import isfile, join, getsize
+import sys
+from concurrent.futures import ProcessPoolExecutor, Future
 
 from datetime import *
 import numpy as np
+from sampling import AliasTable
+from scoring import scoreBatch
+from archive_parser import parseFile, ParseProgress
+import archive_snapshot
+
+# the archive keeps every message in memory, so the records are slotted, ids are kept as ints (the str properties
+# are what everything else uses), strings that repeat across records are interned, and messages without attachments
+# all share one empty tuple
+
+EMPTY_ATTACHMENTS = ()
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
 
 class Channel:
-    server_name: str = ""
-    channel_name: str = ""
-    icon: str = ""
-    channel_id: str = ""
-    server_id: str = ""
+    __slots__ = ("server_name", "channel_name", "icon", "_channel_id", "_server_id")
 
     def __init__(self, server_name: str, channel_name: str, icon: str, channel_id: int, server_id: int):
-        self.server_name = server_name
-        self.channel_name = channel_name
-        self.icon = icon
-        self.channel_id = channel_id
-        self.server_id = server_id
+        self.server_name = intern(server_name)
+        self.channel_name = intern(channel_name)
+        self.icon = intern(icon)
+        self._channel_id = int(channel_id)
+        self._server_id = int(server_id)
+
+    @property
+    def channel_id(self) -> str:
+        return str(self._channel_id)
+
+    @property
+    def server_id(self) -> str:
+        return str(self._server_id)
 
 class Person:
-    username: str = ""
-    discord_id: str = ""
-    nickname: str = ""
-    color: str = ""
-    avatar: str = ""
+    __slots__ = ("username", "_discord_id", "nickname", "color", "avatar")
 
     def __init__(self, username: str, discord_id: str, nickname: str, color: str, avatar: str):
-        self.username = username
-        self.discord_id = discord_id
-        self.nickname = nickname
-        self.color = color
-        self.avatar = avatar
+        self.username = intern(username)
+        self._discord_id = int(discord_id)
+        self.nickname = intern(nickname)
+        self.color = intern(color)
+        self.avatar = intern(avatar)
+
+    @property
+    def discord_id(self) -> str:
+        return str(self._discord_id)
     
     def __hash__(self):
-        return self.discord_id.__hash__()
+        return self._discord_id.__hash__()
     
     def __eq__(self, value):
-        return self.discord_id == value.discord_id
+        return self._discord_id == value._discord_id
 
 class Attachment:
-    url: str = ""
-    name: str = ""
+    __slots__ = ("url", "name")
 
     def __init__(self, url: str, name: str):
         self.url = url
-        self.name = name
+        self.name = intern(name)
 
 class Message:
-    sender: Person = None
-    channel: Channel = None
-    content: str = ""
-    ts: datetime = datetime.min
-    discord_id: str = ""
-    attachments: list[Attachment] = []
+    __slots__ = ("sender", "channel", "content", "ts", "_discord_id", "attachments")
 
     def __init__(self, sender: Person, channel: Channel, content: str, ts: datetime, discord_id: str, attachments: list):
         self.sender = sender
         self.channel = channel
         self.content = content
         self.ts = ts
-        self.discord_id = discord_id
-        self.attachments = attachments
+        self._discord_id = int(discord_id)
+        self.attachments: tuple[Attachment, ...] = tuple(attachments) if len(attachments) > 0 else EMPTY_ATTACHMENTS
+
+    @property
+    def discord_id(self) -> str:
+        return str(self._discord_id)
     
     def __hash__(self) -> int:
-        return self.discord_id.__hash__()
+        return self._discord_id.__hash__()
     
     def __eq__(self, value) -> bool:
-        return self.discord_id == value.discord_id
+        return self._discord_id == value._discord_id
     
     def isDM(self) -> bool:
-        return self.channel.server_id == "0"
+        return self.channel._server_id == 0
 
     def getMessageLink(self) -> str:
         if self.isDM():
             return "https://discord.com/channels/@me/" + self.channel.channel_id + "/" + self.discord_id
         return "https://discord.com/channels/" + self.channel.server_id + "/" + self.channel.channel_id + "/" + self.discord_id
 
+MESSAGES_FOLDER = join(getcwd(), 'messages2')
+
 channels = dict[str, Channel]()
 people = dict[str, Person]()
-messages = dict[str, Message]()
+# keyed by the message's own int id, so the index doesn't keep a second copy of every id as a str
+messages = dict[int, Message]()
 day_to_message = dict[date, list[Message]]()
+# every message with the same utc offset shares one tzinfo instead of each parsed timestamp bringing its own
+timezones = dict[timedelta, timezone]()
+# weights line up with day_to_message and are computed once after parsing
+day_to_weights = dict[date, np.ndarray]()
+# candidates and alias table for a given "today", built the first time that day is asked for
+todays_tables = dict[date, tuple[list[Message], AliasTable]]()
+
+def getMessageFromToday(rng: np.random.Generator | None = None) -> Message:
+    today = date.today()
 
-def calcWeight(msg: Message) -> float:
-    weight = 50
-
-    words = msg.content.split()
-    word_count = len(words)
-    
-    for word in words:
-        # if a message has a content warning or other words that signal something bad, we don't want to considered 
-        if word.lower() in ["cw", "tw", "death", "trump", "kill", "kms"]: 
-            weight = 0
-
-        # if a mention mentions someone else, increase its weight
-        if "@" in word or word.lower() in ["david", "dayvid", "syc", "sycamore", "reed", "abi", "ethan"]: 
-            weight *= 1.1
-        
-    if msg.channel.channel_id == 0: # boost chances of DMs being sent
-        weight *= 1.1
-
-    # penalize short messages, since they rarely are interesting. shorter messages get penalized more
-    # will not penalize messages with pictures
-    if word_count <= 5 and len(msg.attachments) == 0: 
-        weight *= .1 * word_count
-
-    # give a little boost to messages with pictures
-    if len(msg.attachments) > 0:
-        weight *= 1.2
-
-    if "venting" in msg.channel.channel_name: # penalize messages in venting
-        weight *= .3
-
-    if "nsfw" in msg.channel.channel_name: # add a little spice for good measure
-        weight *= 1.1
-
-    if msg.sender.username in ["neonkitchens", "mineawesome", "insidioushumdrum", "anaru", "knifekeroppi"]: # prioritize messages sent by us
-        weight *= 1.5
+    if today not in todays_tables:
+        todays_tables[today] = buildTodaysTable(today)
 
-    if weight < 0: # negative number would break shit, and if the weight is 0 its impossible so
-        return 0
+    messages_to_consider, table = todays_tables[today]
 
-    return weight
+    return messages_to_consider[table.draw(rng)]
 
-def getMessageFromToday() -> Message:
+def buildTodaysTable(today: date) -> tuple[list[Message], AliasTable]:
     messages_to_consider = []
     weights = []
-    total_weight = 0
-
-    today = date.today()
-    this_year = today.year
 
-    for year in range(2020, this_year):
+    for year in range(2020, today.year):
         date_to_check = today.replace(year=year)
         if date_to_check in day_to_message:
-            for message in day_to_message[date_to_check]:
-                msg_weight = calcWeight(message)
-                messages_to_consider.append(message)
-                weights.append(msg_weight)
-                total_weight += msg_weight
-    
-    message_choice = np.random.choice(messages_to_consider, 1, p=np.array(weights)/total_weight)
+            messages_to_consider.extend(day_to_message[date_to_check])
+            weights.append(day_to_weights[date_to_check])
+
+    if len(messages_to_consider) == 0:
+        raise ValueError(f"there are no messages from past years on {today.month}/{today.day}")
 
-    return message_choice[0]
+    return messages_to_consider, AliasTable(np.concatenate(weights))
 
 def getMessage(id: str) -> Message:
     global messages
 
-    if id in messages:
-        return messages[id]
-    else:
+    try:
+        return messages.get(int(id))
+    except ValueError:
         return None
 
 def getOrPersistPerson(id: str, author_json: any) -> Person:
@@ -177,45 +164,97 @@ def addMessageToDayMap(date: date, message: Message) -> None:
     day_to_message[date].append(message)
     
 
-allfiles = [join(getcwd(), 'messages2', f) for f in listdir(join(getcwd(), 'messages2')) if isfile(join(getcwd(), 'messages2', f))]
+def shareTimezone(ts: datetime) -> datetime:
+    offset = ts.utcoffset()
+
+    if offset is None:
+        return ts
+
+    if offset not in timezones:
+        timezones[offset] = timezone(offset)
+
+    return ts.replace(tzinfo=timezones[offset])
+
+def mergeResult(result: dict) -> None:
+    server_name, channel_name, icon, channel_id, server_id = result["channel"]
+    current_channel = Channel(server_name=server_name, channel_name=channel_name, icon=icon, channel_id=channel_id, server_id=server_id)
+
+    channels[channel_id] = current_channel
+
+    authors = result["authors"]
 
-print("Parsing Files...")
+    for discord_id, author_id, content, timestamp, attachment_tuples in result["messages"]:
+        author = getOrPersistPerson(author_id, authors[author_id])
+        ts = shareTimezone(datetime.fromisoformat(timestamp))
 
-for file in allfiles:
-    print(f"Parsing {file}...")
+        attachments = EMPTY_ATTACHMENTS if len(attachment_tuples) == 0 else [Attachment(attachment_url, attachment_name) for attachment_url, attachment_name in attachment_tuples]
 
-    with open(file, "r") as jsonFile:
-        data = json.load(jsonFile)
-        guild_json = data['guild']
-        channel_json = data['channel']
+        message = Message(sender=author, channel=current_channel, content=content, ts=ts, discord_id=discord_id, attachments=attachments)
+        message_date = ts.date()
 
-        current_channel = Channel(server_name=guild_json["name"], channel_name=channel_json["name"], icon=guild_json["iconUrl"], channel_id=channel_json["id"], server_id=guild_json["id"])
+        messages[message._discord_id] = message
+        addMessageToDayMap(message_date, message)
 
-        channels[channel_json["id"]] = current_channel
+def loadArchive(folder: str = MESSAGES_FOLDER, workers: int | None = None) -> None:
+    """Parses every export in folder into channels, people, messages and day_to_message.
 
-        all_messages = data["messages"]
+    Files are parsed on a process pool (MESSAGE_READER_WORKERS processes, every core by default) and merged
+    back in directory order, so the result is the same as parsing them one after another.
+    """
+    if workers is None:
+        workers = int(getenv("MESSAGE_READER_WORKERS", cpu_count() or 1))
 
-        for message_json in all_messages:
-            author_json = message_json["author"]
-            author_id = author_json["id"]
-            author = getOrPersistPerson(author_id, author_json)
+    allfiles = [join(folder, f) for f in listdir(folder) if isfile(join(folder, f))]
+    progress = ParseProgress(len(allfiles), sum(getsize(file) for file in allfiles))
 
-            content = message_json["content"]
-            discord_id = message_json["id"]
-            timestamp = datetime.fromisoformat(message_json["timestamp"])
+    print(f"Parsing {len(allfiles)} files with {workers} workers...")
 
-            all_attachments = message_json["attachments"]
-            attachments = list()
+    if workers <= 1:
+        for file in allfiles:
+            result = parseFile(file)
+            mergeResult(result)
+            progress.update(result)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # start the biggest files first so one huge channel doesn't end up last on an otherwise idle pool
+            futures = dict[str, Future]()
+            for file in sorted(allfiles, key=getsize, reverse=True):
+                futures[file] = executor.submit(parseFile, file)
+
+            for file in allfiles:
+                result = futures.pop(file).result()
+                mergeResult(result)
+                progress.update(result)
+
+    progress.finish()
+
+    for message_date in day_to_message:
+        day_to_weights[message_date] = scoreBatch(day_to_message[message_date])
+
+    print("Parsing Complete!")
+
+def useSnapshot(opened: archive_snapshot.Snapshot) -> None:
+    """Serves the archive from a memory-mapped snapshot, messages are only built as they are looked up."""
+    global snapshot
+    global channels
+    global people
+    global messages
+    global day_to_message
+    global day_to_weights
 
-            for attachment_json in all_attachments:
-                attachment_name = attachment_json["fileName"]
-                attachment_url = attachment_json["url"]
-                attachments.append(Attachment(attachment_url, attachment_name))
+    snapshot = opened
+    channels = opened.channels
+    people = opened.people
+    messages = archive_snapshot.LazyMessages(opened)
+    day_to_message = archive_snapshot.LazyDays(opened)
+    day_to_weights = archive_snapshot.LazyWeights(day_to_message)
 
-            message = Message(sender=author, channel=current_channel, content=content, ts=timestamp, discord_id=discord_id, attachments=attachments)
-            message_date = timestamp.date()
+    print(f"Loaded {len(opened)} messages from snapshot")
 
-            messages[discord_id] = message
-            addMessageToDayMap(message_date, message)
+# set when the archive is served from a compiled snapshot (see archive_snapshot.py) instead of parsed
+snapshot: archive_snapshot.Snapshot | None = archive_snapshot.openSnapshot(archive_snapshot.SNAPSHOT_PATH, MESSAGES_FOLDER)
 
-print("Parsing Complete!")
+if snapshot is not None:
+    useSnapshot(snapshot)
+else:
+    loadArchive()
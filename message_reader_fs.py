@@ -4,37 +4,129 @@ import google.cloud.logging as gcloud_logging
 import google.auth as auth
 import numpy as np
 import pytz
-import random
-from readerwriterlock.rwlock import RWLockWrite
+import os
+import sys
+import threading
+import time
+from cachetools import LRUCache, TTLCache
+from sampling import AliasTable
+from scoring import scoreBatch
+from profile_sync import ProfileSync, PERSON_FIELDS, CHANNEL_FIELDS
+import metrics
 import logging as log
 
-creds, project_id = auth.load_credentials_from_file("service-account-auth.json")
+# nothing here talks to google at import time, clients are created the first time they are needed
+creds = None
+project_id: str | None = None
+db: firestore.Client | None = None
+gcp_client: gcloud_logging.Client | None = None
+client_lock = threading.Lock()
 
-log.info("authing")
-db = firestore.Client(project=project_id, credentials=creds)
+def getCredentials() -> tuple:
+    global creds
+    global project_id
 
-gcp_client = gcloud_logging.Client(project=project_id, credentials=creds)
-gcp_client.setup_logging()
+    with client_lock:
+        if creds is None:
+            creds, project_id = auth.load_credentials_from_file("service-account-auth.json")
 
-channels = db.collection("servers", "pizzeria", "channels")
-people = db.collection("servers", "pizzeria", "people")
-messages = db.collection("servers", "pizzeria", "messages")
+        return creds, project_id
+
+def getDb() -> firestore.Client:
+    global db
+
+    if db is None:
+        credentials, project = getCredentials()
+
+        with client_lock:
+            if db is None:
+                log.info("authing")
+                db = firestore.Client(project=project, credentials=credentials)
+
+    return db
+
+def setupLogging() -> None:
+    """Sends logging to cloud logging, only the first call does anything."""
+    global gcp_client
+
+    credentials, project = getCredentials()
+
+    with client_lock:
+        if gcp_client is None:
+            gcp_client = gcloud_logging.Client(project=project, credentials=credentials)
+            gcp_client.setup_logging()
+
+# every server's data lives under servers/<namespace>. a guild's namespace is its id, unless GUILD_NAMESPACES
+# ("<guild id>=<namespace>,...") names another one, like the original server's data under servers/pizzeria. only a
+# guild listed there can use pizzeria, the bot won't start without it so that guild's data isn't moved by accident
+DEFAULT_NAMESPACE = "pizzeria"
+
+def parseNamespaces(text: str) -> dict[str, str]:
+    out = dict()
+
+    for pair in text.split(","):
+        if "=" in pair:
+            guild_id, namespace = pair.split("=", 1)
+            out[guild_id.strip()] = namespace.strip()
+
+    return out
+
+GUILD_NAMESPACES = parseNamespaces(os.getenv("GUILD_NAMESPACES", ""))
+
+def namespaceFor(server_id) -> str:
+    return GUILD_NAMESPACES.get(str(server_id), str(server_id))
+
+def collection(name: str, namespace: str = DEFAULT_NAMESPACE) -> firestore.CollectionReference:
+    return getDb().collection("servers", namespace, name)
+
+def document(name: str, id: str, namespace: str = DEFAULT_NAMESPACE) -> firestore.DocumentReference:
+    return getDb().document("servers", namespace, name, id)
 
 EDT = pytz.timezone('America/New_York')
 
+# each get_all call is one BatchGetDocuments rpc, this keeps the requests a reasonable size
+GET_ALL_CHUNK = 300
+
+# message documents from version 2 on carry a copy of their sender's and channel's display fields as they were when
+# the message was written (sender_snapshot, channel_snapshot), so rendering one takes a single read. version 3 adds
+# month_day (month * 100 + day) and year in EDT, so a calendar day across every year is one equality query.
+# backfill_schema.py brings older documents up to date.
+SCHEMA_VERSION = 3
+
+# queries are read in pages of this size, following a cursor until a short page comes back
+PAGE_SIZE = 1000
+
+# tries at reading a message's sender and channel before it is left out of its batch
+PROFILE_LOOKUP_ATTEMPTS = 3
+
+# where the sender and channel of each loaded message came from, inline snapshots or reading the references
+message_profiles = metrics.Counter("message_profiles_total", "Messages loaded by where their sender and channel came from", ("source",))
+
+# day caches hold a lot of these, so like message_reader's they are slotted, keep ids as ints behind str properties,
+# intern the strings that repeat across records and share one empty attachments tuple
+
+EMPTY_ATTACHMENTS = ()
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
 class Channel:
-    server_name: str = ""
-    channel_name: str = ""
-    icon: str = ""
-    channel_id: str = ""
-    server_id: str = ""
+    __slots__ = ("server_name", "channel_name", "icon", "_channel_id", "_server_id")
 
     def __init__(self, server_name: str, channel_name: str, icon: str, channel_id: int, server_id: int):
-        self.server_name = server_name
-        self.channel_name = channel_name
-        self.icon = icon
-        self.channel_id = str(channel_id)
-        self.server_id = str(server_id)
+        self.server_name = intern(server_name)
+        self.channel_name = intern(channel_name)
+        self.icon = intern(icon)
+        self._channel_id = int(channel_id)
+        self._server_id = int(server_id)
+
+    @property
+    def channel_id(self) -> str:
+        return str(self._channel_id)
+
+    @property
+    def server_id(self) -> str:
+        return str(self._server_id)
     
     def toDict(self) -> dict[str, str]:
         out = dict()
@@ -48,24 +140,24 @@ class Channel:
         return out
 
 class Person:
-    username: str = ""
-    discord_id: str = ""
-    nickname: str = ""
-    color: str = ""
-    avatar: str = ""
+    __slots__ = ("username", "_discord_id", "nickname", "color", "avatar")
 
     def __init__(self, username: str, discord_id: str, nickname: str, color: str, avatar: str):
-        self.username = username
-        self.discord_id = discord_id
-        self.nickname = nickname
-        self.color = color
-        self.avatar = avatar
+        self.username = intern(username)
+        self._discord_id = int(discord_id)
+        self.nickname = intern(nickname)
+        self.color = intern(color)
+        self.avatar = intern(avatar)
+
+    @property
+    def discord_id(self) -> str:
+        return str(self._discord_id)
     
     def __hash__(self):
-        return self.discord_id.__hash__()
+        return self._discord_id.__hash__()
     
     def __eq__(self, value):
-        return self.discord_id == value.discord_id
+        return self._discord_id == value._discord_id
     
     def toDict(self) -> dict[str, str]:
         out = dict()
@@ -79,45 +171,50 @@ class Person:
         return out
 
 class Attachment:
-    url: str = ""
-    name: str = ""
+    __slots__ = ("url", "name")
 
     def __init__(self, url: str, name: str):
         self.url = url
-        self.name = name
+        self.name = intern(name)
 
 class Message:
-    sender: Person
-    channel: Channel
-    content: str = ""
-    ts: datetime = datetime.min
-    discord_id: str = ""
-    attachments: list[Attachment] = []
+    __slots__ = ("sender", "channel", "content", "ts", "_discord_id", "attachments")
 
     def __init__(self, sender: Person, channel: Channel, content: str, ts: datetime, discord_id: str, attachments: list):
         self.sender = sender
         self.channel = channel
         self.content = content
         self.ts = ts
-        self.discord_id = discord_id
-        self.attachments = attachments
+        self._discord_id = int(discord_id)
+        self.attachments: tuple[Attachment, ...] = tuple(attachments) if len(attachments) > 0 else EMPTY_ATTACHMENTS
+
+    @property
+    def discord_id(self) -> str:
+        return str(self._discord_id)
     
     def __hash__(self) -> int:
-        return self.discord_id.__hash__()
+        return self._discord_id.__hash__()
     
     def __eq__(self, value) -> bool:
-        return self.discord_id == value.discord_id
+        return self._discord_id == value._discord_id
     
     def isDM(self) -> bool:
-        return self.channel.server_id == "0"
+        return self.channel._server_id == 0
+
+    def namespace(self) -> str:
+        return namespaceFor(self.channel.server_id)
     
     def toDict(self) -> dict[str, str]:
         out = dict()
 
-        out["sender"] = db.document("servers", "pizzeria", "people", self.sender.discord_id)
-        out["channel"] = db.document("servers", "pizzeria", "channels", self.channel.channel_id)
+        out["schema"] = SCHEMA_VERSION
+        out["sender"] = document("people", self.sender.discord_id, self.namespace())
+        out["channel"] = document("channels", self.channel.channel_id, self.namespace())
+        out["sender_snapshot"] = self.sender.toDict()
+        out["channel_snapshot"] = self.channel.toDict()
         out["content"] = self.content
         out["ts"] = self.ts
+        out["month_day"], out["year"] = monthDay(self.ts)
         out["discord_id"] = self.discord_id
 
         attachments = []
@@ -139,139 +236,422 @@ class Message:
             return "https://discord.com/channels/@me/" + self.channel.channel_id + "/" + self.discord_id
         return "https://discord.com/channels/" + self.channel.server_id + "/" + self.channel.channel_id + "/" + self.discord_id
 
-todays_messages = set[Message]()
-date_of_todays_messages = date(1, 1, 1)
-tm_lock = RWLockWrite()
+class ProfileCache:
+    """Last known state of person or channel documents, keyed by discord id."""
 
-def getMessages() -> tuple[set[Message], date]:
-    global tm_lock
-    global todays_messages
-    global date_of_todays_messages
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    with tm_lock.gen_rlock():
-        return todays_messages, date_of_todays_messages
+    def get(self, discord_id: str):
+        with self.lock:
+            value = self.entries.get(discord_id)
 
-def putMessage(message: Message):
-    channelref = db.document("servers", "pizzeria", "channels", message.channel.channel_id)
-    channelsnap = channelref.get()
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
 
-    if channelsnap.exists:
-        # only do it 1 out of every 5 messages
-        if random.randrange(0,5) == 0:
-            # we only check icon, channel_name, and server_name since its the only things that would change
-            channel = loadChannel(channelsnap)
+            return value
 
-            if channel.channel_name != message.channel.channel_name:
-                channelref.update({"channel_name": message.channel.channel_name})
-            
-            if channel.server_name != message.channel.server_name:
-                channelref.update({"server_name": message.channel.server_name})
+    def put(self, discord_id: str, value) -> None:
+        with self.lock:
+            self.entries[discord_id] = value
 
-            if channel.icon != message.channel.icon:
-                channelref.update({"icon": message.channel.icon})
-    else:
-        channels.add(message.channel.toDict(), message.channel.channel_id)
-    
-    senderref = db.document("servers", "pizzeria", "people", message.sender.discord_id)
-    sendersnap = senderref.get()
-    
-    if sendersnap.exists:
-        # we only do this on 1 out of every 5 messages
-        if random.randrange(0,5) == 0:
-            # we only check nickname, avatar, and color since those change
-            person = loadPerson(sendersnap)
-
-            if person.nickname != message.sender.nickname:
-                log.info(f"updating nickname for {message.sender.username} from {person.nickname} to {message.sender.nickname}")
-                senderref.update({"nickname": message.sender.nickname})
-            
-            if person.avatar != message.sender.avatar:
-                log.info(f"updating avatar for {message.sender.username}")
-                senderref.update({"avatar": message.sender.avatar})
-            
-            if person.color != message.sender.color:
-                log.info(f"updating color for {message.sender.username} from {person.color} to {message.sender.color}")
-                senderref.update({"color": message.sender.color})
-    else:
-        log.info(f"adding new person {message.sender.username}")
-        people.add(message.sender.toDict(), message.sender.discord_id)
+    def forget(self, discord_id: str) -> None:
+        with self.lock:
+            self.entries.pop(discord_id, None)
 
-    log.debug(f"new message from {message.sender.username} in {message.channel.channel_name}: {message.content}")
-    messages.add(message.toDict(), message.discord_id)
+person_cache = ProfileCache()
+channel_cache = ProfileCache()
 
-def calcWeight(msg: Message) -> float:
-    weight = 50
+def cacheStats() -> dict[str, int]:
+    out = dict()
 
-    words = msg.content.split()
-    word_count = len(words)
-    
-    for word in words:
-        # if a message has a content warning or other words that signal something bad, we don't want to considered 
-        if word.lower() in ["cw", "tw", "death", "trump", "kill", "kms"]: 
-            weight = 0
-
-        # if a mention mentions someone else, increase its weight
-        if "@" in word or word.lower() in ["david", "dayvid", "syc", "sycamore", "reed", "abi", "ethan"]: 
-            weight *= 1.1
-        
-    if msg.channel.channel_id == 0: # boost chances of DMs being sent
-        weight *= 1.1
+    out["person_hits"] = person_cache.hits
+    out["person_misses"] = person_cache.misses
+    out["channel_hits"] = channel_cache.hits
+    out["channel_misses"] = channel_cache.misses
 
-    # penalize short messages, since they rarely are interesting. shorter messages get penalized more
-    # will not penalize messages with pictures
-    if word_count <= 5 and len(msg.attachments) == 0: 
-        weight *= .1 * word_count
+    return out
 
-    # give a little boost to messages with pictures
-    if len(msg.attachments) > 0:
-        weight *= 1.2
+metrics.Gauge("profile_cache_lookups_total", "Person and channel cache lookups", lambda: {("person", "hit"): person_cache.hits, ("person", "miss"): person_cache.misses, ("channel", "hit"): channel_cache.hits, ("channel", "miss"): channel_cache.misses}, ("cache", "result"), kind="counter")
 
-    if "venting" in msg.channel.channel_name: # penalize messages in venting
-        weight *= .3
+def prepareDay(new_messages: set[Message]) -> tuple[list[Message], np.ndarray, AliasTable | None]:
+    candidates = list(new_messages)
+    weights = scoreBatch(candidates)
+    table = AliasTable(weights) if len(candidates) > 0 else None
 
-    if "nsfw" in msg.channel.channel_name: # add a little spice for good measure
-        weight *= 1.1
+    return candidates, weights, table
 
-    if msg.sender.username in ["neonkitchens", "mineawesome", "insidioushumdrum", "anaru", "knifekeroppi"]: # prioritize messages sent by us
-        weight *= 1.5
+class DaySnapshot:
+    """One namespace's messages for one day, with everything sampling needs precomputed. Never changed once built.
 
-    if weight < 0: # negative number would break shit, and if the weight is 0 its impossible so
-        return 0
+    The messages are kept as a set, in a fixed order with their weights and an alias table, and by id so a lookup
+    can be answered from here.
+    """
 
-    return weight
+    __slots__ = ("day", "messages", "candidates", "weights", "table", "by_id", "loaded_at")
 
-def getMessageFromToday() -> Message:
-    all_messages, all_messages_date = getMessages()
+    def __init__(self, new_messages: set[Message], day: date, loaded_at: float | None = None):
+        candidates, weights, table = prepareDay(new_messages)
 
-    messages_to_consider = []
-    weights = []
-    total_weight = 0
+        self.day = day
+        self.messages = frozenset(new_messages)
+        self.candidates = tuple(candidates)
+        self.weights = weights
+        self.table = table
+        self.by_id = {message.discord_id: message for message in candidates}
+        # wall clock time the messages were loaded, 0 for the empty snapshot a cache starts with
+        self.loaded_at = time.time() if loaded_at is None else loaded_at
 
-    if all_messages_date != getTodaysDate():
-        updateTodaysMessages()
-    for message in all_messages:
-        msg_weight = calcWeight(message)
-        messages_to_consider.append(message)
-        weights.append(msg_weight)
-        total_weight += msg_weight
-    
-    message_choice = np.random.choice(messages_to_consider, 1, p=np.array(weights)/total_weight)
+    def find(self, id: str) -> Message | None:
+        return self.by_id.get(id)
+
+    def choose(self, rng: np.random.Generator | None = None) -> Message:
+        if self.table is None:
+            raise ValueError(f"there are no messages loaded for {self.day}")
+
+        return self.candidates[self.table.draw(rng)]
+
+# what every day cache holds until its first load
+EMPTY_DAY = DaySnapshot(set(), date(1, 1, 1), loaded_at=0.0)
+
+day_snapshots = metrics.Counter("day_snapshots_published_total", "Day snapshots published, by whether they were loaded on demand or prefetched the day before", ("source",))
+
+class DayCache:
+    """Today's messages for one namespace, double buffered.
+
+    current is the published snapshot and staged is the next day's, prefetched before midnight. Snapshots are built
+    before they are handed over and published with a single reference assignment, so readers never take a lock and
+    always see one whole snapshot, either the old one or the new one.
+    """
+
+    def __init__(self):
+        self.current = EMPTY_DAY
+        self.staged: DaySnapshot | None = None
+
+    def snapshot(self, day: date | None = None) -> DaySnapshot:
+        """The published snapshot. If it isn't for day and the staged one is, the staged one is published first."""
+        current = self.current
+
+        if day is None or current.day == day:
+            return current
+
+        staged = self.staged
+        if staged is not None and staged.day == day:
+            self.publish(staged, "prefetch")
+            return staged
+
+        return current
+
+    def publish(self, snapshot: DaySnapshot, source: str = "load") -> None:
+        # never go back to an earlier day, a slow load could finish after the next day's snapshot was published
+        if snapshot.day < self.current.day:
+            return
+
+        self.current = snapshot
 
-    return message_choice[0]
+        staged = self.staged
+        if staged is not None and staged.day <= snapshot.day:
+            self.staged = None
 
-def getMessage(id: str) -> Message | None:
+        day_snapshots.inc(source)
+
+    def stage(self, snapshot: DaySnapshot) -> None:
+        if snapshot.day > self.current.day:
+            self.staged = snapshot
+
+    def get(self) -> tuple[frozenset[Message], date]:
+        current = self.current
+        return current.messages, current.day
+
+    def find(self, id: str) -> Message | None:
+        return self.current.find(id)
+
+    def set(self, new_messages: set[Message], day: date) -> None:
+        self.publish(DaySnapshot(new_messages, day))
+
+    def choose(self, rng: np.random.Generator | None = None) -> Message:
+        return self.current.choose(rng)
+
+# at most this many namespaces keep a day cache in memory, the least recently used one is dropped to make room and
+# gets loaded again (from the disk cache) the next time it is needed
+MAX_DAY_CACHES = int(os.getenv("MAX_DAY_CACHES", "32"))
+
+day_caches = LRUCache(maxsize=MAX_DAY_CACHES)
+day_caches_lock = threading.Lock()
+
+def dayCache(namespace: str = DEFAULT_NAMESPACE) -> DayCache:
+    with day_caches_lock:
+        cache = day_caches.get(namespace)
+
+        if cache is None:
+            cache = DayCache()
+            day_caches[namespace] = cache
+
+        return cache
+
+def findDayCache(namespace: str = DEFAULT_NAMESPACE) -> DayCache | None:
+    """namespace's day cache, None if it has none. Unlike dayCache() this never adds one, so reading a namespace that
+    isn't loaded can't push out one that is."""
+    with day_caches_lock:
+        return day_caches.get(namespace)
+
+def dayCaches() -> dict[str, DayCache]:
+    with day_caches_lock:
+        return dict(day_caches.items())
+
+metrics.Gauge("day_cache_messages", "Messages in today's day cache", lambda: {(namespace,): len(cache.current.candidates) for namespace, cache in dayCaches().items()}, ("namespace",))
+# nothing to report for a namespace until its first load
+metrics.Gauge("day_cache_age_seconds", "Seconds since today's day cache was loaded", lambda: {(namespace,): time.time() - cache.current.loaded_at for namespace, cache in dayCaches().items() if cache.current.loaded_at > 0}, ("namespace",))
+metrics.Gauge("day_cache_staged", "Whether tomorrow's messages are prefetched and waiting for midnight", lambda: {(namespace,): int(cache.staged is not None) for namespace, cache in dayCaches().items()}, ("namespace",))
+
+# only loading or prefetching a day makes a day cache, everything that reads one takes a missing one as empty
+
+def currentSnapshot(namespace: str = DEFAULT_NAMESPACE) -> DaySnapshot:
+    """namespace's published day snapshot as it is, EMPTY_DAY if nothing was loaded for it."""
+    cache = findDayCache(namespace)
+    return cache.current if cache is not None else EMPTY_DAY
+
+def getMessages(namespace: str = DEFAULT_NAMESPACE) -> tuple[frozenset[Message], date]:
+    snapshot = currentSnapshot(namespace)
+    return snapshot.messages, snapshot.day
+
+def todaysSnapshot(namespace: str = DEFAULT_NAMESPACE, today: date | None = None) -> DaySnapshot:
+    """namespace's published day snapshot, after publishing the prefetched one if the day it was staged for is here."""
+    cache = findDayCache(namespace)
+    if cache is None:
+        return EMPTY_DAY
+
+    return cache.snapshot(getTodaysDate() if today is None else today)
+
+def findTodaysMessage(id: str, namespace: str = DEFAULT_NAMESPACE) -> Message | None:
+    return currentSnapshot(namespace).find(id)
+
+def setTodaysMessages(new_messages: set[Message], day: date, namespace: str = DEFAULT_NAMESPACE) -> None:
+    dayCache(namespace).set(new_messages, day)
+
+def stageMessages(new_messages: set[Message], day: date, namespace: str = DEFAULT_NAMESPACE) -> None:
+    """Keeps a later day's messages ready, they are published the first time that day's messages are asked for."""
+    dayCache(namespace).stage(DaySnapshot(new_messages, day))
+
+def putMessage(message: Message):
+    if len(putMessages([message])) > 0:
+        raise RuntimeError(f"couldn't look up the profiles for message {message.discord_id}")
+
+def putMessages(to_put: list[Message]) -> list[Message]:
+    """Commits to_put in one batch, returns the messages left out because their profiles couldn't be looked up."""
+    # every write for these messages goes out in a single commit, so a batch either lands fully or not at all
+    batch = getDb().batch()
+    profiles = ProfileSync()
+    cached = list[tuple[ProfileCache, str, Channel | Person]]()
+    skipped = list[Message]()
+
+    for message in to_put:
+        # one profile read failing shouldn't hold up every other message in the batch
+        for attempt in range(1, PROFILE_LOOKUP_ATTEMPTS + 1):
+            try:
+                stageMessage(batch, profiles, cached, message)
+                break
+            except Exception as e:
+                if attempt == PROFILE_LOOKUP_ATTEMPTS:
+                    log.warning(f"leaving message {message.discord_id} out of the batch, its profiles couldn't be looked up: {e}")
+                    skipped.append(message)
+
+    # one merged write per person and channel, however many of their messages are in this batch
+    writes = len(to_put) - len(skipped) + profiles.apply(batch)
+
+    if writes > 0:
+        with metrics.firestoreCall("commit"):
+            batch.commit()
+        metrics.firestore_writes.inc("commit", amount=writes)
+
+    # only now is what we staged what firestore holds, a failure before this leaves the caches as they were
+    putCached(cached)
+    return skipped
+
+def stageMessage(batch: firestore.WriteBatch, profiles: ProfileSync, cached: list, message: Message) -> None:
+    namespace = message.namespace()
+
+    stageChannel(profiles, cached, message.channel)
+    stagePerson(profiles, cached, message.sender, namespace)
+
+    log.debug(f"new message from {message.sender.username} in {message.channel.channel_name}: {message.content}")
+    # set rather than create, so a batch that gets retried after a failed commit doesn't trip over itself
+    batch.set(document("messages", message.discord_id, namespace), message.toDict())
+
+def profileKey(namespace: str, discord_id: str) -> str:
+    # people have a profile per server, so the profile caches are keyed by namespace too
+    return namespace + "/" + discord_id
+
+def putCached(cached: list[tuple[ProfileCache, str, Channel | Person]]) -> None:
+    for cache, key, value in cached:
+        cache.put(key, value)
+
+def stageChannel(profiles: ProfileSync, cached: list, channel: Channel) -> None:
+    """Stages channel's write, and adds what the channel cache should hold once it commits to cached."""
+    key = profileKey(namespaceFor(channel.server_id), channel.channel_id)
+    channelref = document("channels", channel.channel_id, namespaceFor(channel.server_id))
+    current = channel_cache.get(key)
+
+    if current is None:
+        channelsnap = getDocument(channelref)
+        if channelsnap.exists:
+            current = loadChannel(channelsnap)
+
+    stored = current.toDict() if current is not None else None
+    profiles.stage(channelref, stored, channel.toDict(), CHANNEL_FIELDS)
+    cached.append((channel_cache, key, channel))
+
+def stagePerson(profiles: ProfileSync, cached: list, person: Person, namespace: str = DEFAULT_NAMESPACE) -> None:
+    """Stages person's write, and adds what the person cache should hold once it commits to cached."""
+    key = profileKey(namespace, person.discord_id)
+    senderref = document("people", person.discord_id, namespace)
+    current = person_cache.get(key)
+
+    if current is None:
+        sendersnap = getDocument(senderref)
+        if sendersnap.exists:
+            current = loadPerson(sendersnap)
+
+    stored = current.toDict() if current is not None else None
+    changes = profiles.stage(senderref, stored, person.toDict(), PERSON_FIELDS)
+    cached.append((person_cache, key, person))
+
+    if stored is None:
+        log.info(f"adding new person {person.username}")
+    elif len(changes) > 0:
+        log.info(f"updating {', '.join(changes)} for {person.username}")
+
+def upsertPerson(person: Person, namespace: str = DEFAULT_NAMESPACE) -> None:
+    profiles = ProfileSync()
+    cached = list[tuple[ProfileCache, str, Channel | Person]]()
+    stagePerson(profiles, cached, person, namespace)
+
+    profiles.commit(getDb())
+    putCached(cached)
+
+def upsertChannel(channel: Channel) -> None:
+    profiles = ProfileSync()
+    cached = list[tuple[ProfileCache, str, Channel | Person]]()
+    stageChannel(profiles, cached, channel)
+
+    profiles.commit(getDb())
+    putCached(cached)
+
+class SharedProfiles:
+    """Hands out one Person or Channel per distinct snapshot, so messages in a result set share them."""
+
+    def __init__(self):
+        self.people = dict[tuple, Person]()
+        self.channels = dict[tuple, Channel]()
+
+    def person(self, data: dict) -> Person:
+        key = tuple(data.get(field) for field in ("discord_id", "username", "nickname", "color", "avatar"))
+        if key not in self.people:
+            self.people[key] = personFromDict(data)
+        return self.people[key]
+
+    def channel(self, data: dict) -> Channel:
+        key = tuple(data.get(field) for field in ("channel_id", "server_id", "server_name", "channel_name", "icon"))
+        if key not in self.channels:
+            self.channels[key] = channelFromDict(data)
+        return self.channels[key]
+
+# turning message documents into Messages, for every schema version. documents from before the sender and channel
+# were stored inline only have references to them, the caller reads those (profileRefs) however suits it and hands
+# the snapshots to decodeMessages
+
+def profileRefs(docsnaps: list[firestore.DocumentSnapshot]) -> list[firestore.DocumentReference]:
+    """The sender and channel references that decoding docsnaps needs read, each once."""
+    refs = dict[str, firestore.DocumentReference]()
+
+    for docsnap in docsnaps:
+        if not hasInlineProfiles(docsnap):
+            for ref in (docsnap.get("sender"), docsnap.get("channel")):
+                refs[ref.path] = ref
+
+    return list(refs.values())
+
+def decodeMessages(docsnaps: list[firestore.DocumentSnapshot], snaps: dict[str, firestore.DocumentSnapshot]) -> list[Message]:
+    """docsnaps as Messages. snaps has the documents profileRefs asked for by path, each distinct sender and channel
+    is only decoded once and shared by its messages."""
+    profiles = SharedProfiles()
+    senders = dict[str, Person]()
+    channels = dict[str, Channel]()
+    by_refs = 0
+    out = []
+
+    for docsnap in docsnaps:
+        inline = inlineProfiles(docsnap, profiles)
+
+        if inline is not None:
+            out.append(buildMessage(docsnap, *inline))
+            continue
+
+        sender_path = docsnap.get("sender").path
+        channel_path = docsnap.get("channel").path
+
+        if sender_path not in senders:
+            senders[sender_path] = loadPerson(snaps[sender_path])
+
+        if channel_path not in channels:
+            channels[channel_path] = loadChannel(snaps[channel_path])
+
+        out.append(buildMessage(docsnap, senders[sender_path], channels[channel_path]))
+        by_refs += 1
+
+    message_profiles.inc("refs", amount=by_refs)
+    message_profiles.inc("inline", amount=len(docsnaps) - by_refs)
+
+    return out
+
+def hasInlineProfiles(docsnap: firestore.DocumentSnapshot) -> bool:
+    try:
+        docsnap.get("sender_snapshot")
+        docsnap.get("channel_snapshot")
+    except KeyError:
+        return False
+
+    return True
+
+def inlineProfiles(docsnap: firestore.DocumentSnapshot, profiles: SharedProfiles | None = None) -> tuple[Person, Channel] | None:
+    """The sender and channel stored in the message document itself, None for a document from before they were."""
     try:
-        return loadMessage(db.document("servers", "pizzeria", "messages", id).get())
-    except:
+        sender = docsnap.get("sender_snapshot")
+        channel = docsnap.get("channel_snapshot")
+    except KeyError:
         return None
 
-def loadMessage(docsnap: firestore.DocumentSnapshot) -> Message:
-    sendsnap: firestore.DocumentSnapshot = docsnap.get("sender").get()
-    chansnap: firestore.DocumentSnapshot = docsnap.get("channel").get()
+    if profiles is None:
+        return personFromDict(sender), channelFromDict(channel)
+
+    return profiles.person(sender), profiles.channel(channel)
+
+def resolveRefs(refs: list[firestore.DocumentReference]) -> dict[str, firestore.DocumentSnapshot]:
+    out = dict[str, firestore.DocumentSnapshot]()
+
+    for i in range(0, len(refs), GET_ALL_CHUNK):
+        with metrics.firestoreCall("get_all"):
+            snaps = list(getDb().get_all(refs[i:i + GET_ALL_CHUNK]))
+        metrics.firestore_reads.inc("get_all", amount=len(snaps))
+
+        for snap in snaps:
+            out[snap.reference.path] = snap
+
+    return out
+
+def getDocument(ref: firestore.DocumentReference) -> firestore.DocumentSnapshot:
+    with metrics.firestoreCall("get"):
+        docsnap = ref.get()
+    metrics.firestore_reads.inc("get")
 
-    sender = loadPerson(sendsnap)
-    channel = loadChannel(chansnap)
+    return docsnap
 
+def buildMessage(docsnap: firestore.DocumentSnapshot, sender: Person, channel: Channel) -> Message:
     content: str = docsnap.get("content")
     ts: datetime = docsnap.get("ts").astimezone(EDT)
     discord_id: str = docsnap.get("discord_id")
@@ -295,6 +675,12 @@ def loadPerson(docsnap: firestore.DocumentSnapshot) -> Person:
 
     return Person(person_username, person_id, person_nickname, person_color, person_avatar)
 
+def personFromDict(data: dict) -> Person:
+    return Person(data["username"], data["discord_id"], data["nickname"], data["color"], data["avatar"])
+
+def channelFromDict(data: dict) -> Channel:
+    return Channel(data["server_name"], data["channel_name"], data["icon"], int(data["channel_id"]), int(data["server_id"]))
+
 def loadChannel(docsnap: firestore.DocumentSnapshot) -> Channel:
     channel_server_name: str = docsnap.get("server_name")
     channel_name: str = docsnap.get("channel_name")
@@ -304,41 +690,11 @@ def loadChannel(docsnap: firestore.DocumentSnapshot) -> Channel:
 
     return Channel(channel_server_name, channel_name, channel_icon, int(channel_id), int(channel_server_id))
 
-def updateTodaysMessages() -> None:
-    global tm_lock
-    with tm_lock.gen_wlock():
-        global todays_messages
-        global date_of_todays_messages
-
-        if date_of_todays_messages == getTodaysDate():
-            return
-
-        today = getTodaysDate()
-        todays_messages = set[Message]()
-        date_of_todays_messages = today
-
-        log.info("updating today's messages")
-
-        for year in range(2020, today.year):
-            start = datetime(year, today.month, today.day, 0, 0, 0, 0, EDT)
-            end = datetime(year, today.month, today.day, 23, 59, 59, 999999, EDT)
-
-            query = messages.where(filter=firestore.FieldFilter("ts", ">=", start)).where(filter=firestore.FieldFilter("ts", "<=", end)).limit(1000)
-
-            docs = query.get()
-            log.info(f"found {len(docs)} messages for year {year}")
-
-            for doc in docs:
-                docobj = loadMessage(doc)
-                todays_messages.add(docobj)
-            
-            log.info(f"finished loading messages for year {year}")
-        log.info("finished updating today's messages")
+def monthDay(ts: datetime) -> tuple[int, int]:
+    """month * 100 + day and the year, of the day ts falls on in EDT."""
+    local = ts.astimezone(EDT)
+    return local.month * 100 + local.day, local.year
 
 def getTodaysDate() -> date:
     now = datetime.now(EDT)
-    return date.fromtimestamp(now.timestamp())
-
-log.info("initializing message cache")
-updateTodaysMessages()
-log.info("message reader ready")
\ No newline at end of file
+    return date.fromtimestamp(now.timestamp())
\ No newline at end of file
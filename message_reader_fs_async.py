@@ -0,0 +1,151 @@
+import asyncio
+from datetime import datetime, date
+from google.cloud import firestore
+import logging as log
+import message_reader_fs as mr
+import metrics
+import day_cache
+
+# the read side of message_reader_fs on firestore's AsyncClient, so the bot never blocks the event loop on a read.
+# the day cache itself lives in message_reader_fs and is refreshed through storage_backend.
+
+db: firestore.AsyncClient | None = None
+
+def getDb() -> firestore.AsyncClient:
+    global db
+
+    if db is None:
+        credentials, project = mr.getCredentials()
+        db = firestore.AsyncClient(project=project, credentials=credentials)
+
+    return db
+
+day_query_seconds = metrics.Histogram("day_query_seconds", "Time to fetch a day's messages, by whether the cache was cold or only asked for newer messages", ("kind",))
+day_cache_years = metrics.Counter("day_cache_years_total", "Years of today's messages by where they came from", ("source",))
+
+async def getMessage(id: str, namespace: str = mr.DEFAULT_NAMESPACE) -> mr.Message | None:
+    """The message with this id, None if there is no such message. Errors talking to firestore are raised."""
+    docsnap = await getDocument(getDb().document("servers", namespace, "messages", id))
+
+    if not docsnap.exists:
+        return None
+
+    return await loadMessage(docsnap)
+
+async def loadDay(today: date, namespace: str = mr.DEFAULT_NAMESPACE) -> list[mr.Message]:
+    """Loads every message sent on today's month and day in past years.
+
+    The disk cache keeps one bucket per year, and a past year's messages on a given day only change if something
+    is uploaded late. The years from 2020 on that are all in the cache are used as they are and only messages
+    newer than the newest one in them are asked for, which covers the first year the cache doesn't have (like last
+    year, the first time a day comes around again) and anything uploaded late. This year's messages are never read.
+    It's one query either way, so it costs reads in proportion to the messages it finds.
+    """
+    years = list(range(2020, today.year))
+    buckets = await asyncio.to_thread(day_cache.readBuckets, years, today, namespace)
+    month_day = today.month * 100 + today.day
+
+    # the cached years up to the first one that's missing, everything after is fetched again
+    cached = list[int]()
+    for year in years:
+        if buckets[year] is None:
+            break
+        cached.append(year)
+
+    after = day_cache.lastTs([message for year in cached for message in buckets[year]])
+    # today's own messages share the month_day but aren't memories yet
+    before = mr.EDT.localize(datetime(today.year, 1, 1))
+
+    with day_query_seconds.time("cold" if after is None else "revalidate"):
+        docs = await fetchDay(month_day, before, namespace, after)
+
+    day_cache_years.inc("disk", amount=len(cached))
+    day_cache_years.inc("firestore", amount=len(years) - len(cached))
+
+    loaded = await loadMessages(docs)
+
+    fetched = dict[int, list[mr.Message]]()
+    for docsnap, message in zip(docs, loaded):
+        year = docsnap.get("year")
+        if year not in fetched:
+            fetched[year] = list[mr.Message]()
+        fetched[year].append(message)
+
+    for year in years:
+        if year not in cached:
+            buckets[year] = fetched.get(year, list[mr.Message]())
+        elif year in fetched:
+            buckets[year] = day_cache.mergeBucket(buckets[year], fetched[year])
+        else:
+            continue
+
+        await asyncio.to_thread(day_cache.writeBucket, year, today, buckets[year], namespace)
+
+    out = []
+    for year in years:
+        out.extend(buckets[year])
+
+    log.info(f"read {len(docs)} messages from firestore, {len(cached)} of {len(years)} years came from the day cache")
+
+    return out
+
+async def fetchDay(month_day: int, before: datetime, namespace: str = mr.DEFAULT_NAMESPACE, after: datetime | None = None) -> list[firestore.DocumentSnapshot]:
+    """Every message on month_day sent before before, and after after if it's given.
+
+    Needs a composite index on messages (month_day ascending, ts ascending).
+    """
+    query = getDb().collection("servers", namespace, "messages").where(filter=firestore.FieldFilter("month_day", "==", month_day))
+    query = query.where(filter=firestore.FieldFilter("ts", "<", before))
+
+    if after is not None:
+        query = query.where(filter=firestore.FieldFilter("ts", ">", after))
+
+    return await fetchAll(query.order_by("ts").limit(mr.PAGE_SIZE))
+
+async def fetchAll(query: firestore.AsyncQuery) -> list[firestore.DocumentSnapshot]:
+    docs = []
+    cursor = None
+
+    while True:
+        page_query = query if cursor is None else query.start_after(cursor)
+        with metrics.firestoreCall("query"):
+            page = await page_query.get()
+        metrics.firestore_reads.inc("query", amount=len(page))
+        docs.extend(page)
+
+        if len(page) < mr.PAGE_SIZE:
+            return docs
+
+        cursor = page[-1]
+
+async def loadMessage(docsnap: firestore.DocumentSnapshot) -> mr.Message:
+    return (await loadMessages([docsnap]))[0]
+
+async def loadMessages(docsnaps: list[firestore.DocumentSnapshot]) -> list[mr.Message]:
+    # documents with inline snapshots need no more reads, only the older ones have their references resolved
+    snaps = await resolveRefs(mr.profileRefs(docsnaps))
+    return mr.decodeMessages(docsnaps, snaps)
+
+async def resolveRefs(refs: list[firestore.AsyncDocumentReference]) -> dict[str, firestore.DocumentSnapshot]:
+    async def resolveChunk(chunk: list[firestore.AsyncDocumentReference]) -> list[firestore.DocumentSnapshot]:
+        with metrics.firestoreCall("get_all"):
+            snaps = [snap async for snap in getDb().get_all(chunk)]
+        metrics.firestore_reads.inc("get_all", amount=len(snaps))
+
+        return snaps
+
+    chunks = [refs[i:i + mr.GET_ALL_CHUNK] for i in range(0, len(refs), mr.GET_ALL_CHUNK)]
+    out = dict[str, firestore.DocumentSnapshot]()
+
+    for snaps in await asyncio.gather(*[resolveChunk(chunk) for chunk in chunks]):
+        for snap in snaps:
+            out[snap.reference.path] = snap
+
+    return out
+
+async def getDocument(ref: firestore.AsyncDocumentReference) -> firestore.DocumentSnapshot:
+    with metrics.firestoreCall("get"):
+        docsnap = await ref.get()
+    metrics.firestore_reads.inc("get")
+
+    return docsnap
\ No newline at end of file
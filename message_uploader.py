@@ -1,7 +1,15 @@
 from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, BulkWriteFailure, BulkWriter, SendMode
 import google.auth as auth
 import datetime as dt
+import argparse
+import hashlib
+import json
+import os
+import time
 import message_reader as mr
+from message_reader_fs import SCHEMA_VERSION, monthDay
+from profile_sync import ProfileSync, PERSON_FIELDS, CHANNEL_FIELDS
 
 creds, project_id = auth.load_credentials_from_file("service-account-auth.json")
 
@@ -12,6 +20,15 @@ channels = db.collection("servers", "pizzeria", "channels")
 people = db.collection("servers", "pizzeria", "people")
 messages = db.collection("servers", "pizzeria", "messages")
 
+# each get_all call is one BatchGetDocuments rpc, this keeps the requests a reasonable size
+GET_ALL_CHUNK = 300
+
+CHECKPOINT_FILE = "upload_checkpoint.json"
+MANIFEST_FILE = "upload_manifest.json"
+
+# how many times the bulk writer retries a single failed write before we give up on the run
+MAX_ATTEMPTS = 10
+
 def channelToDict(channel: mr.Channel) -> dict[str, str]:
     out = dict()
 
@@ -37,10 +54,15 @@ def personToDict(person: mr.Person) -> dict[str, str]:
 def messageToDict(message: mr.Message) -> dict[str, str]:
     out = dict()
 
+    # the same layout as message_reader_fs.Message.toDict
+    out["schema"] = SCHEMA_VERSION
     out["sender"] = db.document("servers", "pizzeria", "people", message.sender.discord_id)
     out["channel"] = db.document("servers", "pizzeria", "channels", message.channel.channel_id)
+    out["sender_snapshot"] = personToDict(message.sender)
+    out["channel_snapshot"] = channelToDict(message.channel)
     out["content"] = message.content
     out["ts"] = message.ts
+    out["month_day"], out["year"] = monthDay(message.ts)
     out["discord_id"] = message.discord_id
 
     attachments = []
@@ -57,83 +79,226 @@ def messageToDict(message: mr.Message) -> dict[str, str]:
 
     return out
 
-def loadPerson(docsnap: firestore.DocumentSnapshot) -> mr.Person:
-    person_username: str = docsnap.get("username")
-    person_id: str = docsnap.get("discord_id")
-    person_nickname: str = docsnap.get("nickname")
-    person_color: str = docsnap.get("color")
-    person_avatar: str = docsnap.get("avatar")
+def syncProfiles(kind: str, collection: firestore.CollectionReference, items: dict, toDict, fields: tuple[str, ...]) -> None:
+    """Brings every person or channel in items up to date in firestore.
 
-    return mr.Person(person_username, person_id, person_nickname, person_color, person_avatar)
+    The stored documents are read with a few get_all calls, and each entity gets at most one merged write
+    covering only the fields that matter. All of the writes go out in as few batch commits as possible.
+    """
+    ids = list(items)
+    refs = [collection.document(doc_id) for doc_id in ids]
+    stored = dict[str, dict | None]()
 
-def loadChannel(docsnap: firestore.DocumentSnapshot) -> mr.Channel:
-    channel_server_name: str = docsnap.get("server_name")
-    channel_name: str = docsnap.get("channel_name")
-    channel_icon: str = docsnap.get("icon")
-    channel_id: str = docsnap.get("channel_id")
-    channel_server_id: str = docsnap.get("server_id")
+    for i in range(0, len(refs), GET_ALL_CHUNK):
+        for snap in db.get_all(refs[i:i + GET_ALL_CHUNK]):
+            stored[snap.id] = snap.to_dict() if snap.exists else None
 
-    return mr.Channel(channel_server_name, channel_name, channel_icon, int(channel_id), int(channel_server_id))
+    profiles = ProfileSync()
 
-print("uploading channels")
+    for doc_id, ref in zip(ids, refs):
+        profiles.stage(ref, stored.get(doc_id), toDict(items[doc_id]), fields)
 
-for channel_id in mr.channels:
-    channel = mr.channels[channel_id]
-    print(f"found channel {channel.channel_name}")
+    written = profiles.commit(db)
+    print(f"{written} of {len(ids)} {kind} needed a write")
 
-    channelref = db.document("servers", "pizzeria", "channels", channel_id)
-    channelsnap = channelref.get()
+def uploadChannels() -> None:
+    print("uploading channels")
+    syncProfiles("channels", channels, mr.channels, channelToDict, CHANNEL_FIELDS)
 
-    if channelsnap.exists:
-        # we only check icon, channel_name, and server_name since its the only things that would change
-        loadedchannel = loadChannel(channelsnap)
+def uploadPeople() -> None:
+    print("uploading people")
+    syncProfiles("people", people, mr.people, personToDict, PERSON_FIELDS)
 
-        if channel.channel_name != loadedchannel.channel_name:
-            channelref.update({"channel_name": channel.channel_name})
-        
-        if channel.server_name != loadedchannel.server_name:
-            channelref.update({"server_name": channel.server_name})
+def readCheckpoint(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
 
-        if channel.icon != loadedchannel.icon:
-            channelref.update({"icon": channel.icon})
-    else:
-        channel_dict = channelToDict(channel)
-        channels.add(channel_dict, channel_id)
+    with open(path, "r") as checkpoint_file:
+        return int(json.load(checkpoint_file)["last_message_id"])
 
-print("uploading people")
+def writeCheckpoint(path: str, last_message_id: int) -> None:
+    tmp_path = path + ".tmp"
 
-for person_id in mr.people:
-    person = mr.people[person_id]
-    print(f"found person {person.username}")
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump({"last_message_id": str(last_message_id)}, checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
 
-    senderref = db.document("servers", "pizzeria", "people", person_id)
-    sendersnap = senderref.get()
-    
-    if sendersnap.exists:
-        # we only check nickname, avatar, and color since those change
-        loadedperson = loadPerson(sendersnap)
+    # a crash mid-write leaves the previous checkpoint in place
+    os.replace(tmp_path, path)
 
-        if person.nickname != loadedperson.nickname:
-            senderref.update({"nickname": person.nickname})
-        
-        if person.avatar != loadedperson.avatar:
-            senderref.update({"avatar": person.avatar})
-        
-        if person.color != loadedperson.color:
-            senderref.update({"color": person.color})
-    else:
-        person_dict = personToDict(person)
-        people.add(person_dict, person_id)
-
-print("uploading messages (this will take a while!)")
-message_count = len(mr.messages)
-
-for i, message_id in enumerate(mr.messages):
-    message = mr.messages[message_id]
-    if i % 1000 == 0:
-        print(f"uploading message {i}/{message_count}")
-
-    message_dict = messageToDict(message)
-    messages.add(message_dict, message_id)
+def makeWriter(options: BulkWriterOptions) -> tuple[BulkWriter, list[BulkWriteFailure]]:
+    failures = list[BulkWriteFailure]()
+
+    def onWriteError(error: BulkWriteFailure, writer: BulkWriter) -> bool:
+        if error.attempts < MAX_ATTEMPTS:
+            return True
+
+        failures.append(error)
+        return False
+
+    writer = db.bulk_writer(options)
+    writer.on_write_error(onWriteError)
+
+    return writer, failures
+
+def flushOrFail(writer: BulkWriter, failures: list[BulkWriteFailure]) -> None:
+    writer.flush()
+
+    if len(failures) > 0:
+        writer.close()
+        raise RuntimeError(f"{len(failures)} writes failed (first: {failures[0].message}), rerun to resume from the last checkpoint")
+
+def uploadMessages(options: BulkWriterOptions, chunk_size: int, checkpoint_path: str) -> None:
+    """Uploads every message through a BulkWriter, in id order and chunk by chunk.
+
+    After each chunk is flushed the last id in it goes to the checkpoint file, so an interrupted run picks up
+    after the last chunk that fully made it. Messages are written with set, so resending one is harmless.
+    """
+    print("uploading messages (this will take a while!)")
+
+    last_done = readCheckpoint(checkpoint_path)
+    # mr.messages is keyed by int ids
+    all_ids = sorted(mr.messages)
+    remaining = [message_id for message_id in all_ids if message_id > last_done]
+
+    if len(remaining) < len(all_ids):
+        print(f"resuming from checkpoint, {len(all_ids) - len(remaining)} messages already uploaded")
+
+    writer, failures = makeWriter(options)
+
+    start = time.perf_counter()
+    uploaded = 0
+
+    for chunk_start in range(0, len(remaining), chunk_size):
+        chunk = remaining[chunk_start:chunk_start + chunk_size]
+
+        for message_id in chunk:
+            writer.set(messages.document(str(message_id)), messageToDict(mr.messages[message_id]))
+
+        flushOrFail(writer, failures)
+
+        writeCheckpoint(checkpoint_path, chunk[-1])
+
+        uploaded += len(chunk)
+        elapsed = time.perf_counter() - start
+        rate = uploaded / elapsed
+        eta = dt.timedelta(seconds=int((len(remaining) - uploaded) / rate))
+        print(f"uploaded {len(all_ids) - len(remaining) + uploaded}/{len(all_ids)} messages, {rate:.0f} messages/s, eta {eta}")
+
+    writer.close()
+
+def documentHash(data: dict) -> str:
+    return hashlib.blake2b(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8"), digest_size=8).hexdigest()
+
+def messageHashDict(message: mr.Message) -> dict:
+    # messageToDict holds document references, hash what they point at instead. the snapshots are left out so a
+    # nickname change doesn't rewrite every message that person sent, backfill_schema.py migrates old documents
+    out = dict()
+
+    out["sender"] = message.sender.discord_id
+    out["channel"] = message.channel.channel_id
+    out["content"] = message.content
+    out["ts"] = message.ts.isoformat()
+    out["discord_id"] = message.discord_id
+    out["attachments"] = [[attachment.url, attachment.name] for attachment in message.attachments]
+
+    return out
+
+def readManifest(path: str) -> dict[str, dict[str, str]]:
+    if not os.path.exists(path):
+        return {"channels": dict(), "people": dict(), "messages": dict()}
+
+    with open(path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+def writeManifest(path: str, manifest: dict[str, dict[str, str]]) -> None:
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+    os.replace(tmp_path, path)
+
+def syncArchive(options: BulkWriterOptions, chunk_size: int, manifest_path: str) -> None:
+    """Uploads only the channels, people and messages whose content changed since the last sync.
+
+    The manifest keeps a content hash of every document this machine uploaded. Changed messages are written
+    with set and changed people and channels go through syncProfiles, so a sync costs writes in proportion to
+    what changed in the export. The manifest is saved after every flushed chunk, which doubles as the resume
+    point for an interrupted sync.
+    """
+    manifest = readManifest(manifest_path)
+
+    def changedSince(kind: str, items: dict, hashDict) -> list[tuple]:
+        known = manifest[kind]
+        changed = list[tuple]()
+
+        # the manifest is json so its keys are str, mr.messages is keyed by int
+        for doc_id in items:
+            doc_hash = documentHash(hashDict(items[doc_id]))
+            if known.get(str(doc_id)) != doc_hash:
+                changed.append((doc_id, doc_hash))
+
+        print(f"{len(changed)} of {len(items)} {kind} are new or changed")
+        return changed
+
+    # people and channels are few, they go through the field diff so a change that doesn't matter costs nothing
+    for kind, collection, items, toDict, fields in [("channels", channels, mr.channels, channelToDict, CHANNEL_FIELDS), ("people", people, mr.people, personToDict, PERSON_FIELDS)]:
+        changed = changedSince(kind, items, toDict)
+
+        syncProfiles(kind, collection, {doc_id: items[doc_id] for doc_id, _ in changed}, toDict, fields)
+
+        for doc_id, doc_hash in changed:
+            manifest[kind][doc_id] = doc_hash
+        writeManifest(manifest_path, manifest)
+
+    changed = changedSince("messages", mr.messages, messageHashDict)
+    writer, failures = makeWriter(options)
+    start = time.perf_counter()
+
+    for chunk_start in range(0, len(changed), chunk_size):
+        chunk = changed[chunk_start:chunk_start + chunk_size]
+
+        for doc_id, _ in chunk:
+            writer.set(messages.document(str(doc_id)), messageToDict(mr.messages[doc_id]))
+
+        flushOrFail(writer, failures)
+
+        for doc_id, doc_hash in chunk:
+            manifest["messages"][str(doc_id)] = doc_hash
+        writeManifest(manifest_path, manifest)
+
+        synced = chunk_start + len(chunk)
+        rate = synced / (time.perf_counter() - start)
+        print(f"synced {synced}/{len(changed)} messages, {rate:.0f}/s")
+
+    writer.close()
+
+parser = argparse.ArgumentParser(description="Uploads the local messages2 archive to firestore")
+parser.add_argument("--initial-ops", type=int, default=500, help="writes per second the bulk writer starts at")
+parser.add_argument("--max-ops", type=int, default=5000, help="writes per second the bulk writer ramps up to")
+parser.add_argument("--serial", action="store_true", help="send one batch at a time instead of several in parallel")
+parser.add_argument("--chunk", type=int, default=5000, help="messages flushed between checkpoints")
+parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="file that records how far the upload got")
+parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and upload everything again")
+parser.add_argument("--sync", action="store_true", help="only upload what changed since the last sync, according to the manifest")
+parser.add_argument("--manifest", default=MANIFEST_FILE, help="content hashes of everything uploaded by --sync")
+args = parser.parse_args()
+
+# the bulk writer ramps from initial to max ops by 50% every 5 minutes, following firestore's 500/50/5 rule
+options = BulkWriterOptions(initial_ops_per_second=args.initial_ops, max_ops_per_second=args.max_ops, mode=SendMode.serial if args.serial else SendMode.parallel)
+
+if args.sync:
+    syncArchive(options, args.chunk, args.manifest)
+else:
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    uploadChannels()
+    uploadPeople()
+    uploadMessages(options, args.chunk, args.checkpoint)
 
 db.close()
\ No newline at end of file
@@ -0,0 +1,268 @@
+import asyncio
+import json
+import os
+import time
+import logging as log
+from datetime import datetime
+from typing import Callable
+import message_reader_fs as mr
+
+# a firestore batch holds at most 500 writes, and one message stages at most 3 of them (message, person, channel)
+MAX_BATCH = 150
+
+# messages that couldn't be committed or put back on the queue wait here for the next start
+SPILL_FILE = os.getenv("WRITE_SPILL", "write_spill.jsonl")
+
+class MessageWriter:
+    """Write-behind queue between the discord event loop and firestore.
+
+    on_message only has to enqueue, a background worker drains the queue into batched commits.
+    """
+
+    def __init__(self, max_batch: int = MAX_BATCH, flush_interval: float = 1.0, max_queue: int = 1000,
+                 max_retries: int = 5, backoff: float = 0.5, report_interval: float = 300, spill_file: str = SPILL_FILE,
+                 on_commit: Callable[[list[mr.Message]], None] | None = None):
+        self.max_batch = min(max_batch, MAX_BATCH)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.report_interval = report_interval
+        self.spill_file = spill_file
+        # told about every message once it is in firestore
+        self.on_commit = on_commit
+
+        # a bounded queue is the backpressure, enqueue waits once it fills up
+        self.queue = asyncio.Queue[mr.Message | None](maxsize=max_queue)
+        # messages that failed to commit, they go out with the next batch ahead of the queue
+        self.retry = list[mr.Message]()
+        self.max_retry = max_queue
+        self.worker: asyncio.Task | None = None
+        # set for the last pass over the queue at stop, anything failing then goes to the spill file
+        self.draining = False
+
+        # totals since start, these are exported
+        self.committed = 0
+        self.requeued = 0
+        self.spilled = 0
+        self.commits = 0
+        self.commit_time = 0.0
+        self.max_commit_time = 0.0
+        # since the last report, only for the log line
+        self.interval_commits = 0
+        self.interval_commit_time = 0.0
+        self.interval_max_commit_time = 0.0
+        self.last_report = time.monotonic()
+
+    def start(self) -> None:
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.run())
+
+    async def enqueue(self, message: mr.Message) -> None:
+        await self.queue.put(message)
+
+    async def stop(self, timeout: float = 30) -> None:
+        """Flushes everything still queued and stops the worker."""
+        if self.worker is None:
+            return
+
+        log.info(f"flushing {self.queue.qsize()} queued messages")
+        await self.queue.put(None)
+
+        try:
+            await asyncio.wait_for(self.worker, timeout)
+        except asyncio.TimeoutError:
+            log.error(f"gave up flushing the write queue with {self.queue.qsize()} messages left")
+
+        self.worker = None
+
+    async def run(self) -> None:
+        self.draining = False
+        stopping = False
+        spilled = await asyncio.to_thread(self.readSpill)
+
+        # what the last run couldn't write goes out first
+        for i in range(0, len(spilled), self.max_batch):
+            await self.commit(spilled[i:i + self.max_batch])
+
+        while not stopping:
+            batch, stopping = await self.collect()
+
+            if len(batch) > 0:
+                await self.commit(batch)
+
+            self.report()
+
+        # whatever still failed gets one last try before it is spilled
+        self.draining = True
+        leftover = self.retry
+        self.retry = []
+
+        for i in range(0, len(leftover), self.max_batch):
+            await self.commit(leftover[i:i + self.max_batch])
+
+    async def collect(self) -> tuple[list[mr.Message], bool]:
+        loop = asyncio.get_running_loop()
+
+        batch = self.retry[:self.max_batch]
+        del self.retry[:self.max_batch]
+
+        if len(batch) == 0:
+            first = await self.queue.get()
+            if first is None:
+                return [], True
+
+            batch.append(first)
+
+        deadline = loop.time() + self.flush_interval
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+
+            try:
+                message = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+
+            if message is None:
+                return batch, True
+
+            batch.append(message)
+
+        return batch, False
+
+    async def commit(self, batch: list[mr.Message]) -> None:
+        delay = self.backoff
+
+        for attempt in range(1, self.max_retries + 1):
+            start = time.perf_counter()
+
+            try:
+                # the firestore client blocks, so the commit runs off the event loop
+                skipped = await asyncio.to_thread(mr.putMessages, batch)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    log.error(f"putting {len(batch)} messages back after {attempt} failed commits: {e}")
+                    await self.retryLater(batch)
+                    return
+
+                log.warning(f"commit of {len(batch)} messages failed (attempt {attempt}), retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+            else:
+                elapsed = time.perf_counter() - start
+                self.committed += len(batch) - len(skipped)
+                self.commits += 1
+                self.commit_time += elapsed
+                self.max_commit_time = max(self.max_commit_time, elapsed)
+                self.interval_commits += 1
+                self.interval_commit_time += elapsed
+                self.interval_max_commit_time = max(self.interval_max_commit_time, elapsed)
+                log.debug(f"committed {len(batch) - len(skipped)} messages in {elapsed * 1000:.1f}ms")
+
+                if len(skipped) > 0:
+                    await self.retryLater(skipped)
+
+                if self.on_commit is not None:
+                    self.on_commit(committedOf(batch, skipped))
+                return
+
+    async def retryLater(self, messages: list[mr.Message]) -> None:
+        """Keeps messages for the next batch, or puts them in the spill file once too many wait or the writer is stopping."""
+        room = 0 if self.draining else max(self.max_retry - len(self.retry), 0)
+        self.retry.extend(messages[:room])
+        self.requeued += len(messages[:room])
+        spill = messages[room:]
+
+        if len(spill) > 0:
+            await asyncio.to_thread(self.writeSpill, spill)
+
+    def writeSpill(self, messages: list[mr.Message]) -> None:
+        try:
+            with open(self.spill_file, "a") as spill_file:
+                for message in messages:
+                    spill_file.write(json.dumps(spillRecord(message)) + "\n")
+        except OSError as e:
+            log.error(f"lost {len(messages)} messages, couldn't write them to {self.spill_file}: {e}")
+            return
+
+        self.spilled += len(messages)
+        log.warning(f"saved {len(messages)} messages to {self.spill_file} to write on the next start")
+
+    def readSpill(self) -> list[mr.Message]:
+        if not os.path.exists(self.spill_file):
+            return []
+
+        out = []
+
+        try:
+            with open(self.spill_file, "r") as spill_file:
+                for line in spill_file:
+                    if line.strip() != "":
+                        out.append(loadSpilled(json.loads(line)))
+        except (OSError, ValueError, KeyError) as e:
+            log.error(f"ignoring unreadable spill file {self.spill_file}: {e}")
+            return []
+
+        # they are only in memory from here on, a failure puts them back in the file
+        os.remove(self.spill_file)
+        log.info(f"writing {len(out)} messages saved by the last run")
+
+        return out
+
+    def stats(self) -> dict[str, float]:
+        out = dict()
+
+        out["queue_depth"] = self.queue.qsize() + len(self.retry)
+        out["committed"] = self.committed
+        out["requeued"] = self.requeued
+        out["spilled"] = self.spilled
+        out["commits"] = self.commits
+        out["avg_commit_ms"] = self.commit_time / self.commits * 1000 if self.commits > 0 else 0
+        out["max_commit_ms"] = self.max_commit_time * 1000
+
+        return out
+
+    def report(self) -> None:
+        now = time.monotonic()
+        if now - self.last_report < self.report_interval:
+            return
+
+        stats = self.stats()
+        avg_commit_ms = self.interval_commit_time / self.interval_commits * 1000 if self.interval_commits > 0 else 0
+        log.info(f"write queue depth {stats['queue_depth']}, {self.interval_commits} commits since last report, "
+                 f"{stats['committed']} messages committed in total, commit latency avg {avg_commit_ms:.1f}ms max {self.interval_max_commit_time * 1000:.1f}ms, {stats['requeued']} put back, {stats['spilled']} saved to disk")
+
+        cache = mr.cacheStats()
+        log.info(f"profile cache hits/misses: people {cache['person_hits']}/{cache['person_misses']}, channels {cache['channel_hits']}/{cache['channel_misses']}")
+
+        self.interval_commit_time = 0.0
+        self.interval_commits = 0
+        self.interval_max_commit_time = 0.0
+        self.last_report = now
+
+def committedOf(batch: list[mr.Message], skipped: list[mr.Message]) -> list[mr.Message]:
+    if len(skipped) == 0:
+        return batch
+
+    left_out = set(map(id, skipped))
+    return [message for message in batch if id(message) not in left_out]
+
+def spillRecord(message: mr.Message) -> dict:
+    out = dict()
+
+    out["sender"] = message.sender.toDict()
+    out["channel"] = message.channel.toDict()
+    out["content"] = message.content
+    out["ts"] = message.ts.isoformat()
+    out["discord_id"] = message.discord_id
+    out["attachments"] = [{"url": attachment.url, "name": attachment.name} for attachment in message.attachments]
+
+    return out
+
+def loadSpilled(record: dict) -> mr.Message:
+    attachments = [mr.Attachment(attachment["url"], attachment["name"]) for attachment in record["attachments"]]
+
+    return mr.Message(mr.personFromDict(record["sender"]), mr.channelFromDict(record["channel"]), record["content"],
+                      datetime.fromisoformat(record["ts"]), record["discord_id"], attachments)
\ No newline at end of file
@@ -0,0 +1,194 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+from aiohttp import web
+import logging as log
+
+# counters, latency histograms and gauges for the hot paths, served in prometheus text format on a local port
+# (METRICS_PORT, 9100 by default) and summarized by $stats. everything here is safe to update from any thread.
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# seconds, from a cache hit to a slow multi-year day load
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry = list["Metric"]()
+
+def labelText(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra != "":
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+    def samples(self) -> list[str]:
+        return []
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values = dict[tuple[str, ...], float]()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        with self.lock:
+            return self.values.get(label_values, 0)
+
+    def total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            return [f"{self.name}{labelText(self.labels, values)} {value}" for values, value in self.values.items()]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label values: count in each bucket (not cumulative, the last one is +Inf), sum and count
+        self.values = dict[tuple[str, ...], tuple[list[int], list[float]]]()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+
+            counts, totals = self.values[label_values]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @contextmanager
+    def time(self, *label_values: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def summary(self) -> dict[tuple[str, ...], tuple[int, float, float]]:
+        """(count, mean, approximate p99) in seconds for each set of label values."""
+        out = dict()
+
+        with self.lock:
+            for label_values, (counts, (total, count)) in self.values.items():
+                out[label_values] = (count, total / count if count > 0 else 0.0, self.quantile(counts, count, 0.99))
+
+        return out
+
+    def quantile(self, counts: list[int], count: int, q: float) -> float:
+        # the upper bound of the bucket the quantile falls in
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= q * count:
+                return bound
+
+        return float("inf")
+
+    def samples(self) -> list[str]:
+        out = []
+
+        with self.lock:
+            for label_values, (counts, (total, count)) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                    out.append(f"{self.name}_bucket{labelText(self.labels, label_values, le)} {cumulative}")
+
+                out.append(f"{self.name}_sum{labelText(self.labels, label_values)} {total}")
+                out.append(f"{self.name}_count{labelText(self.labels, label_values)} {count}")
+
+        return out
+
+class Gauge(Metric):
+    """A value read when the metrics are scraped. read returns a number, or a dict of label values to numbers.
+
+    kind can be "counter" for a count that something else already keeps.
+    """
+
+    def __init__(self, name: str, help: str, read: Callable, labels: tuple[str, ...] = (), kind: str = "gauge"):
+        super().__init__(name, help, labels)
+        self.read = read
+        self.kind = kind
+
+    def samples(self) -> list[str]:
+        try:
+            value = self.read()
+        except Exception as e:
+            log.warning(f"couldn't read gauge {self.name}: {e}")
+            return []
+
+        if isinstance(value, dict):
+            return [f"{self.name}{labelText(self.labels, label_values)} {number}" for label_values, number in value.items()]
+
+        return [f"{self.name} {value}"]
+
+# firestore. reads and writes are counted per document since that's what gets billed
+firestore_seconds = Histogram("firestore_rpc_seconds", "Latency of firestore rpcs", ("op",))
+firestore_errors = Counter("firestore_rpc_errors_total", "Firestore rpcs that raised", ("op",))
+firestore_reads = Counter("firestore_documents_read_total", "Documents read from firestore", ("op",))
+firestore_writes = Counter("firestore_documents_written_total", "Documents written to firestore", ("op",))
+
+@contextmanager
+def firestoreCall(op: str):
+    """Times one firestore rpc and counts it as an error if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        firestore_errors.inc(op)
+        raise
+    finally:
+        firestore_seconds.observe(time.perf_counter() - start, op)
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+async def handleMetrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+async def serve(host: str = METRICS_HOST, port: int = METRICS_PORT) -> web.AppRunner:
+    """Starts serving /metrics, returns the runner to clean up with."""
+    app = web.Application()
+    app.router.add_get("/metrics", handleMetrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    log.info(f"serving metrics on http://{host}:{port}/metrics")
+    return runner
\ No newline at end of file
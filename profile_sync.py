@@ -0,0 +1,90 @@
+from google.cloud import firestore
+import metrics
+import logging as log
+
+# the only fields worth a write when they change. ids never change, and a different username on its own
+# isn't worth the write either
+PERSON_FIELDS = ("nickname", "avatar", "color")
+CHANNEL_FIELDS = ("channel_name", "server_name", "icon")
+
+# firestore caps a batch at 500 writes
+MAX_BATCH_WRITES = 500
+
+def diffFields(stored: dict, desired: dict, fields: tuple[str, ...]) -> dict:
+    out = dict()
+
+    for field in fields:
+        if stored.get(field) != desired[field]:
+            out[field] = desired[field]
+
+    return out
+
+class ProfileSync:
+    """Collects person and channel writes so that every entity gets at most one merged write.
+
+    stage() diffs what we want against what is stored, apply() puts the pending writes into a batch and
+    commit() sends them all in as few batches as possible.
+    """
+
+    def __init__(self):
+        self.pending = dict[str, tuple[firestore.DocumentReference, dict, bool]]()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def stage(self, ref: firestore.DocumentReference, stored: dict | None, desired: dict, fields: tuple[str, ...]) -> dict:
+        """Stages the write that takes ref from stored (None if it doesn't exist) to desired, returns the changed fields."""
+        pending = self.pending.get(ref.path)
+
+        if pending is not None:
+            # a write is already pending for this entity, fold the new changes into it
+            _, data, merge = pending
+            current = {**(stored or dict()), **data} if merge else data
+
+            changes = diffFields(current, desired, fields)
+            data.update(changes)
+            return changes
+
+        if stored is None:
+            self.pending[ref.path] = (ref, dict(desired), False)
+            return dict(desired)
+
+        changes = diffFields(stored, desired, fields)
+
+        if len(changes) > 0:
+            self.pending[ref.path] = (ref, changes, True)
+
+        return changes
+
+    def apply(self, batch: firestore.WriteBatch) -> int:
+        """Puts every pending write into batch, returns how many there were."""
+        writes = list(self.pending.values())
+        self.pending.clear()
+
+        stageWrites(batch, writes)
+        return len(writes)
+
+    def commit(self, db: firestore.Client) -> int:
+        """Commits everything pending in batches of up to MAX_BATCH_WRITES, returns how many writes went out."""
+        writes = list(self.pending.values())
+        self.pending.clear()
+
+        for i in range(0, len(writes), MAX_BATCH_WRITES):
+            chunk = writes[i:i + MAX_BATCH_WRITES]
+            batch = db.batch()
+            stageWrites(batch, chunk)
+
+            with metrics.firestoreCall("commit"):
+                batch.commit()
+            metrics.firestore_writes.inc("commit", amount=len(chunk))
+
+        log.debug(f"committed {len(writes)} profile writes")
+        return len(writes)
+
+def stageWrites(batch: firestore.WriteBatch, writes: list[tuple[firestore.DocumentReference, dict, bool]]) -> None:
+    for ref, data, merge in writes:
+        if merge:
+            # only the changed fields, and it works whether or not the document is there
+            batch.set(ref, data, merge=True)
+        else:
+            batch.set(ref, data)
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import date, datetime
+import numpy as np
+import logging as log
+from archive_parser import parseFile
+from fake_firestore import FakeFirestore
+from generate_archive import generateArchive
+
+# replays an archive through bot.on_message as fake discord messages, against an in-memory firestore, and reports
+# how long the handler took, how late the event loop ran and how many rpcs it all cost. runs fully offline.
+
+class FakeGuild:
+    def __init__(self, id: int, name: str, icon: str):
+        self.id = id
+        self.name = name
+        self.icon = icon
+        # no memories channel, every replayed message gets stored
+        self.channels = list["FakeChannel"]()
+
+class FakeChannel:
+    def __init__(self, id: int, name: str, guild: FakeGuild):
+        self.id = id
+        self.name = name
+        self.guild = guild
+
+class FakeAuthor:
+    def __init__(self, id: int, username: str, nickname: str, color: str, avatar: str):
+        self.id = id
+        self.global_name = username
+        self.display_name = nickname
+        self.color = color
+        self.display_avatar = avatar
+
+class FakeAttachment:
+    def __init__(self, url: str, filename: str):
+        self.url = url
+        self.filename = filename
+
+class FakeMessage:
+    def __init__(self, id: int, author: FakeAuthor, channel: FakeChannel, content: str, created_at: datetime, attachments: list[FakeAttachment]):
+        self.id = id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.created_at = created_at
+        self.attachments = attachments
+
+def loadReplay(folder: str, limit: int | None) -> list[FakeMessage]:
+    """Every message in the exports in folder as a fake discord message, oldest first."""
+    out = []
+
+    for file in sorted(os.listdir(folder)):
+        result = parseFile(os.path.join(folder, file))
+
+        server_name, channel_name, icon, channel_id, server_id = result["channel"]
+        channel = FakeChannel(int(channel_id), channel_name, FakeGuild(int(server_id), server_name, icon))
+        authors = dict[str, FakeAuthor]()
+
+        for author_id, author_json in result["authors"].items():
+            authors[author_id] = FakeAuthor(int(author_id), author_json["name"], author_json["nickname"], author_json["color"], author_json["avatarUrl"])
+
+        for message_id, author_id, content, timestamp, attachments in result["messages"]:
+            out.append(FakeMessage(int(message_id), authors[author_id], channel, content, datetime.fromisoformat(timestamp), [FakeAttachment(url, name) for url, name in attachments]))
+
+    out.sort(key=lambda message: message.created_at)
+    return out if limit is None else out[:limit]
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    out = dict()
+
+    if len(samples) == 0:
+        return out
+
+    values = np.array(samples) * 1000
+
+    out["count"] = len(samples)
+    out["p50_ms"] = float(np.percentile(values, 50))
+    out["p90_ms"] = float(np.percentile(values, 90))
+    out["p99_ms"] = float(np.percentile(values, 99))
+    out["max_ms"] = float(values.max())
+
+    return out
+
+async def watchLoop(lags: list[float], interval: float = 0.01) -> None:
+    # how much later than asked for a short sleep comes back is how long the loop was busy with something else
+    loop = asyncio.get_running_loop()
+
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(loop.time() - expected, 0.0))
+
+async def replay(messages: list[FakeMessage], rate: float, fake: FakeFirestore) -> dict:
+    # imported here so the environment is set up before the bot builds its backend
+    import bot
+    import message_reader_fs as mr
+
+    mr.db = fake
+    # what the writer couldn't write shouldn't be picked up by the next replay
+    spill_dir = tempfile.TemporaryDirectory()
+    bot.backend.writer.spill_file = os.path.join(spill_dir.name, "write_spill.jsonl")
+
+    handler_times = list[float]()
+    # document path of each message, by when its handler was called
+    dispatched = dict[str, float]()
+    lags = list[float]()
+
+    async def handle(message: FakeMessage) -> None:
+        start = time.perf_counter()
+        dispatched[f"servers/{mr.namespaceFor(message.guild.id)}/messages/{message.id}"] = start
+        await bot.on_message(message)
+        handler_times.append(time.perf_counter() - start)
+
+    await bot.backend.start()
+    watcher = asyncio.create_task(watchLoop(lags))
+
+    # every event gets its own task, like discord.py dispatches them
+    handlers = []
+    start = time.perf_counter()
+
+    for i, message in enumerate(messages):
+        if rate > 0:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        handlers.append(asyncio.create_task(handle(message)))
+
+    await asyncio.gather(*handlers)
+    dispatch_time = time.perf_counter() - start
+
+    await bot.backend.stop()
+    total_time = time.perf_counter() - start
+    spill_dir.cleanup()
+
+    watcher.cancel()
+
+    # from the handler being called to the message document landing in the fake
+    end_to_end = []
+    for path, dispatched_at in dispatched.items():
+        written_at = fake.written_at.get(path)
+        if written_at is not None:
+            end_to_end.append(written_at - dispatched_at)
+
+    out = dict()
+
+    out["messages"] = len(messages)
+    out["persisted"] = len(end_to_end)
+    out["dispatch_s"] = dispatch_time
+    out["total_s"] = total_time
+    out["throughput_per_s"] = len(end_to_end) / total_time if total_time > 0 else 0.0
+    out["handler"] = percentiles(handler_times)
+    out["end_to_end"] = percentiles(end_to_end)
+    out["loop_lag"] = percentiles(lags)
+    out["rpcs"] = dict(fake.rpcs)
+    out["injected_failures"] = dict(fake.failures)
+    out["writer"] = bot.backend.writer.stats()
+
+    return out
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replays messages through the bot's handlers against an in-memory firestore")
+    parser.add_argument("--archive", default=None, help="folder of exports to replay, a synthetic archive is generated if not given")
+    parser.add_argument("--days", type=int, default=30, help="days in the synthetic archive")
+    parser.add_argument("--per-day", type=float, default=200, help="messages per day in the synthetic archive")
+    parser.add_argument("--limit", type=int, default=None, help="replay at most this many messages")
+    parser.add_argument("--rate", type=float, default=500, help="messages per second to replay at, 0 sends them all at once")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency of every fake rpc")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="mean of the exponential jitter added to every rpc")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="chance of any one rpc failing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="also write the report to this json file")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own logging")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO if args.verbose else log.ERROR)
+    os.environ["STORAGE_BACKEND"] = "firestore"
+
+    if args.archive is not None:
+        messages = loadReplay(args.archive, args.limit)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            end = date.today()
+            generateArchive(folder, per_day=args.per_day, start=date.fromordinal(end.toordinal() - args.days + 1), end=end, seed=args.seed)
+            messages = loadReplay(folder, args.limit)
+
+    fake = FakeFirestore(args.latency_ms / 1000, args.jitter_ms / 1000, args.failure_rate, args.seed)
+
+    print(f"replaying {len(messages)} messages at {'full speed' if args.rate <= 0 else f'{args.rate:g}/s'}")
+    report = asyncio.run(replay(messages, args.rate, fake))
+
+    print(json.dumps(report, indent=2))
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
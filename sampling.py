@@ -0,0 +1,66 @@
+import numpy as np
+
+default_rng = np.random.default_rng()
+
+class AliasTable:
+    """Walker/Vose alias table over a fixed set of weights.
+
+    Building it is O(n), after that every draw is O(1) and allocates nothing.
+    Pass an rng made with np.random.default_rng(seed) to draw() for reproducible picks.
+    """
+
+    def __init__(self, weights: np.ndarray):
+        weights = np.ascontiguousarray(weights, dtype=np.float64)
+        n = len(weights)
+
+        if n == 0:
+            raise ValueError("cannot build an alias table without any weights")
+
+        total = float(weights.sum())
+
+        # if everything weighs 0 there is nothing to prefer, so fall back to a uniform pick
+        if total > 0:
+            scaled = (weights * (n / total)).tolist()
+        else:
+            scaled = [1.0] * n
+
+        prob = np.ones(n, dtype=np.float64)
+        alias = np.arange(n, dtype=np.int64)
+
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+
+        while len(small) > 0 and len(large) > 0:
+            less = small.pop()
+            more = large.pop()
+
+            prob[less] = scaled[less]
+            alias[less] = more
+
+            scaled[more] = scaled[more] + scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # whatever is left is only off from 1 by rounding error, so it always keeps its own slot
+
+        self.n = n
+        self.weights = weights
+        self.prob = prob
+        self.alias = alias
+
+    def __len__(self) -> int:
+        return self.n
+
+    def draw(self, rng: np.random.Generator | None = None) -> int:
+        if rng is None:
+            rng = default_rng
+
+        # one uniform draw picks both the column and the coin flip inside it
+        u = rng.random() * self.n
+        column = min(int(u), self.n - 1)
+
+        if u - column < self.prob[column]:
+            return column
+        return int(self.alias[column])
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+import pytz
+import logging as log
+
+# when each job last ran, so a run missed while the bot was down can be caught up after a restart
+STATE_FILE = os.getenv("SCHEDULER_STATE", "scheduler_state.json")
+
+class Job:
+    """A coroutine run every day at hour:minute in tz.
+
+    A run that was missed (the bot was down, or the loop woke up late) still happens if it is at most grace late.
+    """
+
+    def __init__(self, name: str, hour: int, minute: int, tz: pytz.BaseTzInfo, run: Callable[[], Awaitable[None]], grace: timedelta = timedelta(hours=1)):
+        self.name = name
+        self.hour = hour
+        self.minute = minute
+        self.tz = tz
+        self.run = run
+        self.grace = grace
+
+        self.last_run: datetime | None = None
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    def at(self, day) -> datetime:
+        # localize picks the right offset on either side of a dst change
+        return self.tz.localize(datetime(day.year, day.month, day.day, self.hour, self.minute))
+
+    def nextRun(self, now: datetime) -> datetime:
+        """The first scheduled time strictly after now."""
+        today = now.astimezone(self.tz).date()
+        run_at = self.at(today)
+
+        if run_at <= now:
+            run_at = self.at(today + timedelta(days=1))
+
+        return run_at
+
+    def previousRun(self, now: datetime) -> datetime:
+        """The last scheduled time at or before now."""
+        today = now.astimezone(self.tz).date()
+        run_at = self.at(today)
+
+        if run_at > now:
+            run_at = self.at(today - timedelta(days=1))
+
+        return run_at
+
+    def stats(self) -> dict:
+        out = dict()
+
+        out["runs"] = self.runs
+        out["failures"] = self.failures
+        out["last_run"] = None if self.last_run is None else self.last_run.isoformat()
+        out["last_duration"] = self.last_duration
+        out["max_duration"] = self.max_duration
+
+        return out
+
+class Scheduler:
+    """Runs each job in its own task that sleeps until the job's next scheduled time."""
+
+    def __init__(self, state_file: str = STATE_FILE):
+        self.state_file = state_file
+        self.jobs = dict[str, Job]()
+        self.tasks = dict[str, asyncio.Task]()
+        # when each job last ran as read from the state file, kept for jobs that are only added later
+        self.state = dict[str, datetime]()
+        self.running = False
+
+    def add(self, job: Job) -> Job:
+        """Adds job, replacing any job with the same name. Once the scheduler is running the job starts right away."""
+        self.remove(job.name)
+        self.jobs[job.name] = job
+
+        if job.name in self.state:
+            job.last_run = self.state[job.name]
+
+        if self.running:
+            self.tasks[job.name] = asyncio.create_task(self.loop(job))
+
+        return job
+
+    def remove(self, name: str) -> None:
+        self.jobs.pop(name, None)
+        task = self.tasks.pop(name, None)
+
+        if task is not None:
+            task.cancel()
+
+    def isRunning(self) -> bool:
+        return self.running
+
+    def start(self) -> None:
+        if self.running:
+            return
+
+        self.running = True
+        self.readState()
+
+        for job in self.jobs.values():
+            self.tasks[job.name] = asyncio.create_task(self.loop(job))
+
+    async def stop(self) -> None:
+        self.running = False
+
+        for task in self.tasks.values():
+            task.cancel()
+
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+
+    async def loop(self, job: Job) -> None:
+        now = datetime.now(job.tz)
+        missed = job.previousRun(now)
+
+        # only a job that is known to have run before gets caught up, a fresh install doesn't replay yesterday
+        if job.last_run is not None and job.last_run < missed and now - missed <= job.grace:
+            log.info(f"catching up on {job.name}, missed the run at {missed}")
+            await self.runJob(job, missed)
+
+        while True:
+            run_at = job.nextRun(datetime.now(job.tz))
+            await sleepUntil(run_at)
+
+            late = datetime.now(job.tz) - run_at
+            if late > job.grace:
+                log.warning(f"skipping {job.name} for {run_at}, woke up {late} late")
+                continue
+
+            await self.runJob(job, run_at)
+
+    async def runJob(self, job: Job, scheduled: datetime) -> None:
+        start = time.perf_counter()
+
+        try:
+            await job.run()
+            job.runs += 1
+        except Exception as e:
+            job.failures += 1
+            log.error(f"job {job.name} failed: {e}")
+
+        job.last_duration = time.perf_counter() - start
+        job.max_duration = max(job.max_duration, job.last_duration)
+        job.last_run = scheduled
+
+        late = (datetime.now(job.tz) - scheduled).total_seconds() - job.last_duration
+        log.info(f"job {job.name} for {scheduled} took {job.last_duration:.2f}s, started {late:.2f}s after its scheduled time")
+
+        self.writeState()
+
+    def readState(self) -> None:
+        if not os.path.exists(self.state_file):
+            return
+
+        try:
+            with open(self.state_file, "r") as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError) as e:
+            log.warning(f"ignoring unreadable scheduler state {self.state_file}: {e}")
+            return
+
+        for name, last_run in state.items():
+            self.state[name] = datetime.fromisoformat(last_run)
+
+            if name in self.jobs:
+                self.jobs[name].last_run = self.state[name]
+
+    def writeState(self) -> None:
+        for name, job in self.jobs.items():
+            if job.last_run is not None:
+                self.state[name] = job.last_run
+
+        state = {name: last_run.isoformat() for name, last_run in self.state.items()}
+        tmp_path = self.state_file + ".tmp"
+
+        try:
+            with open(tmp_path, "w") as state_file:
+                json.dump(state, state_file)
+
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            log.warning(f"couldn't save scheduler state: {e}")
+
+async def sleepUntil(when: datetime) -> None:
+    # sleeps in steps of at most an hour so a wall clock adjustment can't push the wakeup far off
+    while True:
+        remaining = (when - datetime.now(when.tzinfo)).total_seconds()
+
+        if remaining <= 0:
+            return
+
+        await asyncio.sleep(min(remaining, 3600))
\ No newline at end of file
@@ -0,0 +1,293 @@
+import json
+import os
+import re
+from operator import attrgetter, methodcaller
+import numpy as np
+
+RULES_FILE = os.getenv("SCORING_RULES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "scoring_rules.json"))
+
+# what str.split() splits on, by code point. every whitespace character is at or below U+3000, anything above
+# looks up the last entry, which is False
+SPACE_TABLE = np.array([chr(c).isspace() for c in range(0x3002)], dtype=bool)
+
+# what a word can be for scoreBatch, as bits
+BLOCKED = 1
+MENTION = 2
+
+# any large odd number spreads the words' hashes well enough
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+def codePoints(text: str) -> np.ndarray:
+    return np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+
+def wordHashes(codes: np.ndarray, solid: np.ndarray, starts: np.ndarray, width: int) -> tuple[np.ndarray, np.ndarray]:
+    """The hash of the first width code points of each word starting at starts, and its length up to width + 1.
+
+    solid has one more entry than codes, which is False. Equal words hash the same, a word that hashes like another
+    one still has to be compared with it.
+    """
+    hashes = np.zeros(len(starts), dtype=np.uint64)
+    lengths = np.zeros(len(starts), dtype=np.int64)
+    inside = np.ones(len(starts), dtype=bool)
+
+    for offset in range(width + 1):
+        positions = np.minimum(starts + offset, len(codes))
+        inside &= solid[positions]
+        lengths += inside
+
+        if offset < width:
+            # past the end of a word counts as a zero
+            hashes *= HASH_MULTIPLIER
+            hashes += np.where(inside, codes[np.minimum(positions, len(codes) - 1)], 0)
+
+    return hashes, lengths
+
+class ScoringEngine:
+    """Scores messages for the memory of the day from the rules in scoring_rules.json.
+
+    score() handles one message, scoreBatch() a whole list into a numpy array. scoreBatch() works out the same
+    features for every message at once and multiplies in the same order, so they give bit for bit the same weights.
+    """
+
+    def __init__(self, rules: dict):
+        self.base_weight = float(rules["base_weight"])
+
+        # a content warning or other words that signal something bad takes the message out of the running
+        self.blocked_words = frozenset(word.lower() for word in rules["blocked_words"])
+
+        # mentioning someone else makes a message more interesting
+        self.mention_marker = rules["mention_marker"]
+        self.mention_words = frozenset(word.lower() for word in rules["mention_words"])
+        self.mention_boost = float(rules["mention_boost"])
+
+        self.dm_boost = float(rules["dm_boost"])
+
+        # short messages rarely are interesting, the shorter the bigger the penalty. messages with pictures are exempt
+        self.short_message_words = int(rules["short_message_words"])
+        self.short_message_penalty = float(rules["short_message_penalty"])
+
+        self.attachment_boost = float(rules["attachment_boost"])
+
+        # e.g. penalize venting, add a little spice for nsfw
+        self.channel_rules = [(re.compile(re.escape(rule["contains"])), float(rule["multiplier"])) for rule in rules["channel_rules"]]
+
+        # prioritize messages sent by us
+        self.boosted_usernames = frozenset(rules["boosted_usernames"])
+        self.username_boost = float(rules["username_boost"])
+
+        # the words scoreBatch has to look for. only a word without whitespace can be a word of split()
+        self.word_kinds = dict[str, int]()
+        for word in self.blocked_words | self.mention_words:
+            if word.split() == [word]:
+                self.word_kinds[word] = BLOCKED * (word in self.blocked_words) | MENTION * (word in self.mention_words)
+
+        self.word_width = max(map(len, self.word_kinds), default=0)
+        # lookup tables of the lengths and first code points the words have, anything past the end is neither
+        self.word_lengths = np.zeros(self.word_width + 2, dtype=bool)
+        self.word_initials = np.zeros(max((ord(word[0]) for word in self.word_kinds), default=0) + 2, dtype=bool)
+        for word in self.word_kinds:
+            self.word_lengths[len(word)] = True
+            self.word_initials[ord(word[0])] = True
+        # and their first two code points, a code point fits in 21 bits and a word of one has a zero for the second
+        self.word_openings = np.array(sorted({ord(word[0]) << 21 | (ord(word[1]) if len(word) > 1 else 0) for word in self.word_kinds}), dtype=np.uint64)
+        self.word_hashes = np.array([wordHashes(codePoints(word), np.arange(len(word) + 1) < len(word), np.zeros(1, dtype=np.int64), self.word_width)[0][0] for word in self.word_kinds], dtype=np.uint64)
+
+        # mention_boost ** n for every n seen so far, shared so both paths use the exact same factors
+        self.mention_factors = [1.0]
+        self.channel_multipliers = dict[str, float]()
+
+    def mentionFactor(self, mentions: int) -> float:
+        while len(self.mention_factors) <= mentions:
+            self.mention_factors.append(self.mention_boost ** len(self.mention_factors))
+
+        return self.mention_factors[mentions]
+
+    def channelMultiplier(self, channel_name: str) -> float:
+        multiplier = self.channel_multipliers.get(channel_name)
+
+        if multiplier is None:
+            multiplier = 1.0
+            for pattern, rule_multiplier in self.channel_rules:
+                if pattern.search(channel_name) is not None:
+                    multiplier *= rule_multiplier
+
+            self.channel_multipliers[channel_name] = multiplier
+
+        return multiplier
+
+    def features(self, msg) -> tuple[bool, int, int, bool, bool, float, bool]:
+        # lowercase once for the whole message instead of twice per word
+        words = msg.content.lower().split()
+        blocked = not self.blocked_words.isdisjoint(words)
+
+        mentions = 0
+        if not blocked:
+            marker = self.mention_marker
+            mention_words = self.mention_words
+            for word in words:
+                if marker in word or word in mention_words:
+                    mentions += 1
+
+        is_dm = msg.isDM()
+        has_attachments = len(msg.attachments) > 0
+        boosted_user = msg.sender.username in self.boosted_usernames
+
+        return blocked, mentions, len(words), is_dm, has_attachments, self.channelMultiplier(msg.channel.channel_name), boosted_user
+
+    def score(self, msg) -> float:
+        blocked, mentions, word_count, is_dm, has_attachments, channel_multiplier, boosted_user = self.features(msg)
+
+        if blocked:
+            return 0.0
+
+        weight = self.base_weight * self.mentionFactor(mentions)
+
+        if is_dm:
+            weight *= self.dm_boost
+
+        if word_count <= self.short_message_words and not has_attachments:
+            weight *= self.short_message_penalty * word_count
+
+        if has_attachments:
+            weight *= self.attachment_boost
+
+        weight *= channel_multiplier
+
+        if boosted_user:
+            weight *= self.username_boost
+
+        # a negative weight would break sampling
+        if weight < 0:
+            return 0.0
+
+        return weight
+
+    def bulkFeatures(self, msgs: list) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """features() for every message at once, as arrays.
+
+        Every message's lowercased content goes into one string and the words are found from a whitespace mask over
+        its code points. Only the words that start like a blocked or mention word are hashed, and python only looks at
+        the ones whose hash matches.
+        """
+        n = len(msgs)
+
+        contents = list(map(str.lower, map(attrgetter("content"), msgs)))
+        lengths = np.fromiter(map(len, contents), dtype=np.int64, count=n)
+        # a space between messages so no word runs from one into the next
+        starts = np.zeros(n, dtype=np.int64)
+        np.cumsum(lengths[:-1] + 1, out=starts[1:])
+        text = " ".join(contents)
+
+        codes = codePoints(text)
+        # one past the end counts as whitespace, so the last word ends like every other
+        space = np.append(SPACE_TABLE[np.minimum(codes, len(SPACE_TABLE) - 1)], True)
+        solid = ~space
+        word_starts = solid & np.insert(space[:-1], 0, True)
+
+        # how many words start before each position, the difference at a message's ends is its word count
+        words_before = np.zeros(len(word_starts) + 1, dtype=np.int64)
+        np.cumsum(word_starts, out=words_before[1:])
+        word_counts = (words_before[starts + lengths] - words_before[starts]).astype(np.float64)
+
+        # positions in text of the words that are blocked, and of the words that are mentions, each word once
+        blocked_at = list[int]()
+        mentioned_at = list[int]()
+
+        if len(self.word_kinds) > 0:
+            # only words that start like one of them are hashed, only those as long as one of them are compared
+            candidates = np.flatnonzero(word_starts[:-1] & self.word_initials[np.minimum(codes, len(self.word_initials) - 1)])
+            seconds = np.where(solid[candidates + 1], codes[np.minimum(candidates + 1, len(codes) - 1)], 0)
+            candidates = candidates[np.isin(codes[candidates].astype(np.uint64) << 21 | seconds, self.word_openings)]
+            hashes, word_lengths = wordHashes(codes, solid, candidates, self.word_width)
+            matched = np.isin(hashes, self.word_hashes) & self.word_lengths[word_lengths]
+
+            for start, length in zip(candidates[matched].tolist(), word_lengths[matched].tolist()):
+                kind = self.word_kinds.get(text[start:start + length], 0)
+
+                if kind & BLOCKED:
+                    blocked_at.append(start)
+                if kind & MENTION:
+                    mentioned_at.append(start)
+
+        mentioned = np.array(mentioned_at, dtype=np.int64)
+
+        if self.mention_marker == "":
+            mentioned = np.flatnonzero(word_starts)
+        elif len(self.mention_marker.split()) == 1:
+            # a marker with whitespace in it can't be in a word, any other one makes the word it is in a mention
+            if len(self.mention_marker) == 1:
+                marked = np.flatnonzero(codes == ord(self.mention_marker))
+            else:
+                marked = np.fromiter((match.start() for match in re.finditer(re.escape(self.mention_marker), text)), dtype=np.int64)
+
+            # a word counts once however many markers it has, and even if it is a mention word too
+            word_ids = np.concatenate((words_before[mentioned + 1], words_before[marked + 1]))
+            mentioned = np.concatenate((mentioned, marked))[np.unique(word_ids, return_index=True)[1]]
+
+        blocked = np.zeros(n, dtype=bool)
+        blocked[np.searchsorted(starts, np.array(blocked_at, dtype=np.int64), side="right") - 1] = True
+
+        mentions = np.bincount(np.searchsorted(starts, mentioned, side="right") - 1, minlength=n)
+        mentions[blocked] = 0
+
+        is_dm = np.fromiter(map(methodcaller("isDM"), msgs), dtype=bool, count=n)
+        has_attachments = np.fromiter(map(bool, map(attrgetter("attachments"), msgs)), dtype=bool, count=n)
+        boosted_users = np.fromiter(map(self.boosted_usernames.__contains__, map(attrgetter("sender.username"), msgs)), dtype=bool, count=n)
+
+        # a day only has a few channels, so the multipliers are worked out once per name
+        channel_names = list(map(attrgetter("channel.channel_name"), msgs))
+        for channel_name in set(channel_names):
+            self.channelMultiplier(channel_name)
+        channel_multipliers = np.fromiter(map(self.channel_multipliers.__getitem__, channel_names), dtype=np.float64, count=n)
+
+        return blocked, mentions, word_counts, is_dm, has_attachments, channel_multipliers, boosted_users
+
+    def scoreBatch(self, msgs: list) -> np.ndarray:
+        n = len(msgs)
+
+        if n == 0:
+            return np.empty(0, dtype=np.float64)
+
+        blocked, mentions, word_counts, is_dm, has_attachments, channel_multipliers, boosted_users = self.bulkFeatures(msgs)
+
+        max_mentions = int(mentions.max())
+        self.mentionFactor(max_mentions)
+        factors = np.array(self.mention_factors, dtype=np.float64)
+
+        weights = self.base_weight * factors[mentions]
+
+        weights[is_dm] *= self.dm_boost
+
+        short = (word_counts <= self.short_message_words) & ~has_attachments
+        weights[short] *= self.short_message_penalty * word_counts[short]
+
+        weights[has_attachments] *= self.attachment_boost
+
+        weights *= channel_multipliers
+
+        weights[boosted_users] *= self.username_boost
+
+        weights[blocked] = 0.0
+        np.maximum(weights, 0.0, out=weights)
+
+        return weights
+
+def loadRules(path: str = RULES_FILE) -> ScoringEngine:
+    with open(path, "r") as rules_file:
+        return ScoringEngine(json.load(rules_file))
+
+engine: ScoringEngine | None = None
+
+def getEngine() -> ScoringEngine:
+    global engine
+
+    if engine is None:
+        engine = loadRules()
+
+    return engine
+
+def calcWeight(msg) -> float:
+    return getEngine().score(msg)
+
+def scoreBatch(msgs: list) -> np.ndarray:
+    return getEngine().scoreBatch(msgs)
@@ -0,0 +1,411 @@
+import argparse
+import math
+import os
+import re
+import threading
+import time
+import numpy as np
+import logging as log
+import message_reader_fs as mr
+
+# a local inverted index over message content for $search, since firestore can't search text. it is built once
+# from the message_reader archive (python search_index.py), saved as one .npz file and kept up to date with every
+# message the bot stores. messages are only identified here, the hits are looked up through the storage backend.
+#
+# documents are numbered in the order they were added. every term has a sorted array of the documents it is in,
+# a query intersects those, filters on the document columns and ranks what is left with bm25.
+
+INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search_index.npz")
+VERSION = 1
+
+# longer "words" are links and pasted garbage nobody searches for
+MAX_TERM_LENGTH = 40
+
+# bm25 parameters, there is no term frequency to saturate since chat messages rarely repeat a word
+BM25_B = 0.75
+
+TOKEN = re.compile(r"\w+")
+QUERY_PART = re.compile(r'(\w+):("[^"]*"|\S+)|"([^"]*)"|(\S+)')
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN.findall(text.lower()) if len(token) <= MAX_TERM_LENGTH]
+
+class Query:
+    """A parsed $search query: words that must all appear, phrases that must appear as written, and filters."""
+
+    def __init__(self, text: str):
+        self.terms = list[str]()
+        self.phrases = list[list[str]]()
+        self.senders = list[str]()
+        self.channels = list[str]()
+        self.years = list[int]()
+
+        for field, value, phrase, word in QUERY_PART.findall(text):
+            if field != "":
+                value = value.strip('"').lower()
+
+                if field == "from":
+                    self.senders.append(value.lstrip("@"))
+                elif field == "in":
+                    self.channels.append(value.lstrip("#"))
+                elif field == "year" and value.isdigit():
+                    self.years.append(int(value))
+                else:
+                    # not a filter we know, so it was just a word with a colon in it
+                    self.terms.extend(tokenize(field + ":" + value))
+            elif phrase != "":
+                tokens = tokenize(phrase)
+                self.terms.extend(tokens)
+                if len(tokens) > 1:
+                    self.phrases.append(tokens)
+            else:
+                self.terms.extend(tokenize(word))
+
+        self.terms = list(dict.fromkeys(self.terms))
+
+    def isEmpty(self) -> bool:
+        return len(self.terms) == 0
+
+class SearchIndex:
+    """Loaded documents are numpy columns, documents added since are kept in lists until the next save folds them in."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # term -> (start, end) in postings
+        self.terms = dict[str, tuple[int, int]]()
+        self.postings = np.zeros(0, dtype=np.uint32)
+
+        self.ids = np.zeros(0, dtype=np.uint64)
+        self.sorted_ids = np.zeros(0, dtype=np.uint64)
+        self.namespaces = np.zeros(0, dtype=np.uint16)
+        self.senders = np.zeros(0, dtype=np.uint64)
+        self.channels = np.zeros(0, dtype=np.uint64)
+        self.years = np.zeros(0, dtype=np.uint16)
+        self.lengths = np.zeros(0, dtype=np.uint16)
+        self.content_offsets = np.zeros(1, dtype=np.uint64)
+        self.contents = b""
+
+        # documents added since the index was loaded, numbered after the saved ones
+        self.new_postings = dict[str, list[int]]()
+        self.new_docs = list[tuple[int, int, int, int, int, int, str]]()
+        self.new_ids = set[int]()
+
+        self.namespace_names = list[str]()
+        self.namespace_index = dict[str, int]()
+        # lowercased username and nickname by sender id, channel name by channel id, for the filters
+        self.people = dict[int, tuple[str, str]]()
+        self.channel_names = dict[int, str]()
+
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.new_docs)
+
+    def unsaved(self) -> int:
+        return len(self.new_docs)
+
+    def contains(self, discord_id: int) -> bool:
+        if discord_id in self.new_ids:
+            return True
+
+        position = int(np.searchsorted(self.sorted_ids, np.uint64(discord_id)))
+        return position < len(self.sorted_ids) and int(self.sorted_ids[position]) == discord_id
+
+    def add(self, message: mr.Message, namespace: str | None = None) -> bool:
+        """Indexes message under namespace (its own by default), False if it was already indexed."""
+        if namespace is None:
+            namespace = message.namespace()
+
+        discord_id = int(message.discord_id)
+        sender_id = int(message.sender.discord_id)
+        channel_id = int(message.channel.channel_id)
+        tokens = tokenize(message.content)
+
+        with self.lock:
+            if self.contains(discord_id):
+                return False
+
+            if namespace not in self.namespace_index:
+                self.namespace_index[namespace] = len(self.namespace_names)
+                self.namespace_names.append(namespace)
+
+            self.people[sender_id] = (str(message.sender.username).lower(), str(message.sender.nickname).lower())
+            self.channel_names[channel_id] = str(message.channel.channel_name).lower()
+
+            doc = len(self)
+            length = min(len(tokens), 65535)
+            self.new_docs.append((discord_id, self.namespace_index[namespace], sender_id, channel_id, message.ts.astimezone(mr.EDT).year, length, message.content))
+            self.new_ids.add(discord_id)
+            self.total_length += length
+
+            for term in set(tokens):
+                if term not in self.new_postings:
+                    self.new_postings[term] = list[int]()
+                self.new_postings[term].append(doc)
+
+        return True
+
+    def postingsFor(self, term: str) -> np.ndarray:
+        # callers hold the lock
+        start, end = self.terms.get(term, (0, 0))
+        saved = self.postings[start:end]
+        added = self.new_postings.get(term)
+
+        if added is None:
+            return saved
+
+        return np.concatenate([saved, np.array(added, dtype=np.uint32)])
+
+    def column(self, docs: np.ndarray, saved: np.ndarray, field: int) -> np.ndarray:
+        # one field of each document in docs, from the saved columns or the added documents
+        count = len(self.ids)
+        out = np.empty(len(docs), dtype=saved.dtype)
+        is_saved = docs < count
+
+        out[is_saved] = saved[docs[is_saved]]
+        out[~is_saved] = [self.new_docs[doc - count][field] for doc in docs[~is_saved].tolist()]
+
+        return out
+
+    def content(self, doc: int) -> str:
+        count = len(self.ids)
+
+        if doc >= count:
+            return self.new_docs[doc - count][6]
+
+        return self.contents[int(self.content_offsets[doc]):int(self.content_offsets[doc + 1])].decode("utf-8", "surrogatepass")
+
+    def search(self, query: Query, namespace: str, limit: int = 3) -> tuple[list[str], int]:
+        """The ids of the best limit matches for query among namespace's messages, and how many matched in all.
+
+        The total counts every message that matches, phrases and filters included.
+        """
+        if query.isEmpty():
+            return [], 0
+
+        with self.lock:
+            if namespace not in self.namespace_index:
+                return [], 0
+
+            postings = sorted((self.postingsFor(term) for term in query.terms), key=len)
+            docs = postings[0]
+
+            # rarest first so the intermediate results stay small
+            for other in postings[1:]:
+                if len(docs) == 0:
+                    break
+                docs = np.intersect1d(docs, other, assume_unique=True)
+
+            docs = docs.astype(np.int64)
+            keep = self.column(docs, self.namespaces, 1) == self.namespace_index[namespace]
+
+            if len(query.senders) > 0:
+                senders = [sender_id for sender_id, names in self.people.items() if any(value in names or value == str(sender_id) for value in query.senders)]
+                keep &= np.isin(self.column(docs, self.senders, 2), np.array(senders, dtype=np.uint64))
+
+            if len(query.channels) > 0:
+                # names are lowercased on both sides, and the start of a name is enough
+                channels = [channel_id for channel_id, name in self.channel_names.items() if any(name.startswith(value) or value == str(channel_id) for value in query.channels)]
+                keep &= np.isin(self.column(docs, self.channels, 3), np.array(channels, dtype=np.uint64))
+
+            if len(query.years) > 0:
+                keep &= np.isin(self.column(docs, self.years, 4), query.years)
+
+            docs = docs[keep]
+
+            # phrases are checked against the text of every match, so the total only counts real matches
+            if len(query.phrases) > 0 and len(docs) > 0:
+                docs = docs[np.array([hasPhrases(tokenize(self.content(doc)), query.phrases) for doc in docs.tolist()], dtype=bool)]
+
+            if len(docs) == 0:
+                return [], 0
+
+            # every match has every term, so only the idf sum and the length normalization differ between them
+            total = len(self)
+            idf = sum(math.log(1 + (total - len(terms) + 0.5) / (len(terms) + 0.5)) for terms in postings)
+            average_length = self.total_length / total if total > 0 else 1
+            lengths = self.column(docs, self.lengths, 5).astype(np.float64)
+            scores = idf * 2 / (1 + (1 - BM25_B + BM25_B * lengths / average_length))
+
+            # best first, newer messages (larger ids) first on a tie
+            ids = self.column(docs, self.ids, 0)
+            order = np.lexsort((-ids.astype(np.float64), -scores))
+
+            out = [str(int(ids[i])) for i in order[:limit].tolist()]
+
+            return out, len(docs)
+
+    def arrays(self) -> tuple[dict[str, np.ndarray], int]:
+        """Everything in the index as arrays, saved and added documents merged, and how many documents were added."""
+        with self.lock:
+            new_docs = list(self.new_docs)
+            new_postings = {term: list(docs) for term, docs in self.new_postings.items()}
+            terms = dict(self.terms)
+            postings = self.postings
+            namespace_names = list(self.namespace_names)
+            people = dict(self.people)
+            channel_names = dict(self.channel_names)
+            saved = (self.ids, self.namespaces, self.senders, self.channels, self.years, self.lengths)
+            content_offsets = self.content_offsets
+            contents = self.contents
+
+        all_terms = sorted(terms.keys() | new_postings.keys())
+        term_ends = np.zeros(len(all_terms), dtype=np.uint64)
+        merged = list[np.ndarray]()
+        end = 0
+
+        for i, term in enumerate(all_terms):
+            start, stop = terms.get(term, (0, 0))
+            merged.append(postings[start:stop])
+            if term in new_postings:
+                merged.append(np.array(new_postings[term], dtype=np.uint32))
+
+            end += stop - start + len(new_postings.get(term, ()))
+            term_ends[i] = end
+
+        columns = [np.concatenate([column, np.array([doc[field] for doc in new_docs], dtype=column.dtype)]) for field, column in enumerate(saved)]
+        new_contents = [doc[6].encode("utf-8", "surrogatepass") for doc in new_docs]
+        new_offsets = int(content_offsets[-1]) + np.cumsum([len(content) for content in new_contents], dtype=np.uint64)
+
+        out = dict()
+
+        out["version"] = np.array([VERSION])
+        out["terms"] = np.frombuffer("\n".join(all_terms).encode("utf-8", "surrogatepass"), dtype=np.uint8)
+        out["term_ends"] = term_ends
+        out["postings"] = np.concatenate(merged) if len(merged) > 0 else np.zeros(0, dtype=np.uint32)
+        out["ids"], out["namespaces"], out["senders"], out["channels"], out["years"], out["lengths"] = columns
+        out["content_offsets"] = np.concatenate([content_offsets, new_offsets])
+        out["contents"] = np.frombuffer(contents + b"".join(new_contents), dtype=np.uint8)
+        out["namespace_names"] = np.frombuffer("\n".join(namespace_names).encode("utf-8"), dtype=np.uint8)
+        out["people_ids"] = np.array(list(people.keys()), dtype=np.uint64)
+        out["people_names"] = np.frombuffer("\n".join(f"{username}\t{nickname}" for username, nickname in people.values()).encode("utf-8", "surrogatepass"), dtype=np.uint8)
+        out["channel_ids"] = np.array(list(channel_names.keys()), dtype=np.uint64)
+        out["channel_names"] = np.frombuffer("\n".join(channel_names.values()).encode("utf-8", "surrogatepass"), dtype=np.uint8)
+
+        return out, len(new_docs)
+
+    def save(self, path: str = INDEX_PATH) -> None:
+        arrays, new_docs = self.arrays()
+        tmp_path = path + ".tmp.npz"
+
+        np.savez(tmp_path, **arrays)
+        # a crash mid-write leaves the previous index in place
+        os.replace(tmp_path, path)
+
+        # what was just saved becomes the columns, so the added documents don't pile up in lists between restarts
+        self.install(arrays, new_docs)
+
+    def load(self, path: str = INDEX_PATH) -> None:
+        with np.load(path, allow_pickle=False) as arrays:
+            if int(arrays["version"][0]) != VERSION:
+                raise ValueError(f"{path} is search index version {int(arrays['version'][0])}, expected {VERSION}")
+
+            self.install(arrays)
+
+    def install(self, arrays, folded: int | None = None) -> None:
+        """Makes arrays (as arrays() returns them) the saved columns.
+
+        With folded the arrays were built from this index and hold the first folded added documents, which are
+        dropped from the lists while the ones added since stay. Without it the index is replaced by the arrays.
+        """
+        terms = splitLines(arrays["terms"])
+        term_ends = arrays["term_ends"].tolist()
+        namespace_names = splitLines(arrays["namespace_names"])
+        people_names = [line.split("\t", 1) for line in splitLines(arrays["people_names"])]
+        channel_names = splitLines(arrays["channel_names"])
+        ids = arrays["ids"]
+        sorted_ids = np.sort(ids)
+        contents = arrays["contents"].tobytes()
+
+        with self.lock:
+            self.terms = dict(zip(terms, zip([0] + term_ends[:-1], term_ends)))
+            self.postings = arrays["postings"]
+            self.ids = ids
+            self.sorted_ids = sorted_ids
+            self.namespaces = arrays["namespaces"]
+            self.senders = arrays["senders"]
+            self.channels = arrays["channels"]
+            self.years = arrays["years"]
+            self.lengths = arrays["lengths"]
+            self.content_offsets = arrays["content_offsets"]
+            self.contents = contents
+
+            if folded is None:
+                self.new_docs.clear()
+                self.new_postings.clear()
+
+                self.namespace_names = namespace_names
+                self.namespace_index = {namespace: i for i, namespace in enumerate(namespace_names)}
+                self.people = {sender_id: (names[0], names[1]) for sender_id, names in zip(arrays["people_ids"].tolist(), people_names)}
+                self.channel_names = dict(zip(arrays["channel_ids"].tolist(), channel_names))
+            else:
+                # documents keep their numbers, the ones still added are numbered right after the new columns. the
+                # namespaces, people and channels here already include everything in arrays
+                count = len(ids)
+                del self.new_docs[:folded]
+                self.new_postings = {term: kept for term, docs in self.new_postings.items() if len(kept := [doc for doc in docs if doc >= count]) > 0}
+
+            self.new_ids = {doc[0] for doc in self.new_docs}
+            self.total_length = int(self.lengths.sum()) + sum(doc[5] for doc in self.new_docs)
+
+def splitLines(array: np.ndarray) -> list[str]:
+    text = array.tobytes().decode("utf-8", "surrogatepass")
+    return [] if text == "" else text.split("\n")
+
+def hasPhrases(tokens: list[str], phrases: list[list[str]]) -> bool:
+    for phrase in phrases:
+        if not any(tokens[i:i + len(phrase)] == phrase for i in range(len(tokens) - len(phrase) + 1)):
+            return False
+
+    return True
+
+def openIndex(path: str = INDEX_PATH) -> SearchIndex:
+    """The index saved at path, or an empty one that only covers messages stored from now on."""
+    index = SearchIndex()
+
+    if not os.path.exists(path):
+        log.warning(f"there is no search index at {path}, run search_index.py to index the archive")
+        return index
+
+    start = time.perf_counter()
+    try:
+        index.load(path)
+    except (OSError, ValueError, KeyError) as e:
+        log.error(f"couldn't load the search index {path}, starting an empty one: {e}")
+        return SearchIndex()
+
+    log.info(f"loaded the search index with {len(index)} messages in {time.perf_counter() - start:.2f}s")
+    return index
+
+def buildIndex(path: str) -> None:
+    """Indexes the message_reader archive, as the pizzeria server's messages, into a new index at path."""
+    import message_reader
+
+    index = SearchIndex()
+    start = time.perf_counter()
+
+    for message in message_reader.messages.values():
+        index.add(message, mr.DEFAULT_NAMESPACE)
+
+    print(f"indexed {len(index)} messages with {len(index.new_postings)} terms in {time.perf_counter() - start:.1f}s")
+
+    index.save(path)
+    print(f"saved to {path} ({os.path.getsize(path) / 1e6:.1f}MB)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the $search index from the local messages2 archive")
+    parser.add_argument("path", nargs="?", default=INDEX_PATH, help="file to write the index to")
+    parser.add_argument("--query", default=None, help="run a query against the index at path instead of building it")
+    parser.add_argument("--namespace", default=mr.DEFAULT_NAMESPACE)
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+
+    if args.query is None:
+        buildIndex(args.path)
+    else:
+        index = openIndex(args.path)
+        start = time.perf_counter()
+        ids, total = index.search(Query(args.query), args.namespace, limit=10)
+        print(f"{total} matches in {(time.perf_counter() - start) * 1000:.1f}ms: {ids}")
\ No newline at end of file
@@ -0,0 +1,166 @@
+import asyncio
+import os
+import zlib
+from abc import ABC, abstractmethod
+from datetime import date
+from typing import Callable
+import numpy as np
+import metrics
+import logging as log
+import message_reader_fs as mr
+from message_cache import MessageCache
+
+refresh_seconds = metrics.Histogram("day_refresh_seconds", "Time to load and prepare today's messages")
+prefetch_seconds = metrics.Histogram("day_prefetch_seconds", "Time to load and prepare tomorrow's messages ahead of midnight")
+
+# refreshes take one of this many locks, picked by namespace, so the locks don't grow with the servers the bot is in
+UPDATE_LOCK_STRIPES = 64
+
+class StorageBackend(ABC):
+    """Where the bot keeps messages, people and channels.
+
+    Backends implement the storage calls, the day cache (which lives in message_reader_fs) is refreshed,
+    prefetched and sampled the same way for all of them. Everything is kept per namespace (see message_reader_fs.namespaceFor),
+    a message's namespace comes from its channel's server.
+    """
+
+    def __init__(self):
+        # one refresh at a time per namespace. namespaces sharing a lock wait on each other, which only costs time
+        self.update_locks = [asyncio.Lock() for _ in range(UPDATE_LOCK_STRIPES)]
+        # loads the day cache of every server in the background once the bot is connected
+        self.warmup: asyncio.Task | None = None
+        self.message_cache = MessageCache(self.getMessage)
+        # called with messages once they are stored, which can be a while after putMessage returns
+        self.stored_callbacks = list[Callable[[list[mr.Message]], None]]()
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    async def putMessage(self, message: mr.Message) -> None:
+        pass
+
+    @abstractmethod
+    async def getMessage(self, id: str, namespace: str) -> mr.Message | None:
+        pass
+
+    @abstractmethod
+    async def candidatesForDay(self, today: date, namespace: str) -> list[mr.Message]:
+        """Every message in namespace sent on today's month and day in a past year."""
+        pass
+
+    @abstractmethod
+    async def upsertPerson(self, person: mr.Person, namespace: str) -> None:
+        pass
+
+    @abstractmethod
+    async def upsertChannel(self, channel: mr.Channel) -> None:
+        pass
+
+    def onStored(self, callback: Callable[[list[mr.Message]], None]) -> None:
+        self.stored_callbacks.append(callback)
+
+    def stored(self, messages: list[mr.Message]) -> None:
+        """Backends call this with messages once they are written."""
+        for callback in self.stored_callbacks:
+            try:
+                callback(messages)
+            except Exception as e:
+                log.error(f"stored callback failed for {len(messages)} messages: {e}")
+
+    async def lookupMessage(self, id: str, namespace: str = mr.DEFAULT_NAMESPACE) -> mr.Message | None:
+        """getMessage through the message cache, this is what $message uses."""
+        return await self.message_cache.lookup(id, namespace)
+
+    def stats(self) -> dict[str, float]:
+        """Numbers worth watching about this backend, the message cache's by default."""
+        return {"message_cache_" + key: value for key, value in self.message_cache.stats().items()}
+
+    def startWarmUp(self, namespaces: list[str]) -> asyncio.Task:
+        if self.warmup is None or self.warmup.done():
+            # no more than fit in memory, loading the rest would only push the first ones out again
+            self.warmup = asyncio.create_task(self.warmUp(namespaces[:mr.MAX_DAY_CACHES]))
+            self.warmup.add_done_callback(logWarmUp)
+
+        return self.warmup
+
+    async def warmUp(self, namespaces: list[str]) -> None:
+        # one namespace after another, so a bot in many servers doesn't load all of them at once
+        for namespace in namespaces:
+            try:
+                await self.updateTodaysMessages(namespace)
+            except Exception as e:
+                # the next command that needs this day cache will try to load it again
+                log.error(f"warming up today's messages for {namespace} failed: {e}")
+
+    def updateLock(self, namespace: str) -> asyncio.Lock:
+        return self.update_locks[zlib.crc32(namespace.encode("utf-8")) % len(self.update_locks)]
+
+    async def updateTodaysMessages(self, namespace: str = mr.DEFAULT_NAMESPACE) -> None:
+        # a refresh that is already running covers anyone else who asks for one
+        async with self.updateLock(namespace):
+            today = mr.getTodaysDate()
+
+            # publishes the prefetched day if there is one, then there's nothing left to load
+            if mr.todaysSnapshot(namespace, today).day == today:
+                return
+
+            log.info(f"updating today's messages for {namespace}")
+
+            with refresh_seconds.time():
+                loaded = await self.candidatesForDay(today, namespace)
+                mr.setTodaysMessages(set[mr.Message](loaded), today, namespace)
+
+            log.info(f"finished updating today's messages for {namespace}, loaded {len(loaded)} messages")
+
+    async def prefetchDay(self, day: date, namespace: str = mr.DEFAULT_NAMESPACE) -> None:
+        """Loads day's messages ahead of time, they are published the first time they are asked for on that day.
+
+        Only past years' messages are loaded for a day, so nothing sent between now and then is missed.
+        """
+        cache = mr.findDayCache(namespace)
+
+        # already loaded, or about to be published
+        if cache is not None and (cache.current.day >= day or (cache.staged is not None and cache.staged.day == day)):
+            return
+
+        log.info(f"prefetching {day}'s messages for {namespace}")
+
+        with prefetch_seconds.time():
+            loaded = await self.candidatesForDay(day, namespace)
+            mr.stageMessages(set[mr.Message](loaded), day, namespace)
+
+        log.info(f"prefetched {len(loaded)} messages for {namespace}")
+
+    async def getMessageFromToday(self, namespace: str = mr.DEFAULT_NAMESPACE, rng: np.random.Generator | None = None) -> mr.Message:
+        snapshot = mr.todaysSnapshot(namespace)
+
+        # if the warm up is loading this namespace right now, the lock has us wait for that load instead
+        if snapshot.day != mr.getTodaysDate():
+            await self.updateTodaysMessages(namespace)
+            # sample from what the refresh published, never from the snapshot taken before it
+            snapshot = mr.todaysSnapshot(namespace)
+
+        return snapshot.choose(rng)
+
+def logWarmUp(task: asyncio.Task) -> None:
+    if not task.cancelled():
+        log.info("today's messages are warmed up")
+
+def getBackend(name: str | None = None) -> StorageBackend:
+    """Picks the backend named by STORAGE_BACKEND (firestore or sqlite), firestore by default."""
+    if name is None:
+        name = os.getenv("STORAGE_BACKEND", "firestore")
+
+    if name == "firestore":
+        from storage_firestore import FirestoreBackend
+        return FirestoreBackend()
+
+    if name == "sqlite":
+        from storage_sqlite import SqliteBackend
+        return SqliteBackend(os.getenv("SQLITE_PATH", "pizzeria.db"))
+
+    raise ValueError(f"unknown storage backend {name}")
\ No newline at end of file
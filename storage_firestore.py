@@ -0,0 +1,43 @@
+import asyncio
+from datetime import date
+import message_reader_fs as mr
+import message_reader_fs_async as amr
+from message_writer import MessageWriter
+from storage_backend import StorageBackend
+
+class FirestoreBackend(StorageBackend):
+    """servers/<namespace> in firestore. Writes go through the write-behind queue, reads through the AsyncClient."""
+
+    def __init__(self):
+        super().__init__()
+        self.writer = MessageWriter(on_commit=self.stored)
+
+    async def start(self) -> None:
+        self.writer.start()
+
+    async def stop(self) -> None:
+        # anything still queued gets written before we go down
+        await self.writer.stop()
+
+    def stats(self) -> dict[str, float]:
+        out = super().stats()
+
+        for key, value in self.writer.stats().items():
+            out["writer_" + key] = value
+
+        return out
+
+    async def putMessage(self, message: mr.Message) -> None:
+        await self.writer.enqueue(message)
+
+    async def getMessage(self, id: str, namespace: str) -> mr.Message | None:
+        return await amr.getMessage(id, namespace)
+
+    async def candidatesForDay(self, today: date, namespace: str) -> list[mr.Message]:
+        return await amr.loadDay(today, namespace)
+
+    async def upsertPerson(self, person: mr.Person, namespace: str) -> None:
+        await asyncio.to_thread(mr.upsertPerson, person, namespace)
+
+    async def upsertChannel(self, channel: mr.Channel) -> None:
+        await asyncio.to_thread(mr.upsertChannel, channel)
\ No newline at end of file
@@ -0,0 +1,219 @@
+import asyncio
+import argparse
+import json
+import sqlite3
+import threading
+from datetime import datetime, date, timezone
+import logging as log
+import message_reader_fs as mr
+from storage_backend import StorageBackend
+
+# discord ids are snowflakes, they fit in sqlite's 64 bit integers. month_day and year are the same as in firestore
+# documents (mr.monthDay). namespace is the server's namespace (see mr.namespaceFor), a person has one profile per
+# namespace since nicknames and colors are per server.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+create table if not exists people (
+    namespace text not null,
+    discord_id integer not null,
+    username text not null,
+    nickname text not null,
+    color text not null,
+    avatar text not null,
+    primary key (namespace, discord_id)
+);
+
+create table if not exists channels (
+    channel_id integer primary key,
+    namespace text not null,
+    server_id integer not null,
+    server_name text not null,
+    channel_name text not null,
+    icon text not null
+);
+
+create table if not exists messages (
+    discord_id integer primary key,
+    namespace text not null,
+    sender_id integer not null,
+    channel_id integer not null references channels (channel_id),
+    content text not null,
+    ts_us integer not null,
+    month_day integer not null,
+    year integer not null,
+    attachments text not null
+);
+
+create index if not exists messages_by_day on messages (namespace, month_day, year);
+"""
+
+# version 0 had no namespaces, everything in it belonged to pizzeria
+MIGRATE_FROM_0 = """
+alter table people rename to people_0;
+alter table channels rename to channels_0;
+alter table messages rename to messages_0;
+drop index if exists messages_by_day;
+""" + SCHEMA + """
+insert into people select 'pizzeria', discord_id, username, nickname, color, avatar from people_0;
+insert into channels select channel_id, 'pizzeria', server_id, server_name, channel_name, icon from channels_0;
+insert into messages select discord_id, 'pizzeria', sender_id, channel_id, content, ts_us, month_day, year, attachments from messages_0;
+drop table messages_0;
+drop table channels_0;
+drop table people_0;
+"""
+
+MESSAGE_COLUMNS = """
+select m.discord_id, m.content, m.ts_us, m.attachments,
+       p.discord_id, p.username, p.nickname, p.color, p.avatar,
+       c.channel_id, c.server_id, c.server_name, c.channel_name, c.icon
+from messages m
+join people p on p.namespace = m.namespace and p.discord_id = m.sender_id
+join channels c on c.channel_id = m.channel_id
+"""
+
+def tsToMicros(ts: datetime) -> int:
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+
+    delta = ts - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def microsToTs(ts_us: int) -> datetime:
+    seconds, micros = divmod(ts_us, 1000000)
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(microsecond=micros)
+
+def personRow(person, namespace: str) -> tuple:
+    return (namespace, int(person.discord_id), person.username, person.nickname, person.color, person.avatar)
+
+def channelRow(channel, namespace: str) -> tuple:
+    return (int(channel.channel_id), namespace, int(channel.server_id), channel.server_name, channel.channel_name, channel.icon)
+
+def messageRow(message, namespace: str) -> tuple:
+    month_day, year = mr.monthDay(message.ts)
+    attachments = json.dumps([[attachment.url, attachment.name] for attachment in message.attachments], ensure_ascii=False)
+
+    return (int(message.discord_id), namespace, int(message.sender.discord_id), int(message.channel.channel_id), message.content, tsToMicros(message.ts), month_day, year, attachments)
+
+UPSERT_PERSON = "insert into people values (?, ?, ?, ?, ?, ?) on conflict (namespace, discord_id) do update set username = excluded.username, nickname = excluded.nickname, color = excluded.color, avatar = excluded.avatar"
+UPSERT_CHANNEL = "insert into channels values (?, ?, ?, ?, ?, ?) on conflict (channel_id) do update set namespace = excluded.namespace, server_id = excluded.server_id, server_name = excluded.server_name, channel_name = excluded.channel_name, icon = excluded.icon"
+PUT_MESSAGE = "insert or replace into messages values (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+class SqliteBackend(StorageBackend):
+    """Everything in one local sqlite file. Lookups are an index probe, so there's no round trip and no read cost.
+
+    sqlite calls block, they run in a worker thread on a single connection guarded by a lock.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # readers don't wait on the writer, and a commit doesn't need a full fsync
+        self.conn.execute("pragma journal_mode = wal")
+        self.conn.execute("pragma synchronous = normal")
+        self.migrate()
+
+    def migrate(self) -> None:
+        version = self.conn.execute("pragma user_version").fetchone()[0]
+        existing = self.conn.execute("select count(*) from sqlite_master where type = 'table' and name = 'messages'").fetchone()[0] > 0
+
+        if existing and version == 0:
+            log.info(f"moving {self.path} to schema version {SCHEMA_VERSION}")
+            # executescript commits before it runs, so the whole move is wrapped in one transaction of its own
+            self.conn.executescript("begin;" + MIGRATE_FROM_0 + f"pragma user_version = {SCHEMA_VERSION}; commit;")
+        else:
+            self.conn.executescript(SCHEMA + f"pragma user_version = {SCHEMA_VERSION};")
+
+    async def stop(self) -> None:
+        await asyncio.to_thread(self.close)
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    async def putMessage(self, message: mr.Message) -> None:
+        await asyncio.to_thread(self.putMessages, [message], message.namespace())
+        self.stored([message])
+
+    async def getMessage(self, id: str, namespace: str) -> mr.Message | None:
+        try:
+            key = int(id)
+        except ValueError:
+            return None
+
+        return await asyncio.to_thread(self.loadMessage, key, namespace)
+
+    async def candidatesForDay(self, today: date, namespace: str) -> list[mr.Message]:
+        return await asyncio.to_thread(self.loadDay, today, namespace)
+
+    async def upsertPerson(self, person: mr.Person, namespace: str) -> None:
+        await asyncio.to_thread(self.execute, UPSERT_PERSON, personRow(person, namespace))
+
+    async def upsertChannel(self, channel: mr.Channel) -> None:
+        await asyncio.to_thread(self.execute, UPSERT_CHANNEL, channelRow(channel, mr.namespaceFor(channel.server_id)))
+
+    def execute(self, sql: str, row: tuple) -> None:
+        with self.lock, self.conn:
+            self.conn.execute(sql, row)
+
+    def putMessages(self, to_put: list, namespace: str) -> None:
+        """Writes the messages, all from namespace, along with their senders and channels in one transaction.
+
+        The messages can be message_reader's as well as message_reader_fs's, so the namespace is passed in.
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(UPSERT_PERSON, {message.sender.discord_id: personRow(message.sender, namespace) for message in to_put}.values())
+            self.conn.executemany(UPSERT_CHANNEL, {channel.channel_id: channelRow(channel, namespace) for channel in (message.channel for message in to_put)}.values())
+            self.conn.executemany(PUT_MESSAGE, [messageRow(message, namespace) for message in to_put])
+
+    def loadMessage(self, id: int, namespace: str = mr.DEFAULT_NAMESPACE) -> mr.Message | None:
+        with self.lock:
+            row = self.conn.execute(MESSAGE_COLUMNS + " where m.discord_id = ? and m.namespace = ?", (id, namespace)).fetchone()
+
+        return None if row is None else buildMessage(row, dict(), dict())
+
+    def loadDay(self, today: date, namespace: str = mr.DEFAULT_NAMESPACE) -> list[mr.Message]:
+        with self.lock:
+            rows = self.conn.execute(MESSAGE_COLUMNS + " where m.namespace = ? and m.month_day = ? and m.year < ?", (namespace, today.month * 100 + today.day, today.year)).fetchall()
+
+        senders = dict[int, mr.Person]()
+        channels = dict[int, mr.Channel]()
+
+        return [buildMessage(row, senders, channels) for row in rows]
+
+def buildMessage(row: tuple, senders: dict[int, mr.Person], channels: dict[int, mr.Channel]) -> mr.Message:
+    message_id, content, ts_us, attachments, sender_id, username, nickname, color, avatar, channel_id, server_id, server_name, channel_name, icon = row
+
+    # messages from the same sender or channel share one object, like loadMessages does on firestore
+    if sender_id not in senders:
+        senders[sender_id] = mr.Person(username, str(sender_id), nickname, color, avatar)
+
+    if channel_id not in channels:
+        channels[channel_id] = mr.Channel(server_name, channel_name, icon, channel_id, server_id)
+
+    return mr.Message(senders[sender_id], channels[channel_id], content, microsToTs(ts_us), str(message_id), [mr.Attachment(url, name) for url, name in json.loads(attachments)])
+
+def importArchive(path: str) -> None:
+    """Copies the local messages2 archive (through message_reader) into the sqlite file at path, as the pizzeria server's messages."""
+    import message_reader
+
+    backend = SqliteBackend(path)
+    to_put = list(message_reader.messages.values())
+
+    print(f"importing {len(to_put)} messages into {path}")
+
+    for i in range(0, len(to_put), 10000):
+        backend.putMessages(to_put[i:i + 10000], mr.DEFAULT_NAMESPACE)
+
+    backend.close()
+    print("done")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Imports the local messages2 archive into a sqlite database for the sqlite backend")
+    parser.add_argument("path", nargs="?", default="pizzeria.db", help="sqlite file to import into")
+    args = parser.parse_args()
+
+    log.basicConfig(level=log.INFO)
+    importArchive(args.path)
\ No newline at end of file
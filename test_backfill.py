@@ -0,0 +1,118 @@
+import json
+from datetime import datetime
+import pytest
+import pytz
+from google.api_core.exceptions import ServiceUnavailable
+import backfill_schema
+import message_reader_fs as mr
+from fake_firestore import FakeFirestore
+
+# the backfill against the in-memory firestore: documents from before the snapshots were stored inline get them
+# along with month_day and year, and a run that dies partway picks up after the last page it committed
+
+NAMESPACE = "pizzeria"
+MESSAGES = 23
+PAGE = 5
+
+def makeArchive(fake: FakeFirestore) -> None:
+    """MESSAGES documents in the version 1 layout, only references to the sender and channel."""
+    for sender_id in ("1", "2", "3"):
+        fake.docs[f"servers/{NAMESPACE}/people/{sender_id}"] = mr.Person(f"user{sender_id}", sender_id, f"nick{sender_id}", "#ffffff", "").toDict()
+
+    fake.docs[f"servers/{NAMESPACE}/channels/20"] = mr.Channel("Pizzeria", "general", "", "20", "300").toDict()
+
+    for i in range(MESSAGES):
+        discord_id = f"{1000 + i}"
+        # the last one's sender was never stored
+        sender_id = "9" if i == MESSAGES - 1 else str(i % 3 + 1)
+
+        fake.docs[f"servers/{NAMESPACE}/messages/{discord_id}"] = {
+            "sender": fake.document("servers", NAMESPACE, "people", sender_id),
+            "channel": fake.document("servers", NAMESPACE, "channels", "20"),
+            "content": f"message {i}",
+            "ts": datetime(2019, 3, 1 + i % 28, 20, 0, tzinfo=pytz.utc),
+            "discord_id": discord_id,
+            "attachments": [],
+        }
+
+def failCommit(fake: FakeFirestore, number: int) -> None:
+    # the fake fails at random, this fails exactly the number'th commit
+    rpc = fake.rpc
+
+    def failing(kind: str) -> None:
+        rpc(kind)
+        if kind == "commit" and fake.rpcs["commit"] == number:
+            raise ServiceUnavailable("injected commit failure")
+
+    fake.rpc = failing
+
+def messagePaths() -> list[str]:
+    return [f"servers/{NAMESPACE}/messages/{1000 + i}" for i in range(MESSAGES)]
+
+def test_backfill_migrates_old_documents(tmp_path, monkeypatch):
+    fake = FakeFirestore()
+    makeArchive(fake)
+    monkeypatch.setattr(mr, "db", fake)
+
+    totals = backfill_schema.backfill(NAMESPACE, PAGE, str(tmp_path / "checkpoint.json"))
+
+    assert totals["read"] == MESSAGES
+    assert totals["migrated"] == MESSAGES - 1
+    assert totals["missing"] == 1
+
+    for path in messagePaths()[:-1]:
+        doc = fake.docs[path]
+        assert doc["schema"] == mr.SCHEMA_VERSION
+        assert (doc["month_day"], doc["year"]) == mr.monthDay(doc["ts"])
+        assert doc["sender_snapshot"] == fake.docs[doc["sender"].path]
+        assert doc["channel_snapshot"] == fake.docs[doc["channel"].path]
+        # the migrated documents decode without reading the references again
+        assert mr.hasInlineProfiles(fake.document(*path.split("/")).snapshot())
+
+    assert "schema" not in fake.docs[messagePaths()[-1]]
+
+def test_backfill_resumes_after_a_failed_commit(tmp_path, monkeypatch):
+    fake = FakeFirestore()
+    makeArchive(fake)
+    monkeypatch.setattr(mr, "db", fake)
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    failCommit(fake, 3)
+
+    with pytest.raises(ServiceUnavailable):
+        backfill_schema.backfill(NAMESPACE, PAGE, checkpoint_path)
+
+    # the first two pages committed and were checkpointed, the third wasn't written at all
+    with open(checkpoint_path, "r") as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)[NAMESPACE]
+
+    paths = messagePaths()
+    assert checkpoint["last_message_id"] == paths[2 * PAGE - 1].rsplit("/", 1)[-1]
+    assert checkpoint["read"] == 2 * PAGE
+    assert all("schema" not in fake.docs[path] for path in paths[2 * PAGE:])
+
+    written_at = {path: fake.written_at[path] for path in paths[:2 * PAGE]}
+    queries = fake.rpcs["query"]
+
+    totals = backfill_schema.backfill(NAMESPACE, PAGE, checkpoint_path)
+
+    # the second run only read the 13 messages left, in three pages, and didn't write the first two again
+    assert fake.rpcs["query"] - queries == 3
+    assert all(fake.written_at[path] == written_at[path] for path in written_at)
+
+    assert totals["read"] == MESSAGES
+    assert totals["migrated"] == MESSAGES - 1
+    assert totals["missing"] == 1
+    assert all(fake.docs[path]["schema"] == mr.SCHEMA_VERSION for path in paths[:-1])
+
+def test_dry_run_writes_nothing(tmp_path, monkeypatch):
+    fake = FakeFirestore()
+    makeArchive(fake)
+    monkeypatch.setattr(mr, "db", fake)
+    checkpoint_path = tmp_path / "checkpoint.json"
+
+    totals = backfill_schema.backfill(NAMESPACE, PAGE, str(checkpoint_path), dry_run=True)
+
+    assert totals["migrated"] == MESSAGES - 1
+    assert fake.rpcs["commit"] == 0
+    assert not checkpoint_path.exists()
\ No newline at end of file
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from sampling import AliasTable
+
+# an alias table gives every column 1/n, split between the column itself (prob) and its alias. adding those shares
+# back up has to give the weights exactly, and draws have to follow them
+
+def sharesOf(table: AliasTable) -> np.ndarray:
+    """The chance of drawing each index, as the table's columns give it."""
+    shares = table.prob.copy()
+    np.add.at(shares, table.alias, 1 - table.prob)
+    return shares / len(table)
+
+def test_columns_add_up_to_the_weights():
+    rng = np.random.default_rng(1)
+
+    for n in (1, 2, 3, 17, 1000):
+        weights = rng.exponential(size=n)
+        table = AliasTable(weights)
+
+        assert np.allclose(sharesOf(table), weights / weights.sum())
+
+def test_draws_follow_the_weights():
+    weights = np.array([1.0, 2.0, 3.0, 4.0])
+    table = AliasTable(weights)
+    rng = np.random.default_rng(0)
+    draws = 200_000
+
+    counts = np.bincount([table.draw(rng) for _ in range(draws)], minlength=len(weights))
+
+    # a few standard deviations of a binomial at this many draws
+    assert np.allclose(counts / draws, weights / weights.sum(), atol=0.005)
+
+def test_zero_weights_are_never_drawn():
+    table = AliasTable(np.array([0.0, 5.0, 0.0, 1.0, 0.0]))
+    rng = np.random.default_rng(0)
+
+    drawn = {table.draw(rng) for _ in range(10_000)}
+
+    assert drawn == {1, 3}
+
+def test_all_zero_weights_pick_uniformly():
+    table = AliasTable(np.zeros(4))
+
+    assert np.allclose(sharesOf(table), 0.25)
+
+def test_one_weight():
+    table = AliasTable(np.array([3.0]))
+
+    assert len(table) == 1
+    assert table.draw(np.random.default_rng(0)) == 0
+
+def test_no_weights():
+    with pytest.raises(ValueError):
+        AliasTable(np.array([]))
+
+def test_draws_are_reproducible_with_a_seed():
+    table = AliasTable(np.arange(1.0, 50.0))
+
+    def drawWithSeed(seed: int) -> list[int]:
+        rng = np.random.default_rng(seed)
+        return [table.draw(rng) for _ in range(100)]
+
+    assert drawWithSeed(7) == drawWithSeed(7)
+    assert drawWithSeed(7) != drawWithSeed(8)
\ No newline at end of file
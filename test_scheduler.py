@@ -0,0 +1,122 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+import pytz
+from scheduler import Job, Scheduler
+
+# catching up on a run that was missed while the bot was down. the job is scheduled a couple of minutes ago so
+# the scheduler finds a missed run as soon as it starts, whether it runs it depends on the state file and the grace
+
+EDT = pytz.timezone("America/New_York")
+
+def jobMissedMinutesAgo(name: str, minutes: int, grace: timedelta, ran: asyncio.Event) -> Job:
+    scheduled = datetime.now(pytz.utc) - timedelta(minutes=minutes)
+
+    async def run() -> None:
+        ran.set()
+
+    return Job(name, scheduled.hour, scheduled.minute, pytz.utc, run, grace=grace)
+
+def writeState(path: str, state: dict[str, datetime]) -> None:
+    with open(path, "w") as state_file:
+        json.dump({name: last_run.isoformat() for name, last_run in state.items()}, state_file)
+
+async def startAndWait(scheduler: Scheduler, ran: asyncio.Event, timeout: float) -> bool:
+    scheduler.start()
+
+    try:
+        await asyncio.wait_for(ran.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        await scheduler.stop()
+
+def test_missed_run_is_caught_up(tmp_path):
+    async def check() -> None:
+        state_path = str(tmp_path / "state.json")
+        ran = asyncio.Event()
+        job = jobMissedMinutesAgo("refresh", 2, timedelta(hours=1), ran)
+        missed = job.previousRun(datetime.now(pytz.utc))
+        writeState(state_path, {"refresh": missed - timedelta(days=1)})
+
+        scheduler = Scheduler(state_path)
+        scheduler.add(job)
+
+        assert await startAndWait(scheduler, ran, 5)
+        assert job.last_run == missed
+        assert job.runs == 1
+
+        # the catch-up is recorded, so the next restart doesn't run it again
+        with open(state_path, "r") as state_file:
+            assert datetime.fromisoformat(json.load(state_file)["refresh"]) == missed
+
+    asyncio.run(check())
+
+def test_run_already_done_is_not_repeated(tmp_path):
+    async def check() -> None:
+        state_path = str(tmp_path / "state.json")
+        ran = asyncio.Event()
+        job = jobMissedMinutesAgo("refresh", 2, timedelta(hours=1), ran)
+        writeState(state_path, {"refresh": job.previousRun(datetime.now(pytz.utc))})
+
+        scheduler = Scheduler(state_path)
+        scheduler.add(job)
+
+        assert not await startAndWait(scheduler, ran, 0.2)
+
+    asyncio.run(check())
+
+def test_fresh_install_does_not_catch_up(tmp_path):
+    async def check() -> None:
+        ran = asyncio.Event()
+        scheduler = Scheduler(str(tmp_path / "state.json"))
+        scheduler.add(jobMissedMinutesAgo("refresh", 2, timedelta(hours=1), ran))
+
+        assert not await startAndWait(scheduler, ran, 0.2)
+
+    asyncio.run(check())
+
+def test_run_missed_by_more_than_the_grace_is_skipped(tmp_path):
+    async def check() -> None:
+        state_path = str(tmp_path / "state.json")
+        ran = asyncio.Event()
+        job = jobMissedMinutesAgo("refresh", 5, timedelta(minutes=1), ran)
+        writeState(state_path, {"refresh": job.previousRun(datetime.now(pytz.utc)) - timedelta(days=1)})
+
+        scheduler = Scheduler(state_path)
+        scheduler.add(job)
+
+        assert not await startAndWait(scheduler, ran, 0.2)
+
+    asyncio.run(check())
+
+def test_state_is_kept_for_jobs_added_later(tmp_path):
+    async def check() -> None:
+        state_path = str(tmp_path / "state.json")
+        ran = asyncio.Event()
+        job = jobMissedMinutesAgo("refresh", 2, timedelta(hours=1), ran)
+        writeState(state_path, {"refresh": job.previousRun(datetime.now(pytz.utc)) - timedelta(days=1)})
+
+        # servers join after the scheduler has started, their jobs still get the state read at start
+        scheduler = Scheduler(state_path)
+        scheduler.start()
+        scheduler.add(job)
+
+        await asyncio.wait_for(ran.wait(), 5)
+        await scheduler.stop()
+
+    asyncio.run(check())
+
+def test_runs_across_dst():
+    job = Job("motd", 9, 0, EDT, None)
+
+    # the night the clocks go forward, the next run is still 9am local
+    before = EDT.localize(datetime(2026, 3, 7, 12, 0))
+    next_run = job.nextRun(before)
+
+    assert next_run.date() == datetime(2026, 3, 8).date()
+    assert (next_run.hour, next_run.minute) == (9, 0)
+    assert next_run - before == timedelta(hours=20)
+    assert job.previousRun(next_run) == next_run
+    assert job.previousRun(next_run - timedelta(seconds=1)) == EDT.localize(datetime(2026, 3, 7, 9, 0))
\ No newline at end of file
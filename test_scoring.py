@@ -0,0 +1,74 @@
+import itertools
+import json
+import numpy as np
+from scoring import ScoringEngine, loadRules, RULES_FILE
+
+# scoreBatch has to give bit for bit the weights score gives one message at a time, over every rule in
+# scoring_rules.json. the messages only have what scoring reads, so the test doesn't need either reader
+
+CONTENTS = ("", "hi", "lol ok sure", "cw this is sad", "@david look at this one", "sycamore and reed and abi were here tonight",
+            "a pretty long message about nothing in particular at all", "TW kill", "@a @b @c @d @e @f @g")
+CHANNELS = (("general", "300"), ("venting", "300"), ("nsfw-venting", "300"), ("nsfw", "300"), ("dm", "0"))
+USERNAMES = ("someone", "neonkitchens")
+
+class Person:
+    def __init__(self, username: str):
+        self.username = username
+
+class Channel:
+    def __init__(self, channel_name: str, server_id: str):
+        self.channel_name = channel_name
+        self.server_id = server_id
+
+class Message:
+    def __init__(self, sender: Person, channel: Channel, content: str, attachments: list):
+        self.sender = sender
+        self.channel = channel
+        self.content = content
+        self.attachments = attachments
+
+    def isDM(self) -> bool:
+        return self.channel.server_id == "0"
+
+def makeMessages() -> list[Message]:
+    out = []
+
+    for content, (channel_name, server_id), username, attachment_count in itertools.product(CONTENTS, CHANNELS, USERNAMES, (0, 1, 2)):
+        out.append(Message(Person(username), Channel(channel_name, server_id), content, [f"{n}.png" for n in range(attachment_count)]))
+
+    return out
+
+def assertParity(engine: ScoringEngine, messages: list[Message]) -> None:
+    batch = engine.scoreBatch(messages)
+    single = np.array([engine.score(message) for message in messages], dtype=np.float64)
+
+    assert batch.dtype == np.float64
+    assert np.array_equal(batch, single)
+
+def test_batch_matches_single_scores():
+    assertParity(loadRules(), makeMessages())
+
+def test_batch_matches_single_scores_with_negative_weights():
+    with open(RULES_FILE, "r") as rules_file:
+        rules = json.load(rules_file)
+
+    # weights below zero are clamped on both paths
+    rules["channel_rules"].append({"contains": "venting", "multiplier": -2.0})
+    assertParity(ScoringEngine(rules), makeMessages())
+
+def test_batch_matches_single_scores_on_odd_text():
+    with open(RULES_FILE, "r") as rules_file:
+        rules = json.load(rules_file)
+
+    # scoreBatch finds words in the code points of every message at once, so split() has to agree with it on
+    # unicode whitespace, case folding that changes lengths and a marker longer than one character
+    rules["mention_marker"] = "<@"
+    rules["mention_words"].append("kill")
+    contents = ("cw\u3000x", "x\xa0tw", "\u0130 kms", "<@1>\tdavid", "david<@", "sycamore syc sy", "\U0001f600 @ <@", "\x1cdeath\x1c", "ab\u2028kill", "")
+    messages = [Message(Person("someone"), Channel("general", "300"), content, []) for content in contents]
+
+    assertParity(ScoringEngine(rules), messages)
+    assertParity(loadRules(), messages)
+
+def test_empty_batch():
+    assert len(loadRules().scoreBatch([])) == 0
\ No newline at end of file
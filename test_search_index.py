@@ -0,0 +1,77 @@
+from datetime import datetime
+import numpy as np
+import pytz
+import message_reader_fs as mr
+from search_index import Query, SearchIndex, openIndex
+
+# saving folds the added documents into the columns while the bot keeps adding more. whatever was added between
+# building the arrays and installing them has to stay searchable, and nothing may be indexed twice
+
+NAMESPACE = "pizzeria"
+
+PEOPLE = {"someone": "1", "latecomer": "2"}
+CHANNELS = {"general": "20", "venting": "21"}
+
+def makeMessage(discord_id: int, content: str, username: str = "someone", channel_name: str = "general") -> mr.Message:
+    sender = mr.Person(username, PEOPLE[username], username, "#ffffff", "")
+    channel = mr.Channel("Pizzeria", channel_name, "", CHANNELS[channel_name], "300")
+    return mr.Message(sender, channel, content, datetime(2021, 6, 1, tzinfo=pytz.utc), str(discord_id), [])
+
+def search(index: SearchIndex, text: str) -> tuple[list[str], int]:
+    return index.search(Query(text), NAMESPACE, 10)
+
+def test_save_keeps_messages_added_meanwhile(tmp_path):
+    index = SearchIndex()
+    path = str(tmp_path / "index.npz")
+
+    for discord_id, content in ((1, "pizza tonight"), (2, "pizza again"), (3, "no pizza")):
+        index.add(makeMessage(discord_id, content), NAMESPACE)
+
+    arrays, folded = index.arrays()
+
+    # these come in while the save is writing the file
+    index.add(makeMessage(4, "late pizza", "latecomer", "venting"), NAMESPACE)
+    index.add(makeMessage(5, "pineapple"), NAMESPACE)
+
+    np.savez(path, **arrays)
+    index.install(arrays, folded)
+
+    assert len(index) == 5
+    assert index.unsaved() == 2
+    assert sorted(search(index, "pizza")[0]) == ["1", "2", "3", "4"]
+    assert search(index, "pineapple") == (["5"], 1)
+    assert search(index, "pizza from:latecomer in:vent") == (["4"], 1)
+    assert all(index.contains(discord_id) for discord_id in range(1, 6))
+
+    # already indexed, whichever side of the fold it is on
+    assert not index.add(makeMessage(2, "pizza again"), NAMESPACE)
+    assert not index.add(makeMessage(5, "pineapple"), NAMESPACE)
+
+    # the file only has what was there when the arrays were built
+    loaded = openIndex(path)
+    assert len(loaded) == 3
+    assert search(loaded, "pineapple") == ([], 0)
+
+    # the next save has everything, and loads back to the same results
+    index.save(path)
+    assert index.unsaved() == 0
+
+    loaded = openIndex(path)
+    for text in ("pizza", "pineapple", '"late pizza"', "pizza from:latecomer", "pizza year:2021"):
+        assert search(loaded, text) == search(index, text)
+
+def test_saving_twice_changes_nothing(tmp_path):
+    index = SearchIndex()
+    path = str(tmp_path / "index.npz")
+
+    for discord_id in range(1, 30):
+        index.add(makeMessage(discord_id, f"word{discord_id % 4} common"), NAMESPACE)
+
+    index.save(path)
+    first = search(index, "common word1")
+
+    index.save(path)
+
+    assert search(index, "common word1") == first
+    assert search(openIndex(path), "common word1") == first
+    assert len(openIndex(path)) == 29
\ No newline at end of file